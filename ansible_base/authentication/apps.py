@@ -1,4 +1,6 @@
 from django.apps import AppConfig
+from django.contrib.auth import get_user_model, user_logged_in
+from django.db.models import signals
 
 import ansible_base.lib.checks  # noqa: F401 - register checks
 
@@ -8,3 +10,16 @@ class AuthenticationConfig(AppConfig):
     name = 'ansible_base.authentication'
     label = 'dab_authentication'
     verbose_name = 'Pluggable Authentication'
+
+    def ready(self):
+        from ansible_base.authentication.models import Authenticator, AuthenticatorMap
+        from ansible_base.authentication.signals import handlers
+
+        signals.post_save.connect(handlers.authenticator_saved, sender=Authenticator, dispatch_uid='dab_authenticator_saved')
+        signals.post_delete.connect(handlers.authenticator_deleted, sender=Authenticator, dispatch_uid='dab_authenticator_deleted')
+        signals.post_save.connect(handlers.authenticator_map_changed, sender=AuthenticatorMap, dispatch_uid='dab_authenticator_map_saved')
+        signals.post_delete.connect(handlers.authenticator_map_changed, sender=AuthenticatorMap, dispatch_uid='dab_authenticator_map_deleted')
+        if hasattr(get_user_model(), 'last_login'):
+            # Take the place of the receiver django.contrib.auth connects with the same dispatch_uid, it would be kept if we only connected ours
+            user_logged_in.disconnect(dispatch_uid='update_last_login')
+            user_logged_in.connect(handlers.update_last_login, dispatch_uid='update_last_login')
@@ -7,6 +7,7 @@ from rest_framework.reverse import reverse
 from rest_framework.serializers import ValidationError
 
 from ansible_base.authentication.models import Authenticator
+from ansible_base.authentication.utils.circuit_breaker import CircuitBreaker
 from ansible_base.lib.serializers.fields import JSONField
 
 logger = logging.getLogger('ansible_base.authentication.authenticator_plugins.base')
@@ -54,6 +55,10 @@ class AbstractAuthenticatorPlugin:
 
     configuration_class = BaseAuthenticatorConfiguration
     configuration_encrypted_fields = []
+    # Plugins which talk to a remote service set this and call report_unavailable when the service can not be reached
+    circuit_breaker_enabled = False
+    # Plugins whose group names are case insensitive (i.e. LDAP DNs) set this so authenticator maps ignore the case of groups
+    case_insensitive_groups = False
 
     def __init__(self, database_instance=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -117,12 +122,54 @@ class AbstractAuthenticatorPlugin:
         """
         raise NotImplementedError("Implement in subclass.")
 
+    def verify_credentials(self, request, username=None, password=None, **kwargs):
+        """
+        Checks the username and password of a login without creating or changing anything (users, claims) in the database.
+        Returns something truthy which is passed to complete_login if they are valid, or None if they are not.
+
+        Password plugins implement this (with complete_login) to be run in ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_LOGIN mode,
+        plugins which don't are tried in order when their turn comes.
+        """
+        return NotImplemented
+
+    def complete_login(self, request, verified, username=None, password=None, **kwargs):
+        """
+        Creates or updates the user (and their claims) of a login which verify_credentials accepted and returns the user
+        """
+        raise NotImplementedError("Implement in subclass.")
+
+    def discard_login(self, verified) -> None:
+        """
+        Called instead of complete_login when verify_credentials accepted a login which another authenticator won
+        """
+        pass
+
+    def authenticator_saved(self, authenticator: Authenticator) -> None:
+        """
+        Called once the save of an authenticator of this type is committed so the plugin can prepare anything it serves (i.e. SAML metadata)
+        """
+        pass
+
     def get_login_url(self, authenticator):
         if authenticator.category == 'sso':
             return reverse('social:begin', kwargs={'backend': authenticator.slug})
 
+    def get_circuit_breaker(self) -> CircuitBreaker:
+        return CircuitBreaker(self.database_instance.id)
+
+    def get_servers(self, authenticator) -> list:
+        """
+        Plugins which pick between several servers (i.e. LDAP and TACACS+) return them here so their statistics can be viewed
+        """
+        return []
+
     def add_related_fields(self, request, authenticator):
-        return {}
+        related = {}
+        if self.circuit_breaker_enabled:
+            related["health"] = reverse('authenticator-health', kwargs={'pk': authenticator.id})
+        if self.get_servers(authenticator):
+            related["servers"] = reverse('authenticator-servers', kwargs={'pk': authenticator.id})
+        return related
 
     def validate(self, serializer, data):
         return data
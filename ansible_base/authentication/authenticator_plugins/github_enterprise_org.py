@@ -5,11 +5,14 @@ from social_core.backends.github_enterprise import GithubEnterpriseOrganizationO
 from ansible_base.authentication.authenticator_configurators.github import GithubEnterpriseOrgConfiguration
 from ansible_base.authentication.authenticator_plugins.base import AbstractAuthenticatorPlugin
 from ansible_base.authentication.social_auth import SocialAuthMixin, SocialAuthValidateCallbackMixin
+from ansible_base.authentication.utils.github import GithubMembershipCacheMixin
 
 logger = logging.getLogger('ansible_base.authentication.authenticator_plugins.github_enterprise_organization')
 
 
-class AuthenticatorPlugin(SocialAuthMixin, SocialAuthValidateCallbackMixin, GithubEnterpriseOrganizationOAuth2, AbstractAuthenticatorPlugin):
+class AuthenticatorPlugin(
+    GithubMembershipCacheMixin, SocialAuthMixin, SocialAuthValidateCallbackMixin, GithubEnterpriseOrganizationOAuth2, AbstractAuthenticatorPlugin
+):
     configuration_class = GithubEnterpriseOrgConfiguration
     logger = logger
     type = "github-enterprise-org"
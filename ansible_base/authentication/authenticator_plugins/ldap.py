@@ -1,20 +1,31 @@
+import functools
 import inspect
 import logging
 import re
+import time
 from collections import OrderedDict
-from typing import Any
+from typing import Any, Iterator, Optional
 
 import ldap
 from django.utils.translation import gettext_lazy as _
 from django_auth_ldap import config
 from django_auth_ldap.backend import LDAPBackend
 from django_auth_ldap.backend import LDAPSettings as BaseLDAPSettings
-from django_auth_ldap.config import LDAPGroupType
+from django_auth_ldap.backend import _LDAPUser, _LDAPUserGroups, ldap_error
+from django_auth_ldap.config import ALLOWED_LDAP_MEMBERSHIP_EXCEPTIONS, LDAPGroupType
+from ldap.controls import SimplePagedResultsControl
 from rest_framework.serializers import ValidationError
 
 from ansible_base.authentication.authenticator_plugins.base import AbstractAuthenticatorPlugin, Authenticator, BaseAuthenticatorConfiguration
+from ansible_base.authentication.utils.authenticator_maps import AuthenticatorMapProgram, compiled_map_cache
+from ansible_base.authentication.utils.circuit_breaker import report_unavailable
 from ansible_base.authentication.utils.claims import get_or_create_authenticator_user, update_user_claims
-from ansible_base.lib.serializers.fields import BooleanField, CharField, ChoiceField, DictField, ListField, URLListField, UserAttrMap
+from ansible_base.authentication.utils.connection_pool import ConnectionPool, ConnectionPoolTimeout, connection_pools
+from ansible_base.authentication.utils.provisioning import ProvisionedUser
+from ansible_base.authentication.utils.server_selection import ServerSelector
+from ansible_base.authentication.utils.ttl_cache import TTLCache
+from ansible_base.lib.serializers.fields import BooleanField, CharField, ChoiceField, DictField, IntegerField, ListField, URLListField, UserAttrMap
+from ansible_base.lib.utils.settings import get_setting
 from ansible_base.lib.utils.validation import VALID_STRING
 
 logger = logging.getLogger('ansible_base.authentication.authenticator_plugins.ldap')
@@ -22,6 +33,15 @@ logger = logging.getLogger('ansible_base.authentication.authenticator_plugins.ld
 
 user_search_string = '%(user)s'
 
+# Errors which mean we could not talk to the LDAP server at all (as opposed to a user failing to login)
+LDAP_UNAVAILABLE_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR)
+
+# Pooled connections which have been idle for longer than this (in seconds) are checked with a whoami before being reused
+LDAP_POOL_HEALTH_CHECK_AFTER = 30
+
+# Maps the friendly name of a connection option (as stored in CONNECTION_OPTIONS) to its python-ldap value
+LDAP_OPTION_VALUES = {name: value for value, name in ldap.OPT_NAMES_DICT.items()}
+
 
 def validate_ldap_dn(value: str, with_user: bool = False, required: bool = True) -> None:
     if not value and not required:
@@ -56,10 +76,9 @@ class LDAPConnectionOptions(DictField):
         super().__init__(**kwargs)
 
         def validator(value):
-            valid_options = dict([(v, k) for k, v in ldap.OPT_NAMES_DICT.items()])
             errors = {}
             for key in value.keys():
-                if key not in valid_options:
+                if key not in LDAP_OPTION_VALUES:
                     errors[key] = 'Not a valid connection option'
             if errors:
                 raise ValidationError(errors)
@@ -126,6 +145,69 @@ def validate_ldap_filter(value: Any, with_user: bool = False) -> bool:
     raise ValidationError(_('Invalid filter: %s') % value)
 
 
+# Active Directory's LDAP_MATCHING_RULE_IN_CHAIN, matches an attribute through any number of nested groups
+LDAP_MATCHING_RULE_IN_CHAIN = '1.2.840.113556.1.4.1941'
+
+
+class ActiveDirectoryInChainGroupType(LDAPGroupType):
+    """
+    An Active Directory group type which supports nested groups like NestedActiveDirectoryGroupType but has the server
+    resolve the nesting with LDAP_MATCHING_RULE_IN_CHAIN. This finds all of the groups of a user with a single search
+    instead of one search per level of nesting.
+    """
+
+    def __init__(self, name_attr="cn"):
+        super().__init__(name_attr)
+
+    def in_chain_term(self, dn: str) -> str:
+        return f"(member:{LDAP_MATCHING_RULE_IN_CHAIN}:={self.ldap.filter.escape_filter_chars(dn)})"
+
+    def user_groups(self, ldap_user, group_search):
+        search = group_search.search_with_additional_term_string(self.in_chain_term(ldap_user.dn))
+        return search.execute(ldap_user.connection)
+
+    def is_member(self, ldap_user, group_dn):
+        try:
+            results = ldap_user.connection.search_s(group_dn, ldap.SCOPE_BASE, self.in_chain_term(ldap_user.dn), ['1.1'])
+        except ALLOWED_LDAP_MEMBERSHIP_EXCEPTIONS:
+            results = []
+        return len(results) > 0
+
+
+def get_group_type_class(name: str):
+    """
+    Returns the group type class called name from django-auth-ldap or the group types defined here
+    """
+    group_type_class = getattr(config, name, None)
+    if group_type_class is None and name == ActiveDirectoryInChainGroupType.__name__:
+        group_type_class = ActiveDirectoryInChainGroupType
+    return group_type_class
+
+
+# The user attributes which a group type reads to find the groups of a user. These go by class name since not every version
+# of django-auth-ldap has all of them (i.e. NISGroupType)
+GROUP_TYPE_USER_ATTRIBUTES = {
+    'PosixGroupType': {'uid', 'gidNumber'},
+    'NISGroupType': {'uid'},
+}
+# The group types which only go by the DN of the user
+DN_GROUP_TYPES = ('MemberDNGroupType', 'NestedMemberDNGroupType', 'ActiveDirectoryInChainGroupType')
+
+
+def get_group_type_user_attributes(group_type_class) -> Optional[set]:
+    """
+    Returns the user attributes the group type needs to find the groups of a user, or None if we don't know what it reads
+    """
+    if group_type_class is None:
+        return set()
+    for cls in group_type_class.__mro__:
+        if cls.__name__ in GROUP_TYPE_USER_ATTRIBUTES:
+            return set(GROUP_TYPE_USER_ATTRIBUTES[cls.__name__])
+        if cls.__name__ in DN_GROUP_TYPES:
+            return set()
+    return None
+
+
 def get_all_sub_classes(cls):
     # This function can get the names of all subclasses... maybe we want to move this into utils
     # We use it to find all of the parent classes for LDAPGroup
@@ -188,6 +270,7 @@ class LDAPConfiguration(BaseAuthenticatorConfiguration):
             'The group type may need to be changed based on the type of the '
             'LDAP server.  Values are listed at: '
             'https://django-auth-ldap.readthedocs.io/en/stable/groups.html#types-of-groups'
+            ' Additionally, ActiveDirectoryInChainGroupType resolves nested Active Directory groups with a single search.'
         ),
         allow_null=False,
         required=True,
@@ -257,11 +340,43 @@ class LDAPConfiguration(BaseAuthenticatorConfiguration):
         ui_field_label=_('LDAP User Search'),
     )
 
+    EXTRA_USER_ATTRIBUTES = ListField(
+        help_text=_(
+            'Only the user attributes used by the User Attribute Map and the attribute triggers of the authenticator maps are requested'
+            ' from LDAP and stored with the user. List any other attributes you want here, or "*" to request all of the attributes of the user.'
+            ' A map added for a new attribute only sees it once the user logs in again, reevaluate_claims uses the stored attributes.'
+        ),
+        default=[],
+        allow_null=False,
+        required=False,
+        child=CharField(),
+        ui_field_label=_('LDAP Extra User Attributes'),
+    )
+    LOOKUP_CACHE_TIMEOUT = IntegerField(
+        help_text=_(
+            'How long (in seconds) to remember the DN, attributes and groups of a user after they logged in so that their next login'
+            ' does not have to search the directory again. The password of the user is still checked on every login. 0 disables the cache.'
+        ),
+        allow_null=False,
+        required=False,
+        default=0,
+        min_value=0,
+        ui_field_label=_('LDAP Lookup Cache Timeout'),
+    )
+    LOOKUP_CACHE_SIZE = IntegerField(
+        help_text=_('The maximum number of users whose lookups are cached, the least recently used users are dropped first.'),
+        allow_null=False,
+        required=False,
+        default=10000,
+        min_value=1,
+        ui_field_label=_('LDAP Lookup Cache Size'),
+    )
+
     def validate(self, attrs):
         # Check interdependent fields
         errors = {}
 
-        group_type_class = getattr(config, attrs['GROUP_TYPE'], None)
+        group_type_class = get_group_type_class(attrs['GROUP_TYPE'])
         if group_type_class:
             group_type_params = attrs['GROUP_TYPE_PARAMS']
             logger.error(f"Validating group type params for {attrs['GROUP_TYPE']}")
@@ -291,19 +406,25 @@ class LDAPConfiguration(BaseAuthenticatorConfiguration):
 
 
 class LDAPSettings(BaseLDAPSettings):
-    def __init__(self, prefix: str = 'AUTH_LDAP_', defaults: dict = {}):
+    """
+    The fully compiled settings of an LDAP authenticator. Everything a login needs (search objects, group type, connection options)
+    is built here once per configuration and the settings are frozen afterwards so logins running in parallel can share them.
+    """
+
+    def __init__(self, prefix: str = 'AUTH_LDAP_', defaults: dict = {}, user_attributes: Optional[list] = None):
         # This init method double checks the passed defaults while initializing a settings objects
         super(LDAPSettings, self).__init__(prefix, defaults)
 
         # SERVER_URI needs to be a string, not an array
         setattr(self, 'SERVER_URI', ','.join(defaults['SERVER_URI']))
+        # But we pick the server ourselves so keep the list too
+        setattr(self, 'SERVER_URIS', tuple(defaults['SERVER_URI']))
 
         # Connection options need to be set as {"integer": "value"} but our configuration has {"friendly_name": "value"} so we need to convert them
         connection_options = defaults.get('CONNECTION_OPTIONS', {})
-        valid_options = dict([(v, k) for k, v in ldap.OPT_NAMES_DICT.items()])
         internal_data = {}
         for key in connection_options:
-            internal_data[valid_options[key]] = connection_options[key]
+            internal_data[LDAP_OPTION_VALUES[key]] = connection_options[key]
 
         # If a DB-backed setting is specified that wipes out the
         # OPT_NETWORK_TIMEOUT, fall back to a sane default
@@ -324,86 +445,439 @@ class LDAPSettings(BaseLDAPSettings):
         if newctx_option is not None:
             internal_data[ldap.OPT_X_TLS_NEWCTX] = newctx_option
 
+        if self.START_TLS and ldap.OPT_X_TLS_REQUIRE_CERT in internal_data:
+            # with python-ldap, if you want to set connection-specific TLS
+            # parameters, you must also specify OPT_X_TLS_NEWCTX = 0
+            # see: https://stackoverflow.com/a/29722445
+            # see: https://stackoverflow.com/a/38136255
+            internal_data[ldap.OPT_X_TLS_NEWCTX] = 0
+
         setattr(self, 'CONNECTION_OPTIONS', internal_data)
 
         # Group type needs to be an object instead of a String so instantiate it
-        group_type_class = getattr(config, defaults['GROUP_TYPE'], None)
+        group_type_class = get_group_type_class(defaults['GROUP_TYPE'])
         setattr(self, 'GROUP_TYPE', group_type_class(**defaults['GROUP_TYPE_PARAMS']))
 
+        # USER_ATTRLIST is used when the user is found with USER_DN_TEMPLATE instead of a search
+        setattr(self, 'USER_ATTRLIST', user_attributes)
+
+        # If a search can't be built logins are refused (and this says why) instead of failing to load the authenticator
+        self.error = None
+        # Search fields should be LDAPSearch objects, so we need to convert them from [] to these objects
+        for field in ['GROUP_SEARCH', 'USER_SEARCH']:
+            data = defaults.get(field, None)
+            if data is None:
+                setattr(self, field, None)
+                continue
+            try:
+                attrlist = user_attributes if field == 'USER_SEARCH' else None
+                setattr(self, field, config.LDAPSearch(data[0], getattr(ldap, data[1]), data[2], attrlist=attrlist))
+            except Exception as e:
+                logger.error(f'Failed to instantiate LDAPSearch object: {e}')
+                setattr(self, field, None)
+                self.error = e
+
+        # django-auth-ldap normalizes these on every login, do it here so it never has to write to the settings
+        if self.MIRROR_GROUPS_EXCEPT is not None:
+            self.MIRROR_GROUPS_EXCEPT = frozenset(self.MIRROR_GROUPS_EXCEPT)
+            self.MIRROR_GROUPS = None
+        elif isinstance(self.MIRROR_GROUPS, (list, tuple)):
+            self.MIRROR_GROUPS = frozenset(self.MIRROR_GROUPS)
+
+        self.frozen = True
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if self.__dict__.get('frozen', False):
+            raise AttributeError(f"LDAP settings can not be changed once they are built, {name} was not set")
+        super().__setattr__(name, value)
+
+
+def unbind_quietly(connection) -> None:
+    try:
+        connection.unbind_s()
+    except ldap.LDAPError:
+        pass
+
+
+class PooledLDAPConnection:
+    """
+    Wraps a pooled LDAPObject so that a connection which lost its server is not put back into the pool.
+    Searches in django-auth-ldap swallow LDAP errors so we have to watch the calls ourselves.
+    """
+
+    def __init__(self, connection):
+        self.ldap_connection = connection
+        self.broken = False
+
+    def __getattr__(self, name):
+        attribute = getattr(self.ldap_connection, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            try:
+                return attribute(*args, **kwargs)
+            except LDAP_UNAVAILABLE_ERRORS:
+                self.broken = True
+                raise
+
+        return call
+
+
+class ServerSelectingLDAPUser(_LDAPUser):
+    """
+    An _LDAPUser which connects through the plugin so that the servers are tried fastest first
+    and a server which can't be reached is skipped instead of failing the login.
+    """
+
+    def _bind_as(self, bind_dn, bind_password, sticky=False):
+        logger.debug(f"Binding as {bind_dn}")
+        if self._connection is None:
+            self._connection = self.backend.connect(bind_dn, bind_password, self._request)
+        else:
+            self._connection.simple_bind_s(bind_dn, bind_password)
+        self._connection_bound = sticky
+
+    def verify(self, password) -> bool:
+        """
+        Runs the checks of authenticate (the password of the user, REQUIRE_GROUP and DENY_GROUP) without creating or updating the user
+        """
+        try:
+            self._authenticate_user_dn(password)
+            self._check_requirements()
+        except self.AuthenticationFailed as e:
+            logger.debug(f"Authentication failed for {self._username}: {e}")
+            return False
+        return True
+
+
+class PooledLDAPUser(ServerSelectingLDAPUser):
+    """
+    An _LDAPUser which runs its searches on a pooled connection which is already bound as BIND_DN and checks the
+    users password on a short lived connection of its own so the pooled connection never changes identity.
+    """
+
+    def __init__(self, backend, pool: ConnectionPool, **kwargs):
+        super().__init__(backend, **kwargs)
+        self._pool = pool
+
+    def _bind(self):
+        if self._connection is None:
+            self._connection = self._pool.acquire()
+            self._connection_bound = True
+        else:
+            super()._bind()
+
+    def _authenticate_user_dn(self, password):
+        if self.dn is None:
+            raise self.AuthenticationFailed("failed to map the username to a DN.")
+
+        try:
+            connection = self.backend.connect(self.dn, password, self._request)
+        except ldap.INVALID_CREDENTIALS:
+            raise self.AuthenticationFailed("user DN/password rejected by LDAP server.")
+        unbind_quietly(connection)
+
+    def release_connection(self) -> None:
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if self._connection_bound and not connection.broken:
+            self._pool.release(connection)
+        else:
+            self._pool.discard(connection)
+        self._connection_bound = False
+
 
 class AuthenticatorPlugin(LDAPBackend, AbstractAuthenticatorPlugin):
     configuration_class = LDAPConfiguration
     type = 'LDAP'
     category = "password"
+    circuit_breaker_enabled = True
+    case_insensitive_groups = True
+    lookup_cache = None
+    # The compiled authenticator maps the settings were built for
+    settings_program = None
 
     def __init__(self, database_instance=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.database_instance = database_instance
         if database_instance:
-            self.settings = LDAPSettings(defaults=database_instance.configuration)
+            self.update_settings(database_instance)
         self.configuration_encrypted_fields = ['BIND_PASSWORD']
         self.set_logger(logger)
 
     def authenticate(self, request, username=None, password=None, **kwargs) -> (object, dict, list):
+        if not self.can_authenticate(username, password):
+            return None
+
+        try:
+            user_from_ldap = super().authenticate(request, username, password)
+            return self.finish_login(user_from_ldap, username)
+        except Exception as e:
+            self.handle_login_error(e)
+            return None
+
+    def verify_credentials(self, request, username=None, password=None, **kwargs):
+        if not self.can_authenticate(username, password):
+            return None
+
+        try:
+            ldap_user = self.authenticate_ldap_user(_LDAPUser(self, username=username.strip(), request=request), password, verify_only=True)
+        except Exception as e:
+            self.handle_login_error(e)
+            return None
+        if ldap_user is None:
+            self.process_login_messages(None, username)
+        return ldap_user
+
+    def complete_login(self, request, verified, username=None, password=None, **kwargs):
+        try:
+            # This is the rest of _LDAPUser.authenticate, verify_credentials did the checks
+            verified._get_or_create_user()
+        except Exception as e:
+            self.discard_login(verified)
+            self.handle_login_error(e)
+            return None
+
+        try:
+            return self.finish_login(verified._user, username)
+        except Exception as e:
+            self.handle_login_error(e)
+            return None
+
+    def discard_login(self, verified) -> None:
+        self.release_ldap_connection(verified)
+
+    def can_authenticate(self, username: Optional[str], password: Optional[str]) -> bool:
         if not username or not password:
-            return
-        users_groups = []
+            return False
 
         if not self.database_instance:
             logger.error("AuthenticatorPlugin was missing an authenticator")
-            return None
+            return False
 
         if not self.database_instance.enabled:
             logger.info(f"LDAP authenticator {self.database_instance.name} is disabled, skipping")
+            return False
+
+        # The settings are only rebuilt when the authenticator or its maps change, logins only ever read them
+        if compiled_map_cache.get(self.database_instance.id) is not self.settings_program:
+            self.update_settings(self.database_instance)
+        if self.settings.error:
+            logger.error(f'LDAP authenticator {self.database_instance.name} can not be used: {self.settings.error}')
+            return False
+        return True
+
+    def finish_login(self, user_from_ldap, username: str):
+        users_groups = []
+        if user_from_ldap is not None and user_from_ldap.ldap_user:
+            try:
+                users_groups = list(user_from_ldap.ldap_user._get_groups().get_group_dns())
+                self.cache_user_groups(user_from_ldap.ldap_user)
+            finally:
+                self.release_ldap_connection(user_from_ldap.ldap_user)
+
+        self.process_login_messages(user_from_ldap, username)
+
+        authenticator_user = getattr(getattr(user_from_ldap, 'ldap_user', None), 'authenticator_user', None)
+        return update_user_claims(user_from_ldap, self.database_instance, users_groups, authenticator_user=authenticator_user)
+
+    def handle_login_error(self, error: Exception) -> None:
+        if isinstance(error, LDAP_UNAVAILABLE_ERRORS):
+            report_unavailable(error)
+        logger.exception(f"Encountered an error authenticating to LDAP {self.database_instance.name}")
+
+    def get_user_attributes(self, program: Optional[AuthenticatorMapProgram] = None) -> Optional[list]:
+        """
+        Returns the user attributes to request from LDAP (None meaning all of them). These are the attributes used by
+        USER_ATTR_MAP, by the attribute triggers of the authenticator maps and by the group type plus EXTRA_USER_ATTRIBUTES.
+
+        Only these attributes are stored in the extra_data of the user, so an attribute trigger added later only sees the
+        attribute once the user logs in again (or is provisioned again), reevaluate_claims can't see it before that.
+        """
+        configuration = self.database_instance.configuration
+        extra_attributes = configuration.get('EXTRA_USER_ATTRIBUTES', None) or []
+        if '*' in extra_attributes:
             return None
 
-        # We don't have to check if settings is None because it can never happen, the parent object will always return something
+        if program is None:
+            program = compiled_map_cache.get(self.database_instance.id)
+        group_type_attributes = get_group_type_user_attributes(get_group_type_class(configuration.get('GROUP_TYPE', '')))
+        if group_type_attributes is None:
+            # A group type we don't know may read any attribute of the user
+            return None
+        attributes = set((configuration.get('USER_ATTR_MAP', None) or {}).values()) | set(extra_attributes) | program.attributes | group_type_attributes
+        # 1.1 is the LDAP way of asking for no attributes, an empty list would mean all of them
+        return sorted(attributes) or ['1.1']
 
-        if self.settings.START_TLS and ldap.OPT_X_TLS_REQUIRE_CERT in self.settings.CONNECTION_OPTIONS:
-            # with python-ldap, if you want to set connection-specific TLS
-            # parameters, you must also specify OPT_X_TLS_NEWCTX = 0
-            # see: https://stackoverflow.com/a/29722445
-            # see: https://stackoverflow.com/a/38136255
-            self.settings.CONNECTION_OPTIONS[ldap.OPT_X_TLS_NEWCTX] = 0
+    def release_ldap_connection(self, ldap_user) -> None:
+        if isinstance(ldap_user, PooledLDAPUser):
+            ldap_user.release_connection()
+            return
 
-        # Ensure USER_SEARCH and GROUP_SEARCH are converted into a search object
-        for field, search_must_have_user in [('GROUP_SEARCH', False), ('USER_SEARCH', True)]:
-            data = getattr(self.settings, field, None)
-            if data is None:
-                setattr(self.settings, field, None)
-            else:
-                try:
-                    # Search fields should be LDAPSearch objects, so we need to convert them from [] to these objects
-                    search_object = config.LDAPSearch(data[0], getattr(ldap, data[1]), data[2])
-                    setattr(self.settings, field, search_object)
-                except Exception as e:
-                    logger.error(f'Failed to instantiate LDAPSearch object: {e}')
-                    return None
+        # If we have an LDAP user and that user we found has an user_from_ldap internal object and that object has a bound connection
+        # Then we can try and force an unbind to close the sticky connection
+        if ldap_user._connection_bound:
+            logger.debug(f"Forcing LDAP connection to close for {self.database_instance.name}")
+            try:
+                ldap_user._connection.unbind_s()
+                ldap_user._connection_bound = False
+            except Exception:
+                logger.exception(f"Got unexpected LDAP exception when forcing LDAP disconnect for user {ldap_user._username}, login will still proceed")
 
-        try:
-            user_from_ldap = super().authenticate(request, username, password)
+    def new_connection(self, request=None, uri: Optional[str] = None):
+        """
+        Opens an unbound connection to the LDAP server (or the given server) the same way django-auth-ldap does
+        """
+        if uri is None:
+            uri = self.settings.SERVER_URI
+        if callable(uri):
+            uri = uri(request)
+        connection = self.ldap.initialize(uri, bytes_mode=False)
+        for opt, value in self.settings.CONNECTION_OPTIONS.items():
+            connection.set_option(opt, value)
+        if self.settings.START_TLS:
+            connection.start_tls_s()
+        return connection
+
+    def connect(self, bind_dn: str, password: str, request=None):
+        """
+        Opens a connection bound as bind_dn. The servers are tried in the order of the server selector (fastest healthy server first)
+        and a server which can't be reached is demoted and the next one is tried.
+        """
+        selector = self.get_server_selector()
+        error = None
+        for uri in selector.ordered():
+            started = time.monotonic()
+            connection = None
+            try:
+                connection = self.new_connection(request, uri=uri)
+                connection.simple_bind_s(bind_dn, password)
+            except LDAP_UNAVAILABLE_ERRORS as e:
+                selector.record_failure(uri, e)
+                if connection is not None:
+                    unbind_quietly(connection)
+                error = e
+                continue
+            except ldap.LDAPError:
+                # The server answered (i.e. the password was wrong) so it still counts as healthy
+                selector.record_success(uri, time.monotonic() - started)
+                if connection is not None:
+                    unbind_quietly(connection)
+                raise
+            except Exception:
+                if connection is not None:
+                    unbind_quietly(connection)
+                raise
+            selector.record_success(uri, time.monotonic() - started)
+            return connection
+        raise error
+
+    def get_server_selector(self) -> ServerSelector:
+        return ServerSelector(self.database_instance.id, self.settings.SERVER_URIS)
+
+    def get_servers(self, authenticator) -> list:
+        return authenticator.configuration.get('SERVER_URI', None) or []
+
+    def new_pooled_connection(self) -> PooledLDAPConnection:
+        return PooledLDAPConnection(self.connect(self.settings.BIND_DN, self.settings.BIND_PASSWORD))
+
+    def get_connection_pool(self):
+        """
+        Returns the pool of connections bound as BIND_DN for this authenticator or None if pooling is disabled
+        """
+        size = get_setting('ANSIBLE_BASE_LDAP_CONNECTION_POOL_SIZE', 10)
+        if not size or self.settings.BIND_AS_AUTHENTICATING_USER:
+            # With BIND_AS_AUTHENTICATING_USER the searches run as the user so there is nothing we can share
+            return None
 
-            if user_from_ldap is not None and user_from_ldap.ldap_user:
-                users_groups = list(user_from_ldap.ldap_user._get_groups().get_group_dns())
+        def create_pool():
+            logger.debug(f"Creating LDAP connection pool for {self.database_instance.name}")
+            return ConnectionPool(
+                connect=self.new_pooled_connection,
+                close=lambda connection: connection.unbind_s(),
+                max_size=size,
+                max_idle=get_setting('ANSIBLE_BASE_LDAP_CONNECTION_POOL_IDLE_TIMEOUT', 300),
+                check=lambda connection: connection.whoami_s() is not None,
+                check_after=LDAP_POOL_HEALTH_CHECK_AFTER,
+                acquire_timeout=get_setting('ANSIBLE_BASE_LDAP_CONNECTION_POOL_TIMEOUT', 10),
+            )
+
+        # Keyed by the modification time of the authenticator so a changed configuration gets a new pool
+        return connection_pools.get(self.database_instance.id, self.database_instance.modified_on, create_pool)
+
+    def authenticate_ldap_user(self, ldap_user, password, verify_only: bool = False):
+        """
+        With verify_only only the credentials are checked (see ServerSelectingLDAPUser.verify) and the verified _LDAPUser is returned
+        instead of a user, its connection is kept until the login is completed or discarded.
+        """
+        pool = self.get_connection_pool()
+        if pool is None:
+            ldap_user = ServerSelectingLDAPUser(self, username=ldap_user._username, request=ldap_user._request)
+            return self._authenticate_ldap_user_with_cache(ldap_user, password, verify_only)
 
-                # If we have an LDAP user and that user we found has an user_from_ldap internal object and that object has a bound connection
-                # Then we can try and force an unbind to close the sticky connection
-                if user_from_ldap.ldap_user._connection_bound:
-                    logger.debug(f"Forcing LDAP connection to close for {self.database_instance.name}")
-                    try:
-                        user_from_ldap.ldap_user._connection.unbind_s()
-                        user_from_ldap.ldap_user._connection_bound = False
-                    except Exception:
-                        logger.exception(
-                            f"Got unexpected LDAP exception when forcing LDAP disconnect for user {user_from_ldap.username}, login will still proceed"
-                        )
-
-            self.process_login_messages(user_from_ldap, username)
-
-            return update_user_claims(user_from_ldap, self.database_instance, users_groups)
+        pooled_user = PooledLDAPUser(self, pool, username=ldap_user._username, request=ldap_user._request)
+        try:
+            user = self._authenticate_ldap_user_with_cache(pooled_user, password, verify_only)
+        except ConnectionPoolTimeout as e:
+            # The server is fine, we are just too busy, so this does not count against the circuit breaker
+            logger.warning(f"Unable to authenticate {ldap_user._username} with authenticator {self.database_instance.name}: {e}")
+            pooled_user.release_connection()
+            return None
         except Exception:
-            logger.exception(f"Encountered an error authenticating to LDAP {self.database_instance.name}")
+            pooled_user.release_connection()
+            raise
+        if user is None:
+            pooled_user.release_connection()
+        return user
+
+    def _authenticate_ldap_user_with_cache(self, ldap_user, password, verify_only: bool = False):
+        lookup_cache = self.get_lookup_cache()
+        if lookup_cache is None:
+            return self._authenticate_or_verify(ldap_user, password, verify_only)
+
+        # The attributes requested change with the authenticator maps so they are part of the key
+        user_key = ('user', ldap_user._username, tuple(self.settings.USER_ATTRLIST or ()))
+        cached_user = lookup_cache.get(user_key, None)
+        if cached_user:
+            # With the DN known the user search is skipped, the password is still checked with a bind
+            ldap_user._user_dn, ldap_user._user_attrs = cached_user
+            cached_groups = lookup_cache.get(('groups', ldap_user._user_dn.lower()), None)
+            if cached_groups is not None:
+                ldap_user._groups = _LDAPUserGroups(ldap_user)
+                ldap_user._groups._group_infos = cached_groups
+
+        user = self._authenticate_or_verify(ldap_user, password, verify_only)
+        # Only users who proved who they are get cached
+        if user is not None and ldap_user._user_dn is not None:
+            lookup_cache.set(user_key, (ldap_user._user_dn, ldap_user._user_attrs))
+        return user
+
+    def _authenticate_or_verify(self, ldap_user, password, verify_only: bool):
+        if verify_only:
+            return ldap_user if ldap_user.verify(password) else None
+        return super().authenticate_ldap_user(ldap_user, password)
+
+    def cache_user_groups(self, ldap_user) -> None:
+        lookup_cache = self.get_lookup_cache()
+        groups = getattr(ldap_user, '_groups', None)
+        if lookup_cache is None or groups is None or groups._group_infos is None or ldap_user._user_dn is None:
+            return
+        lookup_cache.set(('groups', ldap_user._user_dn.lower()), groups._group_infos)
+
+    def get_lookup_cache(self):
+        """
+        Returns the cache of user DNs, attributes and groups for this authenticator or None if LOOKUP_CACHE_TIMEOUT is not set.
+        The cache is dropped by update_settings so it never outlives the configuration it was filled with.
+        """
+        timeout = getattr(self.settings, 'LOOKUP_CACHE_TIMEOUT', 0)
+        if not timeout:
             return None
+        if self.lookup_cache is None:
+            self.lookup_cache = TTLCache(timeout, getattr(self.settings, 'LOOKUP_CACHE_SIZE', 10000))
+        return self.lookup_cache
 
     def process_login_messages(self, ldap_user, username: str) -> None:
         if ldap_user is None:
@@ -420,7 +894,13 @@ class AuthenticatorPlugin(LDAPBackend, AbstractAuthenticatorPlugin):
             logger.info(f"User {username} authenticated by LDAP {self.database_instance.name}")
 
     def update_settings(self, database_authenticator: Authenticator) -> None:
-        self.settings = LDAPSettings(defaults=database_authenticator.configuration)
+        # The maps decide which user attributes we ask for so the settings are built for the maps as they are now
+        program = compiled_map_cache.get(database_authenticator.id)
+        # settings is assigned last so a login running in another thread sees either the old or the new settings, never a mix
+        self.settings_program = program
+        self.settings = LDAPSettings(defaults=database_authenticator.configuration, user_attributes=self.get_user_attributes(program))
+        # Anything we cached may have come from a different server or search
+        self.lookup_cache = None
 
     def get_or_build_user(self, username, ldap_user):
         """
@@ -433,6 +913,90 @@ class AuthenticatorPlugin(LDAPBackend, AbstractAuthenticatorPlugin):
             },
             authenticator=self.database_instance,
             extra_data=ldap_user.attrs.data,
+            # update_user_claims writes the authenticator user once we have the groups
+            update_existing=False,
         )
+        # Hang on to the authenticator user so update_user_claims does not have to look it up again
+        ldap_user.authenticator_user = authenticator_user
 
         return authenticator_user.user, created
+
+    def get_username_attribute(self) -> Optional[str]:
+        """
+        Returns the attribute USER_SEARCH matches the username against (i.e. uid for "(uid=%(user)s)")
+        """
+        search = self.settings.USER_SEARCH
+        match = re.search(r'\(([\w;.-]+)=%\(user\)s\)', search.filterstr) if search else None
+        return match.group(1) if match else None
+
+    def iter_directory_users(self, page_size: int = 500) -> Iterator[list]:
+        """
+        Walks every user matched by USER_SEARCH with the paged results control (RFC 2696) and yields them one page at a time
+        as ProvisionedUsers (with their groups) so that the users can be created before they ever login.
+        Users which would fail REQUIRE_GROUP or DENY_GROUP on login are left out.
+        """
+        search = self.settings.USER_SEARCH
+        username_attribute = self.get_username_attribute()
+        if username_attribute is None:
+            raise ValueError('USER_SEARCH must be set and its filter must match an attribute against %(user)s to walk the users of the directory')
+
+        filterstr = search.filterstr % {'user': '*'}
+        attrlist = search.attrlist
+        if attrlist is not None:
+            attrlist = sorted((set(attrlist) - {'1.1'}) | {username_attribute})
+
+        connection = self.connect(self.settings.BIND_DN, self.settings.BIND_PASSWORD)
+        try:
+            cookie = ''
+            while True:
+                control = SimplePagedResultsControl(True, size=page_size, cookie=cookie)
+                msgid = connection.search_ext(search.base_dn, search.scope, filterstr, attrlist, serverctrls=[control])
+                _, results, _, response_controls = connection.result3(msgid)
+
+                page = []
+                for user_dn, attrs in search._process_results(results):
+                    if provisioned_user := self._get_provisioned_user(connection, username_attribute, user_dn, attrs):
+                        page.append(provisioned_user)
+                yield page
+
+                # The server hands back a cookie for the next page, no cookie means that was the last page
+                cookie = next((c.cookie for c in response_controls if c.controlType == SimplePagedResultsControl.controlType), None)
+                if not cookie:
+                    break
+        finally:
+            unbind_quietly(connection)
+
+    def _get_provisioned_user(self, connection, username_attribute: str, user_dn: str, attrs) -> Optional[ProvisionedUser]:
+        usernames = attrs.get(username_attribute, None)
+        if not usernames:
+            logger.debug(f"Skipping {user_dn}, it has no {username_attribute}")
+            return None
+        username = usernames[0]
+
+        # An _LDAPUser which already knows its DN and attributes so only its groups are looked up (on our connection)
+        ldap_user = _LDAPUser(self, username=username)
+        ldap_user._user_dn = user_dn
+        ldap_user._user_attrs = attrs
+        ldap_user._connection = connection
+        ldap_user._connection_bound = True
+        try:
+            ldap_user._check_required_group()
+            ldap_user._check_denied_group()
+        except _LDAPUser.AuthenticationFailed as e:
+            logger.debug(f"Skipping {user_dn}, {e}")
+            return None
+
+        details = {"username": username}
+        for field, attribute in self.settings.USER_ATTR_MAP.items():
+            if values := attrs.get(attribute, None):
+                details[field] = values[0]
+        return ProvisionedUser(uid=username, details=details, extra_data=attrs.data, groups=list(ldap_user._get_groups().get_group_dns()))
+
+
+def ldap_error_handler(sender, context, exception, **kwargs):
+    # django-auth-ldap swallows LDAP errors during authenticate and only tells us about them through this signal
+    if isinstance(exception, LDAP_UNAVAILABLE_ERRORS):
+        report_unavailable(exception)
+
+
+ldap_error.connect(ldap_error_handler, sender=AuthenticatorPlugin, dispatch_uid='dab_ldap_error')
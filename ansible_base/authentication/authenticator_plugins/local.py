@@ -30,28 +30,33 @@ class AuthenticatorPlugin(ModelBackend, AbstractAuthenticatorPlugin):
         super().__init__(database_instance, *args, **kwargs)
 
     def authenticate(self, request, username=None, password=None, **kwargs):
+        user = self.verify_credentials(request, username, password, **kwargs)
+        if user:
+            user = self.complete_login(request, user, username, password, **kwargs)
+        # TODO, we will need to return attributes and claims eventually
+        return user
+
+    def verify_credentials(self, request, username=None, password=None, **kwargs):
         if not username or not password:
             return None
-        user = super().authenticate(request, username, password, **kwargs)
+        return super().authenticate(request, username, password, **kwargs)
 
+    def complete_login(self, request, verified, username=None, password=None, **kwargs):
         # This auth class doesn't create any new local users, so we just need to make sure
         # it has an AuthenticatorUser associated with it.
-        if user:
-            user_attrs = {
+        user_attrs = {
+            "username": username,
+            "first_name": verified.first_name,
+            "last_name": verified.last_name,
+            "email": verified.email,
+            "is_superuser": verified.is_superuser,
+        }
+        get_or_create_authenticator_user(
+            user_id=username,
+            user_details={
                 "username": username,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "email": user.email,
-                "is_superuser": user.is_superuser,
-            }
-            get_or_create_authenticator_user(
-                user_id=username,
-                user_details={
-                    "username": username,
-                },
-                authenticator=self.database_instance,
-                extra_data=user_attrs,
-            )
-
-        # TODO, we will need to return attributes and claims eventually
-        return user
+            },
+            authenticator=self.database_instance,
+            extra_data=user_attrs,
+        )
+        return verified
@@ -1,14 +1,42 @@
+import json
 import logging
+import time
+from typing import Callable, Optional
 
+import jwt
 from django.utils.translation import gettext_lazy as _
+from jwt.utils import base64url_decode
+from requests import RequestException
 from social_core.backends.open_id_connect import OpenIdConnectAuth
+from social_core.exceptions import AuthFailed
 
 from ansible_base.authentication.authenticator_plugins.base import AbstractAuthenticatorPlugin, BaseAuthenticatorConfiguration
 from ansible_base.authentication.social_auth import SocialAuthMixin
+from ansible_base.authentication.utils.versions import get_authentication_cache
 from ansible_base.lib.serializers.fields import BooleanField, CharField, URLField
+from ansible_base.lib.utils.settings import get_setting
 
 logger = logging.getLogger('ansible_base.authentication.authenticator_plugins.oidc')
 
+# How long a worker may hold the refresh of a document before another one is allowed to try
+REFRESH_LOCK_TIMEOUT = 30
+
+
+def get_max_age(response) -> Optional[int]:
+    '''
+    Returns how long the Cache-Control header of response allows it to be cached for or None if it does not say
+    '''
+    directives = {}
+    for directive in response.headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+    try:
+        return int(directives['max-age'])
+    except (KeyError, ValueError):
+        return None
+
 
 class OpenIdConnectConfiguration(BaseAuthenticatorConfiguration):
     documentation_url = "https://python-social-auth.readthedocs.io/en/latest/backends/oidc.html"
@@ -45,3 +73,90 @@ class AuthenticatorPlugin(SocialAuthMixin, OpenIdConnectAuth, AbstractAuthentica
     logger = logger
     category = "sso"
     configuration_encrypted_fields = ['SECRET']
+
+    # social_core caches these per backend class (so every OIDC authenticator would share them) and per process,
+    # we keep them per authenticator in the authentication cache instead
+    def oidc_config(self, refresh: bool = False) -> dict:
+        return self.get_cached_document('discovery', self._fetch_oidc_config, refresh=refresh)
+
+    def get_jwks_keys(self, refresh: bool = False) -> list:
+        return self.get_cached_document('jwks', self._fetch_jwks_keys, refresh=refresh)
+
+    def _fetch_oidc_config(self) -> (dict, Optional[int]):
+        response = self.request(self.oidc_endpoint() + "/.well-known/openid-configuration")
+        return response.json(), get_max_age(response)
+
+    def _fetch_jwks_keys(self) -> (list, Optional[int]):
+        response = self.request(self.jwks_uri())
+        return json.loads(response.text)["keys"], get_max_age(response)
+
+    def get_cached_document(self, name: str, fetch: Callable, refresh: bool = False):
+        '''
+        Returns a document of the provider (the discovery document or the JWKS) from the authentication cache.
+
+        A document is kept for as long as the Cache-Control header of the provider allows, within ANSIBLE_BASE_OIDC_CACHE_MIN_TIMEOUT
+        and ANSIBLE_BASE_OIDC_CACHE_TIMEOUT, and is dropped when the authenticator is modified. Only one worker refreshes an expired
+        document, the others keep using the expired one in the meantime. If the provider can not be reached we keep using the
+        expired document and try again ANSIBLE_BASE_OIDC_CACHE_MIN_TIMEOUT seconds later.
+
+        refresh forces a refresh, i.e. when a token is signed with a key we don't know, unless the document was fetched less than
+        ANSIBLE_BASE_OIDC_CACHE_MIN_TIMEOUT seconds ago.
+        '''
+        if not self.database_instance or not self.database_instance.id:
+            value, _max_age = fetch()
+            return value
+
+        max_timeout = get_setting('ANSIBLE_BASE_OIDC_CACHE_TIMEOUT', 3600)
+        min_timeout = min(get_setting('ANSIBLE_BASE_OIDC_CACHE_MIN_TIMEOUT', 60), max_timeout)
+        cache = get_authentication_cache()
+        cache_key = f'ansible_base.authentication.oidc.{self.database_instance.id}.{name}'
+        lock_key = f'{cache_key}.refresh'
+        version = self.database_instance.modified_on.isoformat()
+        now = time.time()
+
+        cached = cache.get(cache_key, None)
+        if cached is not None and cached['version'] != version:
+            cached = None
+        if cached is not None:
+            if refresh and now - cached['fetched_at'] < min_timeout:
+                return cached['value']
+            if not refresh and now < cached['expires']:
+                return cached['value']
+            if not cache.add(lock_key, True, timeout=REFRESH_LOCK_TIMEOUT):
+                # Another thread or worker is already refreshing it
+                return cached['value']
+
+        try:
+            value, max_age = fetch()
+        except (AuthFailed, RequestException, ValueError, KeyError) as e:
+            if cached is None:
+                raise
+            logger.warning(f"Unable to refresh the OIDC {name} of authenticator {self.database_instance.name}, using the cached one: {e}")
+            cache.set(cache_key, {**cached, 'expires': now + min_timeout}, timeout=None)
+            return cached['value']
+        finally:
+            if cached is not None:
+                cache.delete(lock_key)
+
+        timeout = max_timeout if max_age is None else max(min(max_age, max_timeout), min_timeout)
+        cache.set(cache_key, {'version': version, 'value': value, 'fetched_at': now, 'expires': now + timeout}, timeout=None)
+        return value
+
+    def find_valid_key(self, id_token):
+        kid = jwt.get_unverified_header(id_token).get("kid")
+
+        keys = self.get_jwks_keys()
+        if kid is not None and kid not in [key.get("kid") for key in keys]:
+            # The provider may have rotated its keys since we fetched them
+            keys = self.get_jwks_keys(refresh=True)
+
+        for key in keys:
+            if kid is None or kid == key.get("kid"):
+                if "alg" not in key:
+                    key["alg"] = self.setting("JWT_ALGORITHMS", self.JWT_ALGORITHMS)[0]
+                rsakey = jwt.PyJWK(key)
+                message, encoded_sig = id_token.rsplit(".", 1)
+                decoded_sig = base64url_decode(encoded_sig.encode("utf-8"))
+                if rsakey.Algorithm.verify(message.encode("utf-8"), rsakey.key, decoded_sig):
+                    return key
+        return None
@@ -1,8 +1,12 @@
+import hashlib
 import logging
 
 from django.http import HttpResponse, HttpResponseNotFound
 from django.urls import re_path
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.utils.translation import gettext_lazy as _
+from onelogin.saml2.auth import OneLogin_Saml2_Auth
 from onelogin.saml2.errors import OneLogin_Saml2_Error
 from onelogin.saml2.settings import OneLogin_Saml2_Settings
 from rest_framework.reverse import reverse
@@ -11,7 +15,7 @@ from rest_framework.views import View
 from social_core.backends.saml import SAMLAuth, SAMLIdentityProvider
 
 from ansible_base.authentication.authenticator_plugins.base import AbstractAuthenticatorPlugin, BaseAuthenticatorConfiguration
-from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
+from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_class, get_authenticator_plugin
 from ansible_base.authentication.models import Authenticator
 from ansible_base.authentication.social_auth import (
     AuthenticatorConfigTestStrategy,
@@ -20,6 +24,8 @@ from ansible_base.authentication.social_auth import (
     SocialAuthMixin,
     SocialAuthValidateCallbackMixin,
 )
+from ansible_base.authentication.utils.ttl_cache import TTLCache
+from ansible_base.authentication.utils.versions import get_authentication_cache, get_saml_metadata_cache_key
 from ansible_base.lib.serializers.fields import CharField, JSONField, ListField, PrivateKey, PublicCert, URLField
 from ansible_base.lib.utils.encryption import ENCRYPTED_STRING
 from ansible_base.lib.utils.validation import validate_cert_with_key
@@ -28,6 +34,9 @@ logger = logging.getLogger('ansible_base.authentication.authenticator_plugins.sa
 
 idp_string = 'IdP'
 
+# Parsed OneLogin settings by (authenticator id, modified_on, IdP, redirect_uri), see AuthenticatorPlugin.get_saml_settings
+saml_settings_cache = TTLCache(timeout=3600, max_size=100)
+
 
 class SAMLConfiguration(BaseAuthenticatorConfiguration):
     settings_to_enabled_idps_fields = {
@@ -248,26 +257,92 @@ class AuthenticatorPlugin(SocialAuthMixin, SocialAuthValidateCallbackMixin, SAML
     def add_related_fields(self, request, authenticator):
         return {"metadata": reverse('authenticator-metadata', kwargs={'pk': authenticator.id})}
 
+    def get_saml_settings(self, idp) -> OneLogin_Saml2_Settings:
+        '''
+        Returns the OneLogin settings for idp. Building them parses and validates the whole configuration (i.e. the SP key and
+        certificate and the IdP certificate) so they are built once per version of the authenticator instead of on every login.
+        The settings are not changed by the logins which use them so one object can be shared by all of them.
+        '''
+        # The redirect uri is made absolute from the host of the request so it is part of the key
+        key = (self.database_instance.id, self.database_instance.modified_on, idp.name, self.redirect_uri)
+        saml_settings = saml_settings_cache.get(key)
+        if saml_settings is None:
+            saml_settings = OneLogin_Saml2_Settings(self.generate_saml_config(idp))
+            saml_settings_cache.set(key, saml_settings)
+        return saml_settings
+
+    def _create_saml_auth(self, idp):
+        request_info = {
+            "https": "on" if self.strategy.request_is_secure() else "off",
+            "http_host": self.strategy.request_host(),
+            "script_name": self.strategy.request_path(),
+            "get_data": self.strategy.request_get(),
+            "post_data": self.strategy.request_post(),
+        }
+        return OneLogin_Saml2_Auth(request_info, self.get_saml_settings(idp))
+
+    def authenticator_saved(self, authenticator):
+        # Have the metadata ready for the IdPs which poll it
+        get_metadata(authenticator)
+
+
+def get_metadata(authenticator: Authenticator) -> dict:
+    '''
+    Returns the SP metadata of a SAML authenticator as {'metadata': xml, 'etag': etag, 'errors': errors}.
+
+    Generating and signing the metadata is expensive and IdPs and load balancers poll it, so it is kept in the authentication
+    cache until the authenticator is saved or deleted (see authenticator_changed).
+    '''
+    cache = get_authentication_cache()
+    cache_key = get_saml_metadata_cache_key(authenticator.id)
+    version = authenticator.modified_on.isoformat()
+    cached = cache.get(cache_key, None)
+    if cached is not None and cached['version'] == version:
+        return cached
+
+    # We already have the authenticator so we don't use strategy.get_backend which would load it again
+    Backend = get_authenticator_class(authenticator.type)
+    saml_backend = Backend(
+        AuthenticatorStrategy(AuthenticatorStorage()), database_instance=authenticator, redirect_uri=authenticator.configuration.get('CALLBACK_URL')
+    )
+    try:
+        metadata, errors = saml_backend.generate_metadata_xml()
+    except OneLogin_Saml2_Error as e:
+        metadata, errors = None, str(e)
+
+    if errors:
+        # generate_metadata_xml returns a list of errors
+        errors = errors if isinstance(errors, str) else ''.join(str(error) for error in errors)
+        cached = {'version': version, 'metadata': None, 'etag': None, 'errors': errors}
+    else:
+        etag = f'"{hashlib.sha256(metadata.encode("utf-8") if isinstance(metadata, str) else metadata).hexdigest()}"'
+        cached = {'version': version, 'metadata': metadata, 'etag': etag, 'errors': None}
+    cache.set(cache_key, cached, timeout=None)
+    return cached
+
 
 class SAMLMetadataView(View):
     def get(self, request, pk=None, format=None):
-        authenticator = Authenticator.objects.get(id=pk)
+        authenticator = Authenticator.objects.filter(id=pk).first()
+        if authenticator is None:
+            return HttpResponseNotFound()
         plugin = get_authenticator_plugin(authenticator.type)
         if plugin.type != 'SAML':
             logger.debug(f"Authenticator {authenticator.id} has a type which does not support metadata {plugin.type}")
             return HttpResponseNotFound()
 
-        strategy = AuthenticatorStrategy(AuthenticatorStorage())
-        complete_url = authenticator.configuration.get('CALLBACK_URL')
-        saml_backend = strategy.get_backend(slug=authenticator.slug, redirect_uri=complete_url)
-        try:
-            metadata, errors = saml_backend.generate_metadata_xml()
-        except OneLogin_Saml2_Error as e:
-            errors = e
-        if not errors:
-            return HttpResponse(content=metadata, content_type='text/xml')
-        else:
-            return HttpResponse(content=errors, content_type='text/plain')
+        metadata = get_metadata(authenticator)
+        if metadata['errors']:
+            return HttpResponse(content=metadata['errors'], content_type='text/plain')
+
+        # Pollers which send If-None-Match or If-Modified-Since get a 304 until the authenticator changes
+        last_modified = int(authenticator.modified_on.timestamp())
+        response = get_conditional_response(request, etag=metadata['etag'], last_modified=last_modified)
+        if response is None:
+            response = HttpResponse(content=metadata['metadata'], content_type='text/xml')
+        response['ETag'] = metadata['etag']
+        response['Last-Modified'] = http_date(last_modified)
+        return response
 
 
 urls = [
@@ -1,6 +1,7 @@
 import logging
+import socket
+import time
 
-from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
@@ -10,7 +11,11 @@ from tacacs_plus.flags import TAC_PLUS_AUTHEN_TYPES, TAC_PLUS_VIRTUAL_REM_ADDR
 from ansible_base.authentication.authenticator_plugins.base import AbstractAuthenticatorPlugin, BaseAuthenticatorConfiguration
 from ansible_base.authentication.models import AuthenticatorUser
 from ansible_base.authentication.social_auth import SocialAuthMixin
-from ansible_base.lib.serializers.fields import BooleanField, CharField, ChoiceField, IntegerField
+from ansible_base.authentication.utils.circuit_breaker import report_unavailable
+from ansible_base.authentication.utils.claims import upsert_authenticator_user
+from ansible_base.authentication.utils.server_selection import ServerSelector
+from ansible_base.lib.serializers.fields import BooleanField, CharField, ChoiceField, IntegerField, ListField
+from ansible_base.lib.utils.models import upsert_user
 
 logger = logging.getLogger('ansible_base.authentication.authenticator_plugins.tacacs')
 
@@ -30,6 +35,83 @@ def validate_tacacsplus_disallow_nonascii(value):
         raise ValidationError(_('TACACS+ secret does not allow non-ascii characters'))
 
 
+def parse_tacacs_host(value: str, default_port: int) -> (str, int):
+    """
+    Splits hostname, hostname:port, [ipv6 address] or [ipv6 address]:port into the host and the port
+    """
+    value = value.strip()
+    if value.startswith('['):
+        host, _, port = value[1:].partition(']')
+        port = port[1:] if port.startswith(':') else port
+    elif value.count(':') == 1:
+        host, port = value.split(':')
+    else:
+        host, port = value, ''
+
+    if not host:
+        raise ValueError(f'{value} is missing a hostname')
+    if not port:
+        return host, default_port
+    if not port.isdigit() or not 1 <= int(port) <= 65535:
+        raise ValueError(f'{value} does not have a valid port')
+    return host, int(port)
+
+
+def validate_tacacs_hosts(value):
+    errors = []
+    for host in value or []:
+        try:
+            parse_tacacs_host(host, 49)
+        except ValueError as e:
+            errors.append(str(e))
+    if errors:
+        raise ValidationError(errors)
+
+
+def get_tacacs_servers(configuration: dict) -> dict:
+    """
+    Returns {server name: (host, port)} for HOST followed by the FAILOVER_HOSTS of a TACACS+ configuration
+    """
+    port = configuration.get('PORT', 49)
+    servers = {}
+    for host in [configuration['HOST'], *(configuration.get('FAILOVER_HOSTS', None) or [])]:
+        host, host_port = parse_tacacs_host(host, port)
+        servers[f'{host}:{host_port}'] = (host, host_port)
+    return servers
+
+
+class TimeoutTACACSClient(TACACSClient):
+    """
+    A TACACSClient with its own timeout for connecting to the server, timeout is then only used while waiting for replies.
+    A timeout of 0 means no timeout (for TACACSClient a socket timeout of 0 would make the socket non blocking).
+    """
+
+    def __init__(self, host, port, secret, timeout=10, connect_timeout=None, **kwargs):
+        super().__init__(host, port, secret, timeout=timeout or None, **kwargs)
+        self.connect_timeout = self.timeout if connect_timeout is None else (connect_timeout or None)
+
+    @property
+    def sock(self):
+        if not self._sock:
+            error = None
+            # The resolver picks the address family, HOST can be an IPv6 address or a name which only resolves to IPv6 addresses
+            for family, socktype, proto, canonname, address in socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM):
+                sock = socket.socket(family, socktype, proto)
+                try:
+                    sock.settimeout(self.connect_timeout)
+                    sock.connect(address)
+                    sock.settimeout(self.timeout)
+                except OSError as e:
+                    sock.close()
+                    error = e
+                    continue
+                self._sock = sock
+                break
+            else:
+                raise error
+        return self._sock
+
+
 class TacacsConfiguration(BaseAuthenticatorConfiguration):
     documentation_url = "https://github.com/ansible/tacacs_plus"
     HOST = CharField(
@@ -73,6 +155,31 @@ class TacacsConfiguration(BaseAuthenticatorConfiguration):
         help_text=_('TACACS+ session timeout value in seconds, 0 disables timeout.'),
         ui_field_label=_('TACACS+ Auth Session Timeout'),
     )
+    CONNECT_TIMEOUT = IntegerField(
+        min_value=0,
+        default=None,
+        allow_null=True,
+        required=False,
+        label=_('TACACS+ Connect Timeout'),
+        help_text=_(
+            'How long (in seconds) to wait for a connection to each TACACS+ server before moving on to the next one,'
+            ' defaults to the session timeout. 0 disables timeout.'
+        ),
+        ui_field_label=_('TACACS+ Connect Timeout'),
+    )
+    FAILOVER_HOSTS = ListField(
+        child=CharField(),
+        default=[],
+        allow_null=False,
+        required=False,
+        validators=[validate_tacacs_hosts],
+        label=_('TACACS+ Failover Servers'),
+        help_text=_(
+            'Other TACACS+ servers to use when a server can not be reached, as hostname or hostname:port (the port defaults to the TACACS+ Port).'
+            ' The servers which answer fastest are used first and a server which could not be reached is only tried after the others for a while.'
+        ),
+        ui_field_label=_('TACACS+ Failover Servers'),
+    )
 
 
 class AuthenticatorPlugin(SocialAuthMixin, AbstractAuthenticatorPlugin, ModelBackend):
@@ -80,12 +187,18 @@ class AuthenticatorPlugin(SocialAuthMixin, AbstractAuthenticatorPlugin, ModelBac
     logger = logger
     type = "tacacs"
     category = "password"
+    circuit_breaker_enabled = True
 
     def __init__(self, database_instance=None, *args, **kwargs):
         super().__init__(database_instance, *args, **kwargs)
         self.configuration_encrypted_fields = ['SECRET']
 
     def authenticate(self, request, username=None, password=None, **kwargs):
+        if not self.verify_credentials(request, username, password, **kwargs):
+            return None
+        return self.complete_login(request, True, username, password, **kwargs)
+
+    def verify_credentials(self, request, username=None, password=None, **kwargs):
         if not username or not password:
             return None
 
@@ -94,39 +207,97 @@ class AuthenticatorPlugin(SocialAuthMixin, AbstractAuthenticatorPlugin, ModelBac
             return None
 
         try:
-            tacacs_client = TACACSClient(
-                self.database_instance.configuration["HOST"],
-                self.database_instance.configuration["PORT"],
-                self.database_instance.configuration["SECRET"],
-                timeout=self.database_instance.configuration["SESSION_TIMEOUT"],
-            )
             rem_addr = TAC_PLUS_VIRTUAL_REM_ADDR
             client_ip = self._get_client_ip(request)
             if client_ip:
                 rem_addr = client_ip
 
-            reply = tacacs_client.authenticate(
-                username,
-                password,
-                authen_type=TAC_PLUS_AUTHEN_TYPES[self.database_instance.configuration['AUTH_PROTOCOL']],
-                rem_addr=rem_addr,
-            )
+            reply = self.authenticate_with_failover(username, password, rem_addr)
 
             if reply.valid:
-                # At this point tacacs+ has validated our username and password, so we need to create the user and AuthenticatorUser object
-                User = get_user_model()
-                user, created = User.objects.get_or_create(username=username)
-                if created:
-                    logger.info(f"TACAC+ created user {user.username}")
-                AuthenticatorUser.objects.get_or_create(uid=username, user=user, provider=self.database_instance)
-
-                return user
+                return True
         except Exception as e:
+            # Socket errors (refused connections, timeouts, etc) mean the server is unavailable
+            if isinstance(e, OSError):
+                report_unavailable(e)
             logger.exception("TACACS+ Authentication Error: %s" % str(e))
 
         # Tacacs could not validate us so return None.
         return None
 
+    def complete_login(self, request, verified, username=None, password=None, **kwargs):
+        # At this point tacacs+ has validated our username and password, so we need to create the user and AuthenticatorUser object
+        try:
+            return self.get_or_create_user(username)
+        except Exception as e:
+            logger.exception("TACACS+ Authentication Error: %s" % str(e))
+            return None
+
+    def get_client_settings(self) -> dict:
+        """
+        Returns the parsed servers and client settings of the authenticator, these are only parsed again when the authenticator changes
+        """
+        version = (self.database_instance.id, self.database_instance.modified_on)
+        client_settings = getattr(self, '_client_settings', None)
+        if client_settings is None or client_settings['version'] != version:
+            configuration = self.database_instance.configuration
+            client_settings = {
+                'version': version,
+                'servers': get_tacacs_servers(configuration),
+                'secret': configuration['SECRET'],
+                'timeout': configuration['SESSION_TIMEOUT'],
+                'connect_timeout': configuration.get('CONNECT_TIMEOUT', None),
+                'authen_type': TAC_PLUS_AUTHEN_TYPES[configuration['AUTH_PROTOCOL']],
+            }
+            self._client_settings = client_settings
+        return client_settings
+
+    def authenticate_with_failover(self, username: str, password: str, rem_addr: str):
+        """
+        Sends the authentication to the fastest healthy server. A server which can't be reached is demoted and the next one is tried.
+
+        Every login gets its own client (and session id), TACACSClient holds the socket of the session it is running so it can't be shared.
+        tacacs_plus closes the connection after each authentication so there is no single connection mode to reuse a connection either.
+        """
+        client_settings = self.get_client_settings()
+        selector = ServerSelector(self.database_instance.id, list(client_settings['servers']))
+        error = None
+        for server in selector.ordered():
+            host, port = client_settings['servers'][server]
+            client = TimeoutTACACSClient(
+                host, port, client_settings['secret'], timeout=client_settings['timeout'], connect_timeout=client_settings['connect_timeout']
+            )
+            started = time.monotonic()
+            try:
+                reply = client.authenticate(username, password, authen_type=client_settings['authen_type'], rem_addr=rem_addr)
+            except OSError as e:
+                # Refused connections, timeouts, etc mean this server is unavailable, the next one may still answer
+                selector.record_failure(server, e)
+                error = e
+                continue
+            selector.record_success(server, time.monotonic() - started)
+            return reply
+        raise error
+
+    def get_or_create_user(self, username: str):
+        # Users who logged in before only cost this one query
+        authenticator_user = AuthenticatorUser.objects.filter(uid=username, provider=self.database_instance).select_related('user').first()
+        if authenticator_user is not None:
+            return authenticator_user.user
+
+        user, created = upsert_user(username)
+        if created:
+            logger.info(f"TACAC+ created user {user.username}")
+        # A login running in parallel may have linked the user already, that is fine
+        upsert_authenticator_user(self.database_instance, username, user)
+        return user
+
+    def get_servers(self, authenticator) -> list:
+        try:
+            return list(get_tacacs_servers(authenticator.configuration))
+        except (KeyError, ValueError):
+            return []
+
     def _get_client_ip(self, request):
         if not request or not hasattr(request, 'META'):
             return None
@@ -1,51 +1,330 @@
+import hashlib
 import logging
-from collections import OrderedDict
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from functools import lru_cache
 
 from django.contrib.auth.backends import ModelBackend
+from django.db import connections
 
-from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
-from ansible_base.authentication.models import Authenticator
+from ansible_base.authentication.authenticator_plugins.base import AbstractAuthenticatorPlugin
+from ansible_base.authentication.models import AuthenticatorUser
+from ansible_base.authentication.registry import authenticator_registry
+from ansible_base.authentication.utils.circuit_breaker import pop_reported_error
+from ansible_base.authentication.utils.versions import get_authentication_cache
+from ansible_base.lib.utils.settings import get_setting
 
 logger = logging.getLogger('ansible_base.authentication.backend')
 
 
+def get_authentication_backends():
+    # The registry only goes to the database when an authenticator was saved or deleted
+    return authenticator_registry.get_backends()
+
+
+def get_route_cache_key(username: str) -> str:
+    # Usernames can contain characters which are not valid in cache keys (i.e. spaces for memcached)
+    return f"ansible_base.authentication.route.{hashlib.sha256(username.encode('utf-8')).hexdigest()}"
+
+
+def rule_matches_username(rule: dict, username: str) -> bool:
+    '''
+    A rule can route on a username suffix, on a domain (user@domain or DOMAIN\\user) or on a regex of the username
+    '''
+    if suffix := rule.get('username_suffix', None):
+        if username.lower().endswith(suffix.lower()):
+            return True
+    if domain := rule.get('domain', None):
+        domain = domain.lower()
+        lower_username = username.lower()
+        if lower_username.endswith(f'@{domain}') or lower_username.startswith(f'{domain}\\'):
+            return True
+    if regex := rule.get('username_regex', None):
+        try:
+            if re.search(regex, username):
+                return True
+        except re.error as e:
+            logger.error(f"Invalid username_regex {regex} in ANSIBLE_BASE_AUTHENTICATOR_ROUTING_RULES: {e}")
+    return False
+
+
+def get_learned_route(username: str) -> str:
+    '''
+    Returns the slug of the authenticator the user last successfully logged in with (or '' if we don't know)
+    '''
+    cache = get_authentication_cache()
+    cache_key = get_route_cache_key(username)
+    slug = cache.get(cache_key, None)
+    if slug is None:
+        authenticator_users = AuthenticatorUser.objects.filter(uid=username, provider__category='password').order_by('-modified')
+        slug = authenticator_users.values_list('provider_id', flat=True).first() or ''
+        cache.set(cache_key, slug, get_setting('ANSIBLE_BASE_AUTHENTICATOR_ROUTE_TIMEOUT', 86400))
+    return slug
+
+
+def learn_route(username: str, slug: str) -> None:
+    get_authentication_cache().set(get_route_cache_key(username), slug, get_setting('ANSIBLE_BASE_AUTHENTICATOR_ROUTE_TIMEOUT', 86400))
+
+
+def get_routed_backends(backends: dict, username: str, learned_slug: str = '') -> list:
+    '''
+    Returns a list of (authenticator_id, authenticator_object) in the order they should be tried for username.
+
+    Authenticators from matching ANSIBLE_BASE_AUTHENTICATOR_ROUTING_RULES come first, followed by the authenticator
+    the user last logged in with. Everything else follows in the order of the authenticators so a user who was not
+    routed (or was routed incorrectly) is still able to login.
+    '''
+    ordered_backends = list(backends.items())
+    if not username:
+        return ordered_backends
+
+    slugs = []
+    for rule in get_setting('ANSIBLE_BASE_AUTHENTICATOR_ROUTING_RULES', []) or []:
+        if rule.get('authenticator', None) and rule_matches_username(rule, username):
+            slugs.append(rule['authenticator'])
+    if learned_slug:
+        slugs.append(learned_slug)
+
+    if not slugs:
+        return ordered_backends
+
+    routed_backends = []
+    for slug in slugs:
+        for authenticator_id, authenticator_object in ordered_backends:
+            if authenticator_object.database_instance.slug == slug and (authenticator_id, authenticator_object) not in routed_backends:
+                routed_backends.append((authenticator_id, authenticator_object))
+    logger.debug(f"Routing {username} to {', '.join([str(authenticator_id) for authenticator_id, _ in routed_backends])} first")
+    return routed_backends + [backend for backend in ordered_backends if backend not in routed_backends]
+
+
+class LoginExecutor:
+    '''
+    A bounded pool of threads to run authenticators in, one per process.
+
+    An authenticator which runs past ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_TIMEOUT can not be stopped, it keeps its thread until the
+    authenticator itself gives up (i.e. the network timeout of LDAP or TACACS+). So we count the threads in use and a login which
+    would have to queue behind them tries the authenticators in order in its own thread instead.
+    '''
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dab_authenticate')
+        self.lock = threading.Lock()
+        self.busy = 0
+
+    def reserve(self, count: int) -> bool:
+        with self.lock:
+            if self.busy + count > self.max_workers:
+                return False
+            self.busy += count
+            return True
+
+    def release(self, count: int = 1) -> None:
+        with self.lock:
+            self.busy -= count
+
+    def submit(self, fn, *args, **kwargs):
+        '''
+        Runs fn in the pool, the caller must have reserved a thread for it
+        '''
+        future = self.executor.submit(fn, *args, **kwargs)
+        # This is also called when the future is cancelled
+        future.add_done_callback(lambda _future: self.release())
+        return future
+
+
 @lru_cache(maxsize=1)
-def get_authentication_backends(last_updated):
-    # last_updated is primarily here as a cache busting mechanism
-    authentication_backends = OrderedDict()
+def get_login_executor(max_workers: int) -> LoginExecutor:
+    return LoginExecutor(max_workers)
+
+
+def circuit_breaker_allows(authenticator_object) -> bool:
+    if not authenticator_object.circuit_breaker_enabled:
+        return True
+    if authenticator_object.get_circuit_breaker().allow_request():
+        return True
+    logger.info(f'Skipping authenticator with ID "{authenticator_object.database_instance.id}" because its circuit breaker is open')
+    return False
 
-    for database_authenticator in Authenticator.objects.filter(enabled=True):
+
+def authenticate_with_circuit_breaker(authenticator_object, request, *args, **kwargs):
+    '''
+    Runs the authenticator and records its health if it uses a circuit breaker.
+    The caller is expected to have checked circuit_breaker_allows first.
+    '''
+    return call_with_circuit_breaker(authenticator_object, authenticator_object.authenticate, request, *args, **kwargs)
+
+
+def call_with_circuit_breaker(authenticator_object, function, *args, **kwargs):
+    if not authenticator_object.circuit_breaker_enabled:
+        return function(*args, **kwargs)
+
+    circuit_breaker = authenticator_object.get_circuit_breaker()
+    # Clear anything left over from a previous authenticator in this thread
+    pop_reported_error()
+    start = time.monotonic()
+    try:
+        result = function(*args, **kwargs)
+    except Exception as e:
+        circuit_breaker.record_failure(time.monotonic() - start, e)
+        raise
+
+    latency = time.monotonic() - start
+    if error := pop_reported_error():
+        circuit_breaker.record_failure(latency, error)
+    else:
+        circuit_breaker.record_success(latency)
+    return result
+
+
+def supports_verification(authenticator_object) -> bool:
+    '''
+    Returns if the plugin can check credentials on their own (see AbstractAuthenticatorPlugin.verify_credentials)
+    '''
+    verify_credentials = getattr(type(authenticator_object), 'verify_credentials', AbstractAuthenticatorPlugin.verify_credentials)
+    return verify_credentials is not AbstractAuthenticatorPlugin.verify_credentials
+
+
+def verify_in_thread(authenticator_object, request, *args, **kwargs):
+    try:
+        return call_with_circuit_breaker(authenticator_object, authenticator_object.verify_credentials, request, *args, **kwargs)
+    finally:
+        # Each thread gets its own database connection, don't leave it open in the pool
+        connections.close_all()
+
+
+def discard_when_done(authenticator_object, future) -> None:
+    '''
+    Lets the authenticator clean up (i.e. release its connection) once a verification we are not going to use finishes
+    '''
+
+    def discard(done_future):
+        if done_future.cancelled() or done_future.exception() is not None or not done_future.result():
+            return
         try:
-            authentication_backends[database_authenticator.id] = get_authenticator_plugin(database_authenticator.type)
-        except ImportError:
-            continue
-        authenticator_object = authentication_backends[database_authenticator.id]
-        authenticator_object.update_if_needed(database_authenticator)
-    return authentication_backends
+            authenticator_object.discard_login(done_future.result())
+        except Exception:
+            logger.exception(f'Authenticator with ID "{authenticator_object.database_instance.id}" failed to discard a login')
+
+    future.add_done_callback(discard)
 
 
 class AnsibleBaseAuth(ModelBackend):
     def authenticate(self, request, *args, **kwargs):
         logger.debug("Starting AnsibleBaseAuth authentication")
 
-        # Query the database for the most recently last modified timestamp.
-        # This will be used as a cache key for the cached function get_authentication_backends below
-        last_modified_item = Authenticator.objects.values("modified_on").order_by("-modified_on").first()
-        last_modified = None if last_modified_item is None else last_modified_item.get('modified_on')
+        username = kwargs.get('username', None)
+        if not isinstance(username, str):
+            username = None
 
-        for authenticator_id, authenticator_object in get_authentication_backends(last_modified).items():
-            user = authenticator_object.authenticate(request, *args, **kwargs)
+        learned_slug = ''
+        if username and get_setting('ANSIBLE_BASE_AUTHENTICATOR_LEARN_ROUTES', True):
+            learned_slug = get_learned_route(username)
+
+        # Only plain username/password logins are run concurrently, social auth passes the backend it completes
+        if get_setting('ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_LOGIN', False) and username and 'password' in kwargs and 'backend' not in kwargs:
+            authenticator_id, authenticator_object, user = self.authenticate_concurrently(get_authentication_backends(), request, *args, **kwargs)
+        else:
+            routed_backends = get_routed_backends(get_authentication_backends(), username, learned_slug)
+            authenticator_id, authenticator_object, user = self.authenticate_in_order(routed_backends, request, *args, **kwargs)
+
+        if not user:
+            return None
+
+        # The local authenticator handles this but we want to check this for other authentication types
+        if not getattr(user, 'is_active', True):
+            logger.warning(
+                f'User {user.username} attempted to login from authenticator with ID "{authenticator_id}" their user is inactive, denying permission'
+            )
+            return None
+
+        logger.info(f'User {user.username} logged in from authenticator with ID "{authenticator_id}"')
+        # An AuthenticatorUser (i.e. from provision_users or a denied login) does not mean the user was added to the authenticator,
+        # add is a no-op if they already were
+        authenticator_object.database_instance.users.add(user)
+        if username and learned_slug != authenticator_object.database_instance.slug:
+            learn_route(username, authenticator_object.database_instance.slug)
+        return user
+
+    def authenticate_in_order(self, backends: list, request, *args, **kwargs) -> tuple:
+        for authenticator_id, authenticator_object in backends:
+            if not circuit_breaker_allows(authenticator_object):
+                continue
+            user = authenticate_with_circuit_breaker(authenticator_object, request, *args, **kwargs)
             if user:
-                # The local authenticator handles this but we want to check this for other authentication types
-                if not getattr(user, 'is_active', True):
-                    logger.warning(
-                        f'User {user.username} attempted to login from authenticator with ID "{authenticator_id}" their user is inactive, denying permission'
-                    )
-                    return None
-
-                logger.info(f'User {user.username} logged in from authenticator with ID "{authenticator_id}"')
-                authenticator_object.database_instance.users.add(user)
-                return user
-
-        return None
+                return authenticator_id, authenticator_object, user
+        return None, None, None
+
+    def authenticate_concurrently(self, backends: dict, request, *args, **kwargs) -> tuple:
+        '''
+        Checks the credentials with all of the password authenticators at once and logs in with the successful authenticator with the lowest order.
+
+        Only the checks run concurrently (verify_credentials), creating the user and evaluating their claims (complete_login) is done by the
+        winner alone once all of the authenticators before it have failed. So an authenticator which loses never touches the user.
+        Any authenticator which does not answer within ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_TIMEOUT is treated as a failure.
+        Authenticators which can't check credentials on their own are run in order when their turn comes. If the pool does not have
+        a thread for every authenticator the authenticators are tried in order instead.
+        '''
+        executor = get_login_executor(get_setting('ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_WORKERS', 8))
+        timeout = get_setting('ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_TIMEOUT', 30)
+
+        # backends are already in the order of the authenticators so the list of futures is too
+        password_backends = [
+            (authenticator_id, authenticator_object)
+            for authenticator_id, authenticator_object in backends.items()
+            if authenticator_object.database_instance.category == 'password'
+        ]
+        verifiable_count = len([True for _, authenticator_object in password_backends if supports_verification(authenticator_object)])
+        if not executor.reserve(verifiable_count):
+            logger.warning("All of the threads to run authenticators concurrently are in use, trying the authenticators in order")
+            return self.authenticate_in_order(password_backends, request, *args, **kwargs)
+
+        entries = []
+        for authenticator_id, authenticator_object in password_backends:
+            if not supports_verification(authenticator_object):
+                entries.append((authenticator_id, authenticator_object, None))
+                continue
+            if not circuit_breaker_allows(authenticator_object):
+                executor.release()
+                continue
+            future = executor.submit(verify_in_thread, authenticator_object, request, *args, **kwargs)
+            entries.append((authenticator_id, authenticator_object, future))
+        deadline = time.monotonic() + timeout
+
+        winner = (None, None, None)
+        for authenticator_id, authenticator_object, future in entries:
+            if winner[2]:
+                if future is not None:
+                    # We already have a winner, don't start anything which has not started yet
+                    future.cancel()
+                    discard_when_done(authenticator_object, future)
+                continue
+
+            if future is None:
+                if circuit_breaker_allows(authenticator_object):
+                    user = authenticate_with_circuit_breaker(authenticator_object, request, *args, **kwargs)
+                    if user:
+                        winner = (authenticator_id, authenticator_object, user)
+                continue
+
+            try:
+                verified = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                future.cancel()
+                discard_when_done(authenticator_object, future)
+                logger.warning(f'Authenticator with ID "{authenticator_id}" did not respond within {timeout} seconds, skipping it')
+                if authenticator_object.circuit_breaker_enabled:
+                    authenticator_object.get_circuit_breaker().record_failure(timeout, f'Did not respond within {timeout} seconds')
+                continue
+            except Exception:
+                logger.exception(f'Authenticator with ID "{authenticator_id}" failed to authenticate')
+                continue
+            if verified:
+                user = authenticator_object.complete_login(request, verified, *args, **kwargs)
+                if user:
+                    winner = (authenticator_id, authenticator_object, user)
+
+        return winner
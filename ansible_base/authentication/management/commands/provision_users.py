@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_class
+from ansible_base.authentication.models import Authenticator
+from ansible_base.authentication.utils.provisioning import provision_users
+
+
+class Command(BaseCommand):
+    help = "Create the users of an authenticator (i.e. LDAP) from its directory and apply its maps before the users ever login"
+
+    def add_arguments(self, parser):
+        parser.add_argument("authenticator", type=int, help="The ID of the authenticator whose users should be created")
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be created or changed, don't update any users", required=False)
+        parser.add_argument("--page-size", type=int, default=500, help="The number of users to request from the directory at a time", required=False)
+
+    def handle(self, *args, **options):
+        try:
+            authenticator = Authenticator.objects.get(id=options['authenticator'])
+        except Authenticator.DoesNotExist:
+            raise CommandError(f"Authenticator {options['authenticator']} does not exist")
+
+        if options['page_size'] < 1:
+            raise CommandError("--page-size must be at least 1")
+
+        try:
+            plugin_class = get_authenticator_class(authenticator.type)
+        except ImportError as e:
+            raise CommandError(str(e))
+        if not hasattr(plugin_class, 'iter_directory_users'):
+            raise CommandError(f"Authenticator {authenticator.name} can not list its users")
+
+        plugin = plugin_class(database_instance=authenticator)
+        try:
+            report = provision_users(authenticator, plugin.iter_directory_users(page_size=options['page_size']), dry_run=options['dry_run'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(json.dumps(report, indent=4, sort_keys=True))
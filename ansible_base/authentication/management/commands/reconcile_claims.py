@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ansible_base.authentication.utils.reconciliation import process_reconciliation_queue
+
+
+class Command(BaseCommand):
+    help = "Reconcile the claims of users queued by logins when ANSIBLE_BASE_AUTHENTICATOR_RECONCILE_DEFERRED is enabled"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="The number of queued users to reconcile in each batch", required=False)
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty instead of waiting for more users", required=False)
+        parser.add_argument("--interval", type=float, default=5, help="Seconds to wait before checking an empty queue again", required=False)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+
+        total = 0
+        while True:
+            processed = process_reconciliation_queue(batch_size=options['batch_size'])
+            total += processed
+            if processed:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(f"Reconciled {total} users")
@@ -0,0 +1,28 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ansible_base.authentication.models import Authenticator
+from ansible_base.authentication.utils.reevaluation import reevaluate_claims
+
+
+class Command(BaseCommand):
+    help = "Re-run the authenticator maps for all of the users of an authenticator without waiting for them to login"
+
+    def add_arguments(self, parser):
+        parser.add_argument("authenticator", type=int, help="The ID of the authenticator whose users should be re-evaluated")
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would change, don't update any users", required=False)
+        parser.add_argument("--batch-size", type=int, default=1000, help="The number of users to load and update at a time", required=False)
+        parser.add_argument("--processes", type=int, default=1, help="The number of processes to evaluate the maps in", required=False)
+
+    def handle(self, *args, **options):
+        try:
+            authenticator = Authenticator.objects.get(id=options['authenticator'])
+        except Authenticator.DoesNotExist:
+            raise CommandError(f"Authenticator {options['authenticator']} does not exist")
+
+        if options['batch_size'] < 1 or options['processes'] < 1:
+            raise CommandError("--batch-size and --processes must be at least 1")
+
+        report = reevaluate_claims(authenticator, dry_run=options['dry_run'], batch_size=options['batch_size'], processes=options['processes'])
+        self.stdout.write(json.dumps(report, indent=4, sort_keys=True))
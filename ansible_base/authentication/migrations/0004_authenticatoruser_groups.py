@@ -0,0 +1,18 @@
+# Generated by Django 4.2.8 on 2026-10-18 21:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dab_authentication', '0003_alter_authenticatormap_authenticator'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='authenticatoruser',
+            name='groups',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+    ]
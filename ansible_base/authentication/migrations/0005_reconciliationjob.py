@@ -0,0 +1,26 @@
+# Generated by Django 4.2.8 on 2026-10-18 21:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dab_authentication', '0004_authenticatoruser_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciliationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queued', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('authenticator_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reconciliation_jobs', to='dab_authentication.authenticatoruser')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reconciliation_job', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -1,9 +1,11 @@
 from .authenticator import Authenticator
 from .authenticator_map import AuthenticatorMap
+from .reconciliation import ReconciliationJob
 from .social_auth import AuthenticatorUser
 
 __all__ = (
     'Authenticator',
     'AuthenticatorMap',
     'AuthenticatorUser',
+    'ReconciliationJob',
 )
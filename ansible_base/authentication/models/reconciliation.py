@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.db import models
+from django.utils.timezone import now
+
+from ansible_base.authentication.models.social_auth import AuthenticatorUser
+
+
+class ReconciliationJob(models.Model):
+    """
+    A user whose claims still need to be reconciled with the application.
+
+    When ANSIBLE_BASE_AUTHENTICATOR_RECONCILE_DEFERRED is set logins queue a job here instead of running the reconcile module
+    and the reconcile_claims management command works through the queue. There is only ever one job per user, logging in again
+    before the job ran only points it at the latest authenticator user.
+    """
+
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, related_name="reconciliation_job", on_delete=models.CASCADE)
+    authenticator_user = models.ForeignKey(AuthenticatorUser, related_name="reconciliation_jobs", on_delete=models.CASCADE)
+    queued = models.DateTimeField(default=now, db_index=True)
@@ -1,8 +1,12 @@
+import copy
+
 from django.conf import settings
 from django.db import models
+from social_core.storage import UserMixin
 from social_django.models import AbstractUserSocialAuth
 
 from ansible_base.authentication.models import Authenticator
+from ansible_base.authentication.utils.write_behind import login_write_buffer, save_login
 
 
 class AuthenticatorUser(AbstractUserSocialAuth):
@@ -19,12 +23,41 @@ class AuthenticatorUser(AbstractUserSocialAuth):
     last_login_map_results = models.JSONField(default=list, null=False, blank=True)
     # This field tracks if a user passed or failed an allow map
     access_allowed = models.BooleanField(default=None, null=True)
+    # The groups the authenticator gave us on the last login, this lets us re-evaluate claims without the user logging in
+    groups = models.JSONField(default=None, null=True, blank=True)
 
     @classmethod
     def create_social_auth(cls, user, uid, slug):
-        provider = Authenticator.objects.get(slug=slug)
+        from ansible_base.authentication.social_auth import social_auth_cache
+
+        provider = social_auth_cache.get_authenticator(slug)
         return super().create_social_auth(user, uid, provider)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if not login_write_buffer.enabled:
+            # Without write behind every login is saved anyway, don't pay for a copy on every load
+            return instance
+        # Remember what was loaded so a login can tell if it changed anything but auth_time (see only_auth_time_changed)
+        # social-core updates extra_data in place so we need our own copy
+        instance._loaded_login_data = copy.deepcopy((instance.__dict__.get('extra_data', None), instance.__dict__.get('groups', None)))
+        return instance
+
+    def only_auth_time_changed(self) -> bool:
+        loaded = getattr(self, '_loaded_login_data', None)
+        if loaded is None or not isinstance(loaded[0], dict) or not isinstance(self.extra_data, dict):
+            return False
+        loaded_extra_data, loaded_groups = loaded
+        if loaded_groups != self.groups:
+            return False
+        return {k: v for k, v in loaded_extra_data.items() if k != 'auth_time'} == {k: v for k, v in self.extra_data.items() if k != 'auth_time'}
+
+    def set_extra_data(self, extra_data=None):
+        # social-core calls this on every login and the auth_time in extra_data changes every time
+        if UserMixin.set_extra_data(self, extra_data):
+            save_login(self, update_fields=['extra_data', 'modified'])
+
     class Meta:
         """Meta data"""
 
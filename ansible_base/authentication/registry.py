@@ -0,0 +1,58 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
+from ansible_base.authentication.models import Authenticator
+from ansible_base.authentication.utils.versions import AUTHENTICATORS_VERSION, get_version
+
+logger = logging.getLogger('ansible_base.authentication.registry')
+
+
+class AuthenticatorRegistry:
+    """
+    Holds one plugin instance per enabled authenticator for the life of the process.
+
+    The database is only consulted when the shared authenticators version changes (it is bumped by the save/delete
+    signals on Authenticator) and even then only the plugins whose authenticator was actually modified are updated.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.backends = OrderedDict()
+
+    def get_backends(self) -> OrderedDict:
+        version = get_version(AUTHENTICATORS_VERSION, Authenticator.objects.all())
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.sync(version)
+        return self.backends
+
+    def sync(self, version: str) -> None:
+        logger.debug(f"Authenticator version changed to {version}, syncing authenticator registry")
+        backends = OrderedDict()
+        for database_authenticator in Authenticator.objects.filter(enabled=True).order_by('order', 'id'):
+            authenticator_object = self.backends.get(database_authenticator.id, None)
+            # A new authenticator, or the id was reused by an authenticator of a different type
+            if authenticator_object is None or authenticator_object.database_instance.type != database_authenticator.type:
+                try:
+                    authenticator_object = get_authenticator_plugin(database_authenticator.type)
+                except ImportError:
+                    continue
+            # This will only rebuild the settings of the plugin if the authenticator was modified
+            authenticator_object.update_if_needed(database_authenticator)
+            backends[database_authenticator.id] = authenticator_object
+
+        # Backends are kept in the order they should be tried. Swap the dict instead of mutating it so any thread iterating the old backends is unaffected
+        self.backends = backends
+        self.version = version
+
+    def reset(self) -> None:
+        with self.lock:
+            self.version = None
+            self.backends = OrderedDict()
+
+
+authenticator_registry = AuthenticatorRegistry()
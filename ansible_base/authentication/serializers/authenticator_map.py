@@ -1,3 +1,5 @@
+import re
+
 from rest_framework.serializers import ValidationError
 
 from ansible_base.authentication.models import AuthenticatorMap
@@ -55,6 +57,12 @@ class AuthenticatorMapSerializer(NamedCommonModelSerializer):
                 if 'choices' in type_definition:
                     if triggers[trigger_type] not in type_definition['choices']:
                         errors[f'{error_prefix}.{trigger_type}'] = f"Invalid, choices can only be one of: {', '.join(type_definition['choices'])}"
+                if trigger_type == 'matches':
+                    # Compile the regex now so an invalid one can't get as far as a login
+                    try:
+                        re.compile(triggers[trigger_type], re.IGNORECASE)
+                    except re.error as e:
+                        errors[f'{error_prefix}.{trigger_type}'] = f"Invalid regular expression: {e}"
             elif isinstance(triggers[trigger_type], list):
                 if 'contents' in type_definition:
                     for item in triggers[trigger_type]:
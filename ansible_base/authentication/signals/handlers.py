@@ -0,0 +1,64 @@
+import logging
+
+from django.contrib.auth.models import update_last_login as django_update_last_login
+from django.db import transaction
+from django.utils.timezone import now
+
+from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
+from ansible_base.authentication.utils.authenticator_maps import get_authenticator_maps_version_name
+from ansible_base.authentication.utils.circuit_breaker import CircuitBreaker
+from ansible_base.authentication.utils.connection_pool import connection_pools
+from ansible_base.authentication.utils.server_selection import ServerSelector
+from ansible_base.authentication.utils.versions import AUTHENTICATORS_VERSION, bump_version, get_authentication_cache, get_saml_metadata_cache_key
+from ansible_base.authentication.utils.write_behind import login_write_buffer
+
+logger = logging.getLogger('ansible_base.authentication.signals.handlers')
+
+
+def authenticator_changed(sender, instance, **kwargs):
+    # Bump right away so this process picks up the change and again after commit so that other
+    # processes which reloaded in between don't hold on to the pre-commit state of the authenticator
+    bump_version(AUTHENTICATORS_VERSION)
+    transaction.on_commit(lambda: bump_version(AUTHENTICATORS_VERSION))
+    # The same goes for the cached SAML metadata (and its ETag) so a deleted authenticator does not leave it behind
+    metadata_cache_key = get_saml_metadata_cache_key(instance.id)
+    get_authentication_cache().delete(metadata_cache_key)
+    transaction.on_commit(lambda: get_authentication_cache().delete(metadata_cache_key))
+
+
+def authenticator_saved(sender, instance, **kwargs):
+    authenticator_changed(sender, instance, **kwargs)
+    if not kwargs.get('raw', False):
+        transaction.on_commit(lambda: prepare_authenticator(instance))
+
+
+def prepare_authenticator(authenticator):
+    # This runs after the save was committed, a plugin failing here should not look like the save failed
+    try:
+        get_authenticator_plugin(authenticator.type).authenticator_saved(authenticator)
+    except Exception:
+        logger.exception(f"Failed to prepare authenticator {authenticator.name} after it was saved")
+
+
+def authenticator_deleted(sender, instance, **kwargs):
+    authenticator_changed(sender, instance, **kwargs)
+    # Don't leave the health of the authenticator behind in the cache
+    CircuitBreaker(instance.id).reset()
+    ServerSelector(instance.id, []).reset()
+    # Close any connections this process holds to the authenticators server
+    connection_pools.remove(instance.id)
+
+
+def authenticator_map_changed(sender, instance, **kwargs):
+    # Only the compiled maps of the authenticator the map belongs to need to be rebuilt
+    version_name = get_authenticator_maps_version_name(instance.authenticator_id)
+    bump_version(version_name)
+    transaction.on_commit(lambda: bump_version(version_name))
+
+
+def update_last_login(sender, user, **kwargs):
+    # Replaces the user_logged_in receiver of django.contrib.auth so last_login can go through the write behind buffer
+    if not login_write_buffer.enabled:
+        return django_update_last_login(sender, user, **kwargs)
+    user.last_login = now()
+    login_write_buffer.add(user, {'last_login': user.last_login})
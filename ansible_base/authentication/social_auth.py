@@ -1,11 +1,16 @@
+import copy
 import importlib
 import logging
+import threading
+import time
 
 from django.conf import settings
 from django.db import models
 from django.db.utils import IntegrityError
 from django.http import HttpResponseNotFound
 from rest_framework.reverse import reverse
+from social_core.pipeline.social_auth import load_extra_data as social_load_extra_data
+from social_core.storage import UserMixin
 from social_core.utils import setting_name
 from social_django.models import Association, Code, Nonce, Partial
 from social_django.storage import BaseDjangoStorage
@@ -13,10 +18,78 @@ from social_django.strategy import DjangoStrategy
 
 from ansible_base.authentication.authenticator_plugins.utils import generate_authenticator_slug, get_authenticator_class, get_authenticator_plugins
 from ansible_base.authentication.models import Authenticator, AuthenticatorUser
+from ansible_base.authentication.utils.versions import AUTHENTICATORS_VERSION, get_version
+from ansible_base.lib.utils.settings import get_setting
 
 logger = logging.getLogger('ansible_base.authentication.social_auth')
 
 
+class SocialAuthCache:
+    """
+    Holds the authenticators looked up by slug and the settings returned by ANSIBLE_BASE_SOCIAL_AUTH_STRATEGY_SETTINGS_FUNCTION
+    so that the steps of an SSO login (begin, complete, disconnect) don't look them up again and again.
+
+    Everything is dropped when the shared authenticators version changes (it is bumped by the save/delete signals on
+    Authenticator). Callers get a copy of the cached authenticator, saving it encrypts its configuration in place which must
+    not leak into the cache. The strategy settings are also dropped after ANSIBLE_BASE_SOCIAL_AUTH_STRATEGY_SETTINGS_CACHE_TIMEOUT seconds
+    because the function may read them from somewhere other than the authenticators.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.authenticators = {}
+        # function name -> (function, expires, settings)
+        self.strategy_settings = {}
+
+    def check_version(self) -> None:
+        version = get_version(AUTHENTICATORS_VERSION, Authenticator.objects.all())
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.authenticators = {}
+                    self.strategy_settings = {}
+                    self.version = version
+
+    def get_authenticator(self, slug: str) -> Authenticator:
+        self.check_version()
+        authenticator = self.authenticators.get(slug, None)
+        if authenticator is None:
+            authenticator = Authenticator.objects.get(slug=slug)
+            self.authenticators[slug] = authenticator
+        return copy.deepcopy(authenticator)
+
+    def get_strategy_settings(self, fq_function_name: str) -> dict:
+        self.check_version()
+        the_function, expires, strategy_settings = self.strategy_settings.get(fq_function_name, (None, None, None))
+        if strategy_settings is not None and time.monotonic() < expires:
+            # The strategy adds to its settings, don't let it change ours
+            return dict(strategy_settings)
+
+        logger.info(f"Attempting to load social settings from {fq_function_name}")
+        try:
+            if the_function is None:
+                module_name, _, function_name = fq_function_name.rpartition('.')
+                the_function = getattr(importlib.import_module(module_name), function_name)
+            strategy_settings = the_function()
+        except Exception as e:
+            logger.error(f"Failed to run {fq_function_name} to get additional settings: {e}")
+            return {}
+
+        timeout = get_setting('ANSIBLE_BASE_SOCIAL_AUTH_STRATEGY_SETTINGS_CACHE_TIMEOUT', 60)
+        self.strategy_settings[fq_function_name] = (the_function, time.monotonic() + timeout, strategy_settings)
+        return dict(strategy_settings)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.version = None
+            self.authenticators = {}
+            self.strategy_settings = {}
+
+
+social_auth_cache = SocialAuthCache()
+
+
 class AuthenticatorStorage(BaseDjangoStorage):
     user = AuthenticatorUser
     nonce = Nonce
@@ -35,13 +108,7 @@ class AuthenticatorStrategy(DjangoStrategy):
         self.settings = {}
         fq_function_name = getattr(settings, 'ANSIBLE_BASE_SOCIAL_AUTH_STRATEGY_SETTINGS_FUNCTION', None)
         if fq_function_name:
-            logger.info(f"Attempting to load social settings from {fq_function_name}")
-            try:
-                module_name, _, function_name = fq_function_name.rpartition('.')
-                the_function = getattr(importlib.import_module(module_name), function_name)
-                self.settings = the_function()
-            except Exception as e:
-                logger.error(f"Failed to run {fq_function_name} to get additional settings: {e}")
+            self.settings = social_auth_cache.get_strategy_settings(fq_function_name)
 
     # override setting to pass the backend to get_setting
     def setting(self, name, default=None, backend=None):
@@ -88,7 +155,7 @@ class AuthenticatorStrategy(DjangoStrategy):
     def get_backend(self, slug, redirect_uri=None, *args, **kwargs):
         """Add the database instance arg into the social auth backend."""
 
-        db_instance = Authenticator.objects.get(slug=slug)
+        db_instance = social_auth_cache.get_authenticator(slug)
         Backend = self.get_backend_class(db_instance.type)
 
         kwargs["database_instance"] = db_instance
@@ -171,7 +238,21 @@ class SocialAuthValidateCallbackMixin:
         return data
 
 
+def load_extra_data(backend, details, response, uid, user, *args, social=None, **kwargs):
+    """
+    Stores the extra data of the login on the AuthenticatorUser without saving it.
+
+    create_user_claims_pipeline runs later in the pipeline and writes the extra data together with the claims, so the login
+    only updates the AuthenticatorUser once. social_core's load_extra_data would save it right here.
+    """
+    if social is None:
+        return social_load_extra_data(backend, details, response, uid, user, *args, **kwargs)
+    extra_data = backend.extra_data(user, uid, response, details, *args, **kwargs)
+    UserMixin.set_extra_data(social, extra_data)
+
+
 def create_user_claims_pipeline(*args, backend, **kwargs):
     from ansible_base.authentication.utils.claims import update_user_claims
 
-    update_user_claims(kwargs["user"], backend.database_instance, backend.get_user_groups())
+    # social is the AuthenticatorUser from the earlier steps of the pipeline, passing it saves looking it up again
+    update_user_claims(kwargs["user"], backend.database_instance, backend.get_user_groups(), authenticator_user=kwargs.get("social", None))
@@ -0,0 +1,193 @@
+import logging
+import re
+import threading
+from typing import NamedTuple, Optional
+
+from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_class
+from ansible_base.authentication.models import Authenticator, AuthenticatorMap
+from ansible_base.authentication.utils.trigger_definition import TRIGGER_DEFINITION
+from ansible_base.authentication.utils.versions import get_version
+
+logger = logging.getLogger('ansible_base.authentication.utils.authenticator_maps')
+
+
+class CompiledMap(NamedTuple):
+    '''
+    An AuthenticatorMap with its triggers validated and converted into the form used during logins
+    '''
+
+    id: int
+    name: str
+    map_type: str
+    organization: Optional[str]
+    team: Optional[str]
+    revoke: bool
+    # Same shape as AuthenticatorMap.triggers but with lists turned into frozensets and regexes compiled
+    triggers: dict
+    # If the triggers failed validation the map is reported as invalid and never evaluated
+    invalid: bool = False
+    # The map has a groups trigger with one of has_or, has_and or has_not
+    has_group_condition: bool = False
+
+
+class AuthenticatorMapProgram(NamedTuple):
+    '''
+    The compiled maps of an authenticator in the order they are evaluated
+    '''
+
+    maps: tuple
+    # The maps which have a group condition
+    group_maps: tuple
+    # The names of all of the user attributes referenced by attribute triggers
+    attributes: frozenset = frozenset()
+    # The group names of the maps were lower cased and the users groups have to be as well (see normalize_groups)
+    ignore_group_case: bool = False
+
+
+def get_authenticator_maps_version_name(authenticator_id: int) -> str:
+    return f'authenticator_maps.{authenticator_id}'
+
+
+def normalize_groups(groups) -> frozenset:
+    '''
+    LDAP compares DNs case insensitively and a directory does not always return a DN in the case it was typed into a map,
+    so for authenticators which set case_insensitive_groups the groups of the maps and of the user are lower cased.
+    '''
+    return frozenset(group.lower() if isinstance(group, str) else group for group in groups)
+
+
+def groups_ignore_case(authenticator_type: str) -> bool:
+    try:
+        return getattr(get_authenticator_class(authenticator_type), 'case_insensitive_groups', False)
+    except ImportError:
+        return False
+
+
+def compile_group_trigger(trigger: dict, map_id: int, ignore_case: bool = False) -> dict:
+    compiled = {}
+    for condition, value in trigger.items():
+        if condition not in TRIGGER_DEFINITION['groups']['keys']:
+            logger.warning(f"The condition {condition} for groups in authenticator map {map_id} is invalid and won't be processed")
+            continue
+        compiled[condition] = normalize_groups(value) if ignore_case else frozenset(value)
+    return compiled
+
+
+def compile_attribute_trigger(trigger: dict, map_id: int) -> dict:
+    compiled = {}
+    join_condition = trigger.get('join_condition', 'or')
+    if join_condition not in TRIGGER_DEFINITION['attributes']['keys']['join_condition']['choices']:
+        logger.warning(f"Trigger join_condition {join_condition} on authenticator map {map_id} is invalid and will be set to 'or'")
+        join_condition = 'or'
+    compiled['join_condition'] = join_condition
+
+    valid_conditions = TRIGGER_DEFINITION['attributes']['keys']['*']['keys']
+    for attribute, conditions in trigger.items():
+        if attribute == 'join_condition':
+            continue
+        compiled_conditions = {}
+        for condition, value in conditions.items():
+            if condition not in valid_conditions:
+                logger.warning(f"The condition {condition} for attribute {attribute} in authenticator map {map_id} is invalid and won't be processed")
+                continue
+            if condition == 'matches':
+                # This will raise re.error for an invalid regex which will invalidate the map
+                value = re.compile(value, re.IGNORECASE)
+            elif condition == 'in':
+                value = frozenset(value)
+            compiled_conditions[condition] = value
+        if conditions and not compiled_conditions:
+            # None of the conditions could ever match so the attribute can't change the outcome
+            continue
+        compiled[attribute] = compiled_conditions
+    return compiled
+
+
+def compile_authenticator_map(auth_map: AuthenticatorMap, ignore_group_case: bool = False) -> CompiledMap:
+    compiled_map = CompiledMap(
+        id=auth_map.id,
+        name=auth_map.name,
+        map_type=auth_map.map_type,
+        organization=auth_map.organization,
+        team=auth_map.team,
+        revoke=auth_map.revoke,
+        triggers={},
+    )
+
+    invalid_keys = set(auth_map.triggers.keys()) - set(TRIGGER_DEFINITION.keys())
+    if invalid_keys:
+        logger.warning(f"In AuthenticatorMap {auth_map.id} the following trigger keys are invalid: {', '.join(invalid_keys)}, rule will be ignored")
+        return compiled_map._replace(invalid=True)
+
+    triggers = {}
+    try:
+        for trigger_type, trigger in auth_map.triggers.items():
+            if trigger_type == 'groups':
+                triggers[trigger_type] = compile_group_trigger(trigger, auth_map.id, ignore_group_case)
+            elif trigger_type == 'attributes':
+                triggers[trigger_type] = compile_attribute_trigger(trigger, auth_map.id)
+            else:
+                triggers[trigger_type] = trigger
+    except (re.error, AttributeError, TypeError) as e:
+        logger.warning(f"The triggers of AuthenticatorMap {auth_map.id} are invalid ({e}), rule will be ignored")
+        return compiled_map._replace(invalid=True)
+
+    has_group_condition = any(condition in triggers.get('groups', {}) for condition in ['has_or', 'has_and', 'has_not'])
+    return compiled_map._replace(triggers=triggers, has_group_condition=has_group_condition)
+
+
+def build_program(compiled_maps: tuple, ignore_group_case: bool = False) -> AuthenticatorMapProgram:
+    group_maps = []
+    attributes = set()
+    for compiled_map in compiled_maps:
+        if compiled_map.invalid:
+            continue
+        attributes.update(attribute for attribute in compiled_map.triggers.get('attributes', {}) if attribute != 'join_condition')
+        if compiled_map.has_group_condition:
+            group_maps.append(compiled_map)
+
+    return AuthenticatorMapProgram(
+        maps=compiled_maps,
+        group_maps=tuple(group_maps),
+        attributes=frozenset(attributes),
+        ignore_group_case=ignore_group_case,
+    )
+
+
+def compile_authenticator_maps(authenticator_id: int) -> AuthenticatorMapProgram:
+    authenticator_type = Authenticator.objects.filter(pk=authenticator_id).values_list('type', flat=True).first()
+    ignore_group_case = groups_ignore_case(authenticator_type) if authenticator_type else False
+    maps = AuthenticatorMap.objects.filter(authenticator=authenticator_id).order_by('order', 'id')
+    return build_program(tuple(compile_authenticator_map(auth_map, ignore_group_case) for auth_map in maps), ignore_group_case)
+
+
+class CompiledMapCache:
+    '''
+    Holds the compiled maps of each authenticator for as long as the maps of that authenticator don't change.
+    Saving or deleting an AuthenticatorMap bumps the version of its authenticator which causes a recompile.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.programs = {}
+
+    def get(self, authenticator_id: int) -> AuthenticatorMapProgram:
+        version = get_version(get_authenticator_maps_version_name(authenticator_id), AuthenticatorMap.objects.filter(authenticator=authenticator_id))
+        cached_version, program = self.programs.get(authenticator_id, (None, None))
+        if cached_version == version:
+            return program
+
+        with self.lock:
+            cached_version, program = self.programs.get(authenticator_id, (None, None))
+            if cached_version != version:
+                logger.debug(f"Compiling authenticator maps for authenticator {authenticator_id}")
+                program = compile_authenticator_maps(authenticator_id)
+                self.programs[authenticator_id] = (version, program)
+        return program
+
+    def reset(self) -> None:
+        with self.lock:
+            self.programs = {}
+
+
+compiled_map_cache = CompiledMapCache()
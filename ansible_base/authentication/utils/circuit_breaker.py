@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from ansible_base.authentication.utils.versions import get_authentication_cache
+from ansible_base.lib.utils.settings import get_setting
+
+logger = logging.getLogger('ansible_base.authentication.utils.circuit_breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# The weight given to the latest login when computing the average latency of an authenticator
+LATENCY_WEIGHT = 0.2
+
+# Tracks whether the authenticator running in this thread reported that its remote service was unavailable
+_attempt = threading.local()
+
+
+def report_unavailable(error) -> None:
+    '''
+    Called by an authenticator plugin (from within authenticate) when it could not reach its remote service.
+    This is different from a user failing to login, only unavailability counts against the circuit breaker.
+    '''
+    _attempt.error = error
+
+
+def pop_reported_error() -> Optional[Exception]:
+    error = getattr(_attempt, 'error', None)
+    _attempt.error = None
+    return error
+
+
+class CircuitBreaker:
+    '''
+    Tracks the health of an authenticator in the authentication cache so that all of the workers share it.
+
+    After ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_THRESHOLD consecutive failures the breaker opens and the authenticator
+    is skipped. Once ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_COOLDOWN seconds have passed a single login (across all workers)
+    is allowed through as a probe, if that succeeds the breaker closes again otherwise it stays open for another cooldown.
+    '''
+
+    def __init__(self, authenticator_id: int):
+        self.authenticator_id = authenticator_id
+        self.key = f'ansible_base.authentication.circuit_breaker.{authenticator_id}'
+        self.probe_key = f'{self.key}.probe'
+
+    @property
+    def threshold(self) -> int:
+        return get_setting('ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_THRESHOLD', 5)
+
+    @property
+    def cooldown(self) -> int:
+        return get_setting('ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_COOLDOWN', 60)
+
+    def _get(self) -> dict:
+        return get_authentication_cache().get(self.key, None) or {
+            'state': CLOSED,
+            'consecutive_failures': 0,
+            'opened_at': None,
+            'last_failure': None,
+            'last_error': None,
+            'average_latency': None,
+        }
+
+    def _set(self, state: dict) -> None:
+        get_authentication_cache().set(self.key, state, timeout=None)
+
+    def get_state(self) -> dict:
+        state = self._get()
+        if state['state'] == OPEN and time.time() >= state['opened_at'] + self.cooldown:
+            state['state'] = HALF_OPEN
+        state['threshold'] = self.threshold
+        state['cooldown'] = self.cooldown
+        return state
+
+    def allow_request(self) -> bool:
+        state = self.get_state()
+        if state['state'] == CLOSED:
+            return True
+        if state['state'] == HALF_OPEN:
+            # add only succeeds for one caller so only one worker gets to probe the authenticator
+            return get_authentication_cache().add(self.probe_key, True, timeout=self.cooldown)
+        return False
+
+    def _record_latency(self, state: dict, latency: float) -> None:
+        if state['average_latency'] is None:
+            state['average_latency'] = latency
+        else:
+            state['average_latency'] = (1 - LATENCY_WEIGHT) * state['average_latency'] + LATENCY_WEIGHT * latency
+
+    def record_success(self, latency: float) -> None:
+        state = self._get()
+        if state['state'] != CLOSED:
+            logger.info(f'Authenticator with ID "{self.authenticator_id}" is responding again, closing its circuit breaker')
+            get_authentication_cache().delete(self.probe_key)
+        state.update({'state': CLOSED, 'consecutive_failures': 0, 'opened_at': None})
+        self._record_latency(state, latency)
+        self._set(state)
+
+    def record_failure(self, latency: float, error) -> None:
+        state = self._get()
+        state['consecutive_failures'] += 1
+        state['last_failure'] = time.time()
+        state['last_error'] = str(error)
+        self._record_latency(state, latency)
+        threshold = self.threshold
+        if threshold and state['consecutive_failures'] >= threshold:
+            if state['state'] == CLOSED:
+                logger.warning(
+                    f'Authenticator with ID "{self.authenticator_id}" failed {state["consecutive_failures"]} times in a row, '
+                    f'skipping it for {self.cooldown} seconds: {error}'
+                )
+            # A failed probe (or failures from logins which were already running) restart the cooldown
+            state['state'] = OPEN
+            state['opened_at'] = time.time()
+            get_authentication_cache().delete(self.probe_key)
+        self._set(state)
+
+    def reset(self) -> None:
+        get_authentication_cache().delete_many([self.key, self.probe_key])
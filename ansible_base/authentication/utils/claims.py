@@ -1,14 +1,20 @@
 import logging
 import re
+from functools import lru_cache
 
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.utils.timezone import now
 from rest_framework.serializers import DateTimeField
 from social_core.pipeline.user import get_username
 
-from ansible_base.authentication.models import Authenticator, AuthenticatorMap, AuthenticatorUser
+from ansible_base.authentication.models import Authenticator, AuthenticatorUser, ReconciliationJob
 from ansible_base.authentication.social_auth import AuthenticatorStorage, AuthenticatorStrategy
+from ansible_base.authentication.utils.authenticator_maps import AuthenticatorMapProgram, compiled_map_cache, normalize_groups
+from ansible_base.authentication.utils.memberships import reconcile_user_memberships
+from ansible_base.authentication.utils.write_behind import save_login
+from ansible_base.lib.utils.models import upsert_user
+from ansible_base.lib.utils.settings import get_setting
 
 from .trigger_definition import TRIGGER_DEFINITION
 
@@ -19,6 +25,15 @@ def create_claims(authenticator: Authenticator, username: str, attrs: dict, grou
     '''
     Given an authenticator and a username, attrs and groups determine what the user has access to
     '''
+    # The maps are compiled (validated, sorted and converted to sets/regexes) once per change of the authenticators maps
+    program = compiled_map_cache.get(authenticator.id)
+    return evaluate_claims(program, authenticator.name, username, attrs, groups)
+
+
+def evaluate_claims(program: AuthenticatorMapProgram, authenticator_name: str, username: str, attrs: dict, groups: list) -> dict:
+    '''
+    Runs the compiled maps of an authenticator against a users attrs and groups, this does not touch the database
+    '''
 
     # Assume we are not going to change our flags
     is_superuser = None
@@ -31,26 +46,22 @@ def create_claims(authenticator: Authenticator, username: str, attrs: dict, grou
     rule_responses = []
     # Assume we will have access
     access_allowed = True
-    logger.info(f"Creating mapping for user {username} through authenticator {authenticator.name}")
+    logger.info(f"Creating mapping for user {username} through authenticator {authenticator_name}")
     logger.debug(f"{username}'s groups: {groups}")
     logger.debug(f"{username}'s attrs: {attrs}")
 
-    # load the maps
-    maps = AuthenticatorMap.objects.filter(authenticator=authenticator.id).order_by("order")
-    for auth_map in maps:
+    set_of_user_groups = normalize_groups(groups) if program.ignore_group_case else frozenset(groups)
+    for auth_map in program.maps:
         has_permission = None
-        allowed_keys = TRIGGER_DEFINITION.keys()
-        invalid_keys = set(auth_map.triggers.keys()) - set(allowed_keys)
-        if invalid_keys:
-            logger.warning(f"In AuthenticatorMap {auth_map.id} the following trigger keys are invalid: {', '.join(invalid_keys)}, rule will be ignored")
+        if auth_map.invalid:
             rule_responses.append({auth_map.id: 'invalid'})
             continue
 
         for trigger_type, trigger in auth_map.triggers.items():
             if trigger_type == 'groups':
-                has_permission = process_groups(trigger, groups, authenticator.name)
+                has_permission = process_groups(trigger, set_of_user_groups, authenticator_name)
             if trigger_type == 'attributes':
-                has_permission = process_user_attributes(trigger, attrs, authenticator.name)
+                has_permission = process_user_attributes(trigger, attrs, authenticator_name)
             if trigger_type == 'always':
                 has_permission = True
             if trigger_type == 'never':
@@ -104,22 +115,23 @@ def process_groups(trigger_condition: dict, groups: list, authenticator_id: int)
         logger.warning(f"The conditions {', '.join(invalid_conditions)} for groups in mapping {authenticator_id} are invalid and won't be processed")
 
     has_access = None
-    set_of_user_groups = set(groups)
+    # evaluate_claims turns the users groups into a frozenset once per login, don't copy it for every map
+    set_of_user_groups = groups if isinstance(groups, frozenset) else set(groups)
 
     if "has_or" in trigger_condition:
-        if set_of_user_groups.intersection(set(trigger_condition["has_or"])):
+        if set_of_user_groups.intersection(trigger_condition["has_or"]):
             has_access = True
         else:
             has_access = False
 
     elif "has_and" in trigger_condition:
-        if set(trigger_condition["has_and"]).issubset(set_of_user_groups):
+        if set_of_user_groups.issuperset(trigger_condition["has_and"]):
             has_access = True
         else:
             has_access = False
 
     elif "has_not" in trigger_condition:
-        if set(trigger_condition["has_not"]).intersection(set_of_user_groups):
+        if set_of_user_groups.intersection(trigger_condition["has_not"]):
             has_access = False
         else:
             has_access = True
@@ -196,9 +208,10 @@ def process_user_attributes(trigger_condition: dict, attributes: dict, authentic
                 has_access = has_access_with_join(has_access, a_user_value == trigger_condition[attribute]["equals"], join_condition)
 
             elif "matches" in trigger_condition[attribute]:
-                has_access = has_access_with_join(
-                    has_access, re.match(trigger_condition[attribute]["matches"], a_user_value, re.IGNORECASE) is not None, join_condition
-                )
+                pattern = trigger_condition[attribute]["matches"]
+                if not isinstance(pattern, re.Pattern):
+                    pattern = re.compile(pattern, re.IGNORECASE)
+                has_access = has_access_with_join(has_access, pattern.match(a_user_value) is not None, join_condition)
 
             elif "contains" in trigger_condition[attribute]:
                 has_access = has_access_with_join(has_access, trigger_condition[attribute]['contains'] in a_user_value, join_condition)
@@ -230,9 +243,30 @@ def get_local_username(user_details, authenticator):
         return user_details["username"]
 
 
-def get_or_create_authenticator_user(user_id, user_details, authenticator, extra_data):
+def upsert_authenticator_user(authenticator: Authenticator, uid: str, user, extra_data: dict = None) -> (AuthenticatorUser, bool):
+    '''
+    Links user to authenticator as uid in one INSERT ... ON CONFLICT statement and returns (authenticator_user, created).
+
+    If the AuthenticatorUser already exists (i.e. a login of the same user running in parallel won) its extra_data is
+    replaced, or it is left as is when extra_data is None.
+    '''
+    candidate = AuthenticatorUser(user=user, uid=uid, provider=authenticator, extra_data=extra_data or {})
+    if extra_data is None:
+        AuthenticatorUser.objects.bulk_create([candidate], ignore_conflicts=True)
+    else:
+        AuthenticatorUser.objects.bulk_create([candidate], update_conflicts=True, unique_fields=['provider', 'uid'], update_fields=['extra_data', 'modified'])
+
+    authenticator_user = AuthenticatorUser.objects.select_related('user').get(provider=authenticator, uid=uid)
+    # created is never updated on conflict so it only matches if our row was inserted
+    return authenticator_user, authenticator_user.created == candidate.created
+
+
+def get_or_create_authenticator_user(user_id, user_details, authenticator, extra_data, update_existing=True):
     """
     Create the user object in the database along with it's associated AuthenticatorUser class.
+
+    If the caller is going to pass the AuthenticatorUser on to update_user_claims it can set update_existing=False,
+    the new extra_data of an existing AuthenticatorUser is then only set on the object and written by update_user_claims.
     """
 
     extra = {**extra_data, "auth_time": DateTimeField().to_representation(now())}
@@ -240,7 +274,8 @@ def get_or_create_authenticator_user(user_id, user_details, authenticator, extra
     try:
         auth_user = AuthenticatorUser.objects.get(uid=user_id, provider=authenticator)
         auth_user.extra_data = extra
-        auth_user.save()
+        if update_existing:
+            save_login(auth_user, update_fields=["extra_data", "modified"])
         return (auth_user, False)
     except AuthenticatorUser.DoesNotExist:
         username = get_local_username(user_details, authenticator)
@@ -249,62 +284,108 @@ def get_or_create_authenticator_user(user_id, user_details, authenticator, extra
         allowed_keys = ["first_name", "last_name", "email"]
         details = {k: user_details.get(k, "") for k in allowed_keys if k}
 
-        local_user, created = get_user_model().objects.get_or_create(username=username, defaults=details)
+        # A first login racing another first login of the same user gets their user instead of failing
+        local_user, _ = upsert_user(username, details)
+        return upsert_authenticator_user(authenticator, user_id, local_user, extra)
 
-        return (AuthenticatorUser.objects.create(user=local_user, uid=user_id, extra_data=extra, provider=authenticator), True)
 
+def update_user_claims(user, database_authenticator, groups, authenticator_user=None):
+    '''
+    Evaluates the maps for a user who just logged in and stores the results.
 
-def update_user_claims(user, database_authenticator, groups):
+    If the caller already has the AuthenticatorUser (i.e. the social pipeline) it can be passed in to save looking it up again.
+    Only the fields which changed are written, so a login costs at most one UPDATE on each of the user and authenticator user tables.
+    '''
     if not user:
         return None
 
-    results = create_claims(database_authenticator, user.username, user.authenticator_user.extra, groups)
+    with transaction.atomic():
+        if authenticator_user is None or authenticator_user.provider_id != database_authenticator.slug or authenticator_user.user_id != user.pk:
+            authenticator_user, _ = AuthenticatorUser.objects.get_or_create(provider=database_authenticator, user=user)
+
+        results = create_claims(database_authenticator, user.username, authenticator_user.extra_data, groups)
+
+        # update the auth_time field to align with the general format used for other authenticators
+        authenticator_user.extra_data = {**authenticator_user.extra_data, "auth_time": DateTimeField().to_representation(now())}
+        # Keep the groups so that claims can be re-evaluated when the maps change (see reevaluate_claims)
+        authenticator_user.groups = list(groups)
+        # modified is auto_now but that only happens on save if we include it in update_fields
+        authenticator_user_fields = ['extra_data', 'groups', 'modified']
+        user_fields = []
+
+        for attribute, attr_value in results.items():
+            if attr_value is None:
+                continue
+            logger.debug(f"{attribute}: {attr_value}")
+            if hasattr(user, attribute):
+                object = user
+                dirty_fields = user_fields
+            elif hasattr(authenticator_user, attribute):
+                object = authenticator_user
+                dirty_fields = authenticator_user_fields
+            else:
+                logger.error(f"Neither user nor authenticator user has attribute {attribute}")
+                continue
+
+            if getattr(object, attribute, None) != attr_value:
+                logger.debug(f"Setting new attribute {attribute} for {user.username}")
+                setattr(object, attribute, attr_value)
+                dirty_fields.append(attribute)
+
+        # With ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND a login which only moved auth_time is written later in bulk
+        save_login(authenticator_user, update_fields=authenticator_user_fields)
+        if user_fields:
+            user.save(update_fields=user_fields)
+
+        if results['access_allowed'] is not True:
+            logger.warning(f"User {user.username} failed an allow map and was denied access")
+            return None
+
+        # We have allowed access so now we need to make the user within the system
+        if get_setting('ANSIBLE_BASE_AUTHENTICATOR_RECONCILE_DEFERRED', False):
+            queue_reconciliation(user, authenticator_user)
+        else:
+            reconcile_user_claims(user, authenticator_user)
 
-    needs_save = False
-    authenticator_user, _ = AuthenticatorUser.objects.get_or_create(provider=database_authenticator, user=user)
-    # update the auth_time field to align with the general format used for other authenticators
-    authenticator_user.extra_data = {**authenticator_user.extra_data, "auth_time": DateTimeField().to_representation(now())}
-    authenticator_user.save(update_fields=["extra_data"])
+    return user
 
-    for attribute, attr_value in results.items():
-        if attr_value is None:
-            continue
-        logger.debug(f"{attribute}: {attr_value}")
-        if hasattr(user, attribute):
-            object = user
-        elif hasattr(authenticator_user, attribute):
-            object = authenticator_user
-        else:
-            logger.error(f"Neither user nor authenticator user has attribute {attribute}")
-            continue
 
-        if getattr(object, attribute, None) != attr_value:
-            logger.debug(f"Setting new attribute {attribute} for {user.username}")
-            setattr(object, attribute, attr_value)
-            needs_save = True
+@lru_cache(maxsize=None)
+def _load_reconcile_class(module_name: str):
+    module = __import__(module_name, fromlist=['ReconcileUser'])
+    return getattr(module, 'ReconcileUser')
 
-    if needs_save:
-        authenticator_user.save()
-        user.save()
 
-    if results['access_allowed'] is not True:
-        logger.warning(f"User {user.username} failed an allow map and was denied access")
-        return None
+def get_reconcile_class():
+    '''
+    Returns the ReconcileUser class from ANSIBLE_BASE_AUTHENTICATOR_RECONCILE_MODULE, the class is only looked up once per module
+    '''
+    return _load_reconcile_class(getattr(settings, 'ANSIBLE_BASE_AUTHENTICATOR_RECONCILE_MODULE', 'ansible_base.authentication.utils.claims'))
+
 
-    # We have allowed access so now we need to make the user within the system
-    reconcile_class = getattr(settings, 'ANSIBLE_BASE_AUTHENTICATOR_RECONCILE_MODULE', 'ansible_base.authentication.utils.claims')
+def reconcile_user_claims(user, authenticator_user) -> None:
     try:
-        module = __import__(reconcile_class, fromlist=['ReconcileUser'])
-        klass = getattr(module, 'ReconcileUser')
-        klass.reconcile_user_claims(user, authenticator_user)
+        # A savepoint, so a database error here does not roll back the rest of the login (update_user_claims runs in a transaction)
+        with transaction.atomic():
+            get_reconcile_class().reconcile_user_claims(user, authenticator_user)
     except Exception as e:
         logger.error(f"Failed to reconcile user attributes! {e}")
 
-    return user
+
+def queue_reconciliation(user, authenticator_user) -> None:
+    '''
+    Queues the reconciliation of a user for the reconcile_claims management command.
+
+    This is a single upsert, if the user is already queued the job keeps its place and is only pointed at the latest authenticator user.
+    '''
+    ReconciliationJob.objects.bulk_create(
+        [ReconciliationJob(user=user, authenticator_user=authenticator_user, queued=now())],
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=['authenticator_user'],
+    )
 
 
 class ReconcileUser:
     def reconcile_user_claims(user, authenticator_user):
-        logger.error("TODO: Fix reconciliation of user claims")
-        claims = getattr(user, 'claims', getattr(authenticator_user, 'claims'))
-        logger.error(claims)
+        reconcile_user_memberships(user, authenticator_user)
@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Hashable, Optional
+
+logger = logging.getLogger('ansible_base.authentication.utils.connection_pool')
+
+
+class ConnectionPoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    '''
+    A thread safe pool of connections to a remote service.
+
+    At most max_size connections are handed out at a time, acquire waits up to acquire_timeout seconds for one to be
+    returned before it raises ConnectionPoolTimeout. Every connection handed out must be given back with release or discard.
+    At most max_size idle connections are kept, connections are handed out most recently used first and any connection
+    which has been idle for more than max_idle seconds is closed instead of being reused. If check is given it is called
+    on connections which have been idle for more than check_after seconds before they are handed out, if it returns False
+    or raises the connection is closed and another one is tried.
+    '''
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        close: Callable[[Any], None],
+        max_size: int = 10,
+        max_idle: float = 300,
+        check: Optional[Callable[[Any], bool]] = None,
+        check_after: float = 30,
+        acquire_timeout: float = 10,
+    ):
+        self.connect = connect
+        self.close_connection = close
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check = check
+        self.check_after = check_after
+        self.acquire_timeout = acquire_timeout
+        # One slot per connection handed out, this is what limits the number of open connections
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        # (connection, time it was returned), the most recently returned connection is on the right
+        self.idle = deque()
+        self.closed = False
+
+    def acquire(self) -> Any:
+        if not self.slots.acquire(timeout=self.acquire_timeout):
+            raise ConnectionPoolTimeout(f"All {self.max_size} connections are in use, none was returned within {self.acquire_timeout} seconds")
+        try:
+            return self._get_connection()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def _get_connection(self) -> Any:
+        while True:
+            with self.lock:
+                connection, returned_at = self.idle.pop() if self.idle else (None, None)
+            if connection is None:
+                return self.connect()
+
+            idle_time = time.monotonic() - returned_at
+            if idle_time > self.max_idle:
+                self._close(connection)
+                continue
+            if self.check and idle_time > self.check_after and not self._is_healthy(connection):
+                self._close(connection)
+                continue
+            return connection
+
+    def _is_healthy(self, connection: Any) -> bool:
+        try:
+            return self.check(connection)
+        except Exception as e:
+            logger.debug(f"Pooled connection failed its health check: {e}")
+            return False
+
+    def release(self, connection: Any) -> None:
+        '''
+        Gives back a connection from acquire so it can be reused
+        '''
+        expired = []
+        with self.lock:
+            now = time.monotonic()
+            # The oldest connections are on the left so we can stop at the first one which has not expired
+            while self.idle and now - self.idle[0][1] > self.max_idle:
+                expired.append(self.idle.popleft()[0])
+            if not self.closed and len(self.idle) < self.max_size:
+                self.idle.append((connection, now))
+                connection = None
+
+        self.slots.release()
+        for expired_connection in expired:
+            self._close(expired_connection)
+        if connection is not None:
+            self._close(connection)
+
+    def discard(self, connection: Any) -> None:
+        '''
+        Gives back a connection from acquire which should not be reused (i.e. it lost its server)
+        '''
+        self.slots.release()
+        self._close(connection)
+
+    def _close(self, connection: Any) -> None:
+        try:
+            self.close_connection(connection)
+        except Exception as e:
+            logger.debug(f"Ignoring error while closing pooled connection: {e}")
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, deque()
+        for connection, _ in idle:
+            self._close(connection)
+
+    def __len__(self) -> int:
+        return len(self.idle)
+
+
+class ConnectionPools:
+    '''
+    Holds one ConnectionPool per key (i.e. an authenticator id). When the version of a key changes (i.e. the authenticator
+    was modified) the old pool is closed and a new one is created so connections made with an old configuration are never reused.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pools = {}
+
+    def get(self, key: Hashable, version: Hashable, create: Callable[[], ConnectionPool]) -> ConnectionPool:
+        cached_version, pool = self.pools.get(key, (None, None))
+        if pool is not None and cached_version == version:
+            return pool
+
+        with self.lock:
+            cached_version, old_pool = self.pools.get(key, (None, None))
+            if old_pool is not None and cached_version == version:
+                return old_pool
+            pool = create()
+            self.pools[key] = (version, pool)
+
+        if old_pool is not None:
+            old_pool.close()
+        return pool
+
+    def remove(self, key: Hashable) -> None:
+        with self.lock:
+            _, pool = self.pools.pop(key, (None, None))
+        if pool is not None:
+            pool.close()
+
+    def reset(self) -> None:
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for _, pool in pools.values():
+            pool.close()
+
+
+connection_pools = ConnectionPools()
@@ -0,0 +1,69 @@
+import hashlib
+import logging
+import time
+
+from requests import HTTPError
+from social_core.backends.github import GithubMemberOAuth2
+from social_core.exceptions import AuthFailed
+
+from ansible_base.authentication.utils.versions import get_authentication_cache
+from ansible_base.lib.utils.settings import get_setting
+
+logger = logging.getLogger('ansible_base.authentication.utils.github')
+
+# How long we keep the ETag of a membership check so that we can revalidate it after its answer expired
+ETAG_TIMEOUT = 86400
+
+
+class GithubMembershipCacheMixin:
+    '''
+    Caches the org and team membership checks of the GitHub plugins in the authentication cache.
+
+    A member is trusted for ANSIBLE_BASE_GITHUB_MEMBERSHIP_CACHE_TIMEOUT seconds and a non member is refused for
+    ANSIBLE_BASE_GITHUB_NON_MEMBER_CACHE_TIMEOUT seconds without asking GitHub. After that the check is sent with the ETag
+    of the previous answer in If-None-Match, an unchanged answer comes back as a 304 which does not count against the
+    rate limit.
+    '''
+
+    def user_data(self, access_token, *args, **kwargs):
+        # Skip GithubMemberOAuth2.user_data, it checks the membership on every login
+        user_data = super(GithubMemberOAuth2, self).user_data(access_token, *args, **kwargs)
+        if not self.is_member(access_token, self.member_url(user_data)):
+            raise AuthFailed(self, self.no_member_string)
+        return user_data
+
+    def is_member(self, access_token: str, member_url: str) -> bool:
+        cache = get_authentication_cache()
+        database_instance = getattr(self, 'database_instance', None)
+        authenticator_id = database_instance.id if database_instance else None
+        cache_key = f'ansible_base.authentication.github_membership.{authenticator_id}.{hashlib.sha256(member_url.encode("utf-8")).hexdigest()}'
+        now = time.time()
+
+        cached = cache.get(cache_key, None)
+        if cached is not None and now < cached['expires']:
+            return cached['member']
+
+        headers = {"Authorization": f"token {access_token}"}
+        if cached is not None and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        try:
+            response = self.request(member_url, headers=headers)
+        except HTTPError as err:
+            # A 404 is GitHub saying the user is not a member, anything else is not an answer we can keep
+            if err.response is None or err.response.status_code != 404:
+                raise AuthFailed(self, self.no_member_string)
+            member, etag = False, err.response.headers.get('ETag', None)
+        else:
+            if response.status_code == 304 and cached is not None:
+                logger.debug(f"GitHub membership {member_url} did not change")
+                member, etag = cached['member'], cached['etag']
+            else:
+                # if the user is a member the response code will be 204
+                member, etag = True, response.headers.get('ETag', None)
+
+        if member:
+            timeout = get_setting('ANSIBLE_BASE_GITHUB_MEMBERSHIP_CACHE_TIMEOUT', 300)
+        else:
+            timeout = get_setting('ANSIBLE_BASE_GITHUB_NON_MEMBER_CACHE_TIMEOUT', 60)
+        cache.set(cache_key, {'member': member, 'etag': etag, 'expires': now + timeout}, timeout=ETAG_TIMEOUT)
+        return member
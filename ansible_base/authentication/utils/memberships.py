@@ -0,0 +1,133 @@
+import logging
+from typing import NamedTuple, Optional
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from ansible_base.lib.utils.settings import get_setting
+
+logger = logging.getLogger('ansible_base.authentication.utils.memberships')
+
+
+class Membership(NamedTuple):
+    '''
+    The through table which links the users to an organization or team model and the names of its two columns
+    '''
+
+    through: type
+    object_field: str
+    user_field: str
+
+
+def get_membership(model, members_field: str) -> Optional[Membership]:
+    '''
+    Finds the through table of the many to many relation named members_field between model and the users.
+    This works with a field on model (i.e. users) as well as with a reverse relation from the user (i.e. user_set on auth.Group).
+    '''
+    descriptor = getattr(model, members_field, None)
+    field = getattr(getattr(descriptor, 'rel', None), 'field', None)
+    user_model = get_user_model()
+    if field is None or not field.many_to_many or (field.model if descriptor.reverse else field.related_model) is not user_model:
+        logger.error(f"{model.__name__}.{members_field} is not a many to many relation to the users, memberships of {model.__name__} will not be reconciled")
+        return None
+
+    through = field.remote_field.through
+    if descriptor.reverse:
+        # The field is on the user so the "source" side of the through table is the user
+        object_field, user_field = field.m2m_reverse_field_name(), field.m2m_field_name()
+    else:
+        object_field, user_field = field.m2m_field_name(), field.m2m_reverse_field_name()
+    return Membership(
+        through=through,
+        object_field=through._meta.get_field(object_field).attname,
+        user_field=through._meta.get_field(user_field).attname,
+    )
+
+
+def reconcile_membership(user, membership: Membership, claimed: dict, remove: bool) -> None:
+    '''
+    Applies {object id: is_member} to the memberships of the user with one select, one bulk insert and one delete.
+    Memberships are only ever removed if remove is set.
+    '''
+    if not claimed:
+        return
+
+    current = set(
+        membership.through.objects.filter(**{membership.user_field: user.pk, f'{membership.object_field}__in': claimed.keys()}).values_list(
+            membership.object_field, flat=True
+        )
+    )
+    to_add = [object_id for object_id, is_member in claimed.items() if is_member and object_id not in current]
+    to_remove = [object_id for object_id, is_member in claimed.items() if not is_member and object_id in current] if remove else []
+
+    if to_add:
+        membership.through.objects.bulk_create(
+            [membership.through(**{membership.user_field: user.pk, membership.object_field: object_id}) for object_id in to_add], ignore_conflicts=True
+        )
+    if to_remove:
+        membership.through.objects.filter(**{membership.user_field: user.pk, f'{membership.object_field}__in': to_remove}).delete()
+    logger.debug(f"Added {user.username} to {len(to_add)} and removed them from {len(to_remove)} of {membership.through._meta.object_name}")
+
+
+def reconcile_user_memberships(user, authenticator_user) -> None:
+    '''
+    Makes the organization and team membership of a user match the claims from their last login.
+
+    Organizations and teams are resolved by name in one query each and the membership changes are applied in bulk,
+    so the number of queries does not depend on the number of organizations or teams in the claims.
+    Organizations and teams which don't exist are only created if the authenticator allows it (create_objects) and
+    users are only removed from them when the authenticator allows it (remove_users).
+    '''
+    claims = getattr(authenticator_user, 'claims', None) or {}
+    organization_claims = claims.get('organization_membership', {})
+    team_claims = claims.get('team_membership', {})
+    if not organization_claims and not team_claims:
+        return
+
+    authenticator = authenticator_user.provider
+    organization_model = apps.get_model(settings.ANSIBLE_BASE_ORGANIZATION_MODEL)
+    team_model = apps.get_model(settings.ANSIBLE_BASE_TEAM_MODEL)
+
+    # Every organization we need to know about, either for its own membership or for its teams
+    organization_names = set(organization_claims) | set(team_claims)
+    organizations = {organization.name: organization for organization in organization_model.objects.filter(name__in=organization_names)}
+
+    if authenticator.create_objects:
+        # Creating objects only happens the first time a name shows up so these go through save() for its signals and defaults
+        wanted = {name for name, is_member in organization_claims.items() if is_member}
+        wanted |= {name for name, teams in team_claims.items() if any(teams.values())}
+        for name in sorted(wanted - set(organizations)):
+            logger.info(f"Creating organization {name} from the claims of {authenticator.name}")
+            organizations[name] = organization_model.objects.create(name=name)
+
+    teams = {}
+    if team_claims:
+        organization_ids = [organizations[name].pk for name in team_claims if name in organizations]
+        team_names = {team for org_teams in team_claims.values() for team in org_teams}
+        # order_by() drops the default ordering of teams which would join the organizations
+        for team in team_model.objects.filter(organization_id__in=organization_ids, name__in=team_names).order_by():
+            teams[(team.organization_id, team.name)] = team
+
+    remove = authenticator.remove_users
+
+    organization_membership = get_membership(organization_model, get_setting('ANSIBLE_BASE_ORGANIZATION_MEMBERS_FIELD', 'users'))
+    if organization_membership:
+        claimed = {organizations[name].pk: is_member for name, is_member in organization_claims.items() if name in organizations}
+        reconcile_membership(user, organization_membership, claimed, remove)
+
+    team_membership = get_membership(team_model, get_setting('ANSIBLE_BASE_TEAM_MEMBERS_FIELD', 'users'))
+    if team_membership:
+        claimed = {}
+        for organization_name, org_teams in team_claims.items():
+            organization = organizations.get(organization_name, None)
+            if organization is None:
+                continue
+            for team_name, is_member in org_teams.items():
+                team = teams.get((organization.pk, team_name), None)
+                if team is None and is_member and authenticator.create_objects:
+                    logger.info(f"Creating team {team_name} in organization {organization_name} from the claims of {authenticator.name}")
+                    team = team_model.objects.create(name=team_name, organization=organization)
+                if team is not None:
+                    claimed[team.pk] = is_member
+        reconcile_membership(user, team_membership, claimed, remove)
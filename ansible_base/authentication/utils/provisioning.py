@@ -0,0 +1,109 @@
+import logging
+from typing import Iterable, NamedTuple
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from ansible_base.authentication.models import Authenticator, AuthenticatorUser
+from ansible_base.authentication.utils.authenticator_maps import compiled_map_cache
+from ansible_base.authentication.utils.claims import get_local_username
+from ansible_base.authentication.utils.reevaluation import ClaimsChangeReport, reevaluate_batch
+from ansible_base.lib.utils.models import upsert_user
+
+logger = logging.getLogger('ansible_base.authentication.utils.provisioning')
+
+
+class ProvisionedUser(NamedTuple):
+    '''
+    A user read from an authenticators remote service before they ever logged in
+    '''
+
+    # The id the authenticator knows the user by, this is the uid of the AuthenticatorUser
+    uid: str
+    # username, first_name, last_name and email for the local user
+    details: dict
+    extra_data: dict
+    groups: list
+
+
+def provision_users(authenticator: Authenticator, pages: Iterable[list], dry_run: bool = False) -> dict:
+    '''
+    Creates the users of an authenticator from pages of ProvisionedUsers so they exist before their first login.
+
+    Each page is handled with one query for the existing users, one bulk_create of the new AuthenticatorUsers and the
+    bulk updates of reevaluate_batch, which also evaluates the maps and reconciles the users the same way a login would.
+    The local users are created with upsert_user so their post_save signals (i.e. the resource registry) still fire.
+    Only one page is held in memory at a time. With dry_run nothing is written and the report says what would happen.
+    '''
+    program = compiled_map_cache.get(authenticator.id)
+    report = ClaimsChangeReport()
+    created = 0
+    for page in pages:
+        if not page:
+            continue
+        report.users += len(page)
+        with transaction.atomic():
+            batch, page_created = _provision_page(authenticator, page, dry_run)
+            created += page_created
+            reevaluate_batch(program, authenticator, batch, report, dry_run)
+        logger.debug(f"Provisioned a page of {len(page)} users from authenticator {authenticator.name}")
+
+    logger.info(f"Provisioned {report.users} users of authenticator {authenticator.name}, {created} were new (dry run: {dry_run})")
+    return {**report.as_dict(), 'created': created}
+
+
+def _provision_page(authenticator: Authenticator, page: list, dry_run: bool) -> (list, int):
+    existing = {
+        authenticator_user.uid: authenticator_user
+        for authenticator_user in AuthenticatorUser.objects.filter(provider=authenticator, uid__in=[user.uid for user in page]).select_related('user')
+    }
+
+    batch = []
+    changed = []
+    new_authenticator_users = []
+    for provisioned in page:
+        authenticator_user = existing.get(provisioned.uid, None)
+        if authenticator_user is not None:
+            extra_data = dict(provisioned.extra_data)
+            # The user was not authenticated by this so don't lose when they last were
+            if 'auth_time' in authenticator_user.extra_data:
+                extra_data['auth_time'] = authenticator_user.extra_data['auth_time']
+            if authenticator_user.extra_data != extra_data or authenticator_user.groups != provisioned.groups:
+                authenticator_user.extra_data = extra_data
+                authenticator_user.groups = list(provisioned.groups)
+                changed.append(authenticator_user)
+            batch.append(authenticator_user)
+            continue
+
+        # ensure the authenticator isn't trying to pass along a cheeky is_superuser in the details
+        details = {key: provisioned.details.get(key, "") for key in ["first_name", "last_name", "email"]}
+        username = get_local_username(provisioned.details, authenticator)
+        if dry_run:
+            user = get_user_model()(username=username, **details)
+        else:
+            user, _ = upsert_user(username, details)
+        authenticator_user = AuthenticatorUser(
+            user=user, uid=provisioned.uid, provider=authenticator, extra_data=provisioned.extra_data, groups=list(provisioned.groups)
+        )
+        new_authenticator_users.append(authenticator_user)
+        batch.append(authenticator_user)
+
+    if dry_run:
+        return batch, len(new_authenticator_users)
+
+    # Like a login add the users to the authenticator, an existing AuthenticatorUser (i.e. from a denied login) may not have been
+    Through = Authenticator.users.through
+    Through.objects.bulk_create(
+        [Through(authenticator_id=authenticator.id, user_id=authenticator_user.user_id) for authenticator_user in batch], ignore_conflicts=True
+    )
+
+    if changed:
+        AuthenticatorUser.objects.bulk_update(changed, ['extra_data', 'groups'])
+    if new_authenticator_users:
+        # A user who logs in while we provision may have been linked already, we pick up their row below
+        AuthenticatorUser.objects.bulk_create(new_authenticator_users, ignore_conflicts=True)
+        # Not every database gives us the ids from a bulk insert and bulk_update needs them
+        created = AuthenticatorUser.objects.filter(provider=authenticator, uid__in=[user.uid for user in new_authenticator_users]).select_related('user')
+        created = {authenticator_user.uid: authenticator_user for authenticator_user in created}
+        batch = [created.get(authenticator_user.uid, authenticator_user) for authenticator_user in batch]
+    return batch, len(new_authenticator_users)
@@ -0,0 +1,47 @@
+import logging
+
+from django.db import transaction
+from django.utils.timezone import now
+
+from ansible_base.authentication.models import ReconciliationJob
+from ansible_base.authentication.utils.claims import get_reconcile_class
+
+logger = logging.getLogger('ansible_base.authentication.utils.reconciliation')
+
+
+def process_reconciliation_queue(batch_size: int = 100) -> int:
+    '''
+    Reconciles up to batch_size of the queued users (oldest first) and removes their jobs, returns the number of users reconciled.
+
+    Each job is locked (with skip_locked) and deleted in the same transaction which reconciles its user, so several workers can
+    drain the queue at the same time without picking up the same users and a job is only removed once its user was reconciled.
+    If the process dies part way through a batch the jobs it did not finish are still queued. A login queueing a user who is
+    being reconciled waits for that user's transaction and then queues them again. A job which fails to reconcile is moved to the
+    back of the queue so it can't hold up the users behind it.
+    '''
+    job_ids = list(ReconciliationJob.objects.order_by('queued', 'id').values_list('id', flat=True)[:batch_size])
+
+    reconcile_class = get_reconcile_class()
+    reconciled = 0
+    for job_id in job_ids:
+        job = None
+        try:
+            with transaction.atomic():
+                job = (
+                    ReconciliationJob.objects.select_for_update(skip_locked=True, of=('self',))
+                    .select_related('user', 'authenticator_user')
+                    .filter(id=job_id)
+                    .first()
+                )
+                if job is None:
+                    # Another worker is reconciling (or already reconciled) this user
+                    continue
+                reconcile_class.reconcile_user_claims(job.user, job.authenticator_user)
+                job.delete()
+            reconciled += 1
+        except Exception as e:
+            logger.error(f"Failed to reconcile user attributes of {job.user.username if job else f'job {job_id}'}! {e}")
+            ReconciliationJob.objects.filter(id=job_id).update(queued=now())
+
+    logger.debug(f"Reconciled {reconciled} of {len(job_ids)} queued users")
+    return reconciled
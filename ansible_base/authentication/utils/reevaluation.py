@@ -0,0 +1,231 @@
+import json
+import logging
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from django.db import transaction
+
+from ansible_base.authentication.models import Authenticator, AuthenticatorUser
+from ansible_base.authentication.utils.authenticator_maps import AuthenticatorMapProgram, compiled_map_cache
+from ansible_base.authentication.utils.claims import evaluate_claims, reconcile_user_claims
+
+logger = logging.getLogger('ansible_base.authentication.utils.reevaluation')
+
+# Each worker of the process pool gets the compiled maps once when it starts instead of with every user
+_worker_program = None
+_worker_authenticator_name = None
+
+
+def _init_worker(program: AuthenticatorMapProgram, authenticator_name: str) -> None:
+    global _worker_program, _worker_authenticator_name
+    _worker_program = program
+    _worker_authenticator_name = authenticator_name
+
+
+def _evaluate_in_worker(user_data: tuple) -> dict:
+    username, attrs, groups = user_data
+    return evaluate_claims(_worker_program, _worker_authenticator_name, username, attrs, groups)
+
+
+class ClaimsChangeReport:
+    '''
+    Counts how many users would gain or lose each flag, organization and team
+    '''
+
+    def __init__(self):
+        self.users = 0
+        self.changed = 0
+        self.skipped = 0
+        self.flags = defaultdict(lambda: {'gained': 0, 'lost': 0})
+        self.organizations = defaultdict(lambda: {'gained': 0, 'lost': 0})
+        self.teams = defaultdict(lambda: defaultdict(lambda: {'gained': 0, 'lost': 0}))
+
+    @staticmethod
+    def _count(counts: dict, old_value, new_value) -> bool:
+        if bool(old_value) == bool(new_value):
+            return False
+        counts['gained' if new_value else 'lost'] += 1
+        return True
+
+    def record(self, old_values: dict, new_values: dict) -> bool:
+        '''
+        Records the difference between a users current values and the re-evaluated ones, returns True if anything changed
+        '''
+        changed = False
+        for flag in ['access_allowed', 'is_superuser', 'is_system_auditor']:
+            if new_values[flag] is None:
+                # The maps don't say anything about this flag so it is left alone
+                continue
+            changed = self._count(self.flags[flag], old_values.get(flag, None), new_values[flag]) or changed
+
+        old_claims = old_values.get('claims', None) or {}
+        new_claims = new_values['claims']
+        old_organizations = old_claims.get('organization_membership', {})
+        new_organizations = new_claims['organization_membership']
+        for organization in set(old_organizations) | set(new_organizations):
+            changed = self._count(self.organizations[organization], old_organizations.get(organization), new_organizations.get(organization)) or changed
+
+        old_teams = old_claims.get('team_membership', {})
+        new_teams = new_claims['team_membership']
+        for organization in set(old_teams) | set(new_teams):
+            old_org_teams = old_teams.get(organization, {})
+            new_org_teams = new_teams.get(organization, {})
+            for team in set(old_org_teams) | set(new_org_teams):
+                changed = self._count(self.teams[organization][team], old_org_teams.get(team), new_org_teams.get(team)) or changed
+
+        if changed:
+            self.changed += 1
+        return changed
+
+    def as_dict(self) -> dict:
+        return {
+            'users': self.users,
+            'changed': self.changed,
+            'skipped': self.skipped,
+            'flags': dict(self.flags),
+            'organizations': dict(self.organizations),
+            'teams': {organization: dict(teams) for organization, teams in self.teams.items()},
+        }
+
+
+def _get_target(user, authenticator_user, attribute: str):
+    # This mirrors where update_user_claims stores each of the results
+    if hasattr(user, attribute):
+        return user
+    if hasattr(authenticator_user, attribute):
+        return authenticator_user
+    return None
+
+
+def reevaluate_claims(
+    authenticator: Authenticator, dry_run: bool = True, batch_size: int = 1000, processes: int = 1, after: int = 0, limit: Optional[int] = None
+) -> dict:
+    '''
+    Re-runs the authenticator maps for every user of an authenticator using the attributes and groups stored on their last login.
+
+    Users are streamed from the database in batches of batch_size, evaluated (in a pool of processes if processes > 1)
+    and any changes are written back with bulk_update. With dry_run nothing is written, the returned report is the same either way.
+
+    With a limit only the first limit authenticator users with a pk greater than after are re-evaluated and the report gets a
+    'next' key, the pk to pass as after to continue or None once every user was seen.
+    '''
+    program = compiled_map_cache.get(authenticator.id)
+    needs_groups = len(program.group_maps) > 0
+    report = ClaimsChangeReport()
+
+    executor = None
+    if processes > 1:
+        # Fork so the workers start with Django already setup, they only evaluate and never touch the database
+        executor = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context('fork'), initializer=_init_worker, initargs=(program, authenticator.name)
+        )
+
+    try:
+        batch = []
+        next_pk = last_pk = None
+        authenticator_users = AuthenticatorUser.objects.filter(provider=authenticator, pk__gt=after).select_related('user').order_by('pk')
+        if limit is not None:
+            # Fetch one extra user to know if there is another page
+            authenticator_users = authenticator_users[: limit + 1]
+        # iterator uses a server side cursor on databases which support it so we never hold all of the users in memory
+        for authenticator_user in authenticator_users.iterator(chunk_size=batch_size):
+            if limit is not None and report.users >= limit:
+                next_pk = last_pk
+                break
+            report.users += 1
+            last_pk = authenticator_user.pk
+            if needs_groups and authenticator_user.groups is None:
+                # The user has not logged in since we started storing groups, we can't tell what the group maps would do
+                report.skipped += 1
+                continue
+            batch.append(authenticator_user)
+            if len(batch) >= batch_size:
+                reevaluate_batch(program, authenticator, batch, report, dry_run, processes, executor)
+                batch = []
+        if batch:
+            reevaluate_batch(program, authenticator, batch, report, dry_run, processes, executor)
+    finally:
+        if executor:
+            executor.shutdown()
+
+    logger.info(f"Re-evaluated claims of {report.users} users of authenticator {authenticator.name}, {report.changed} changed (dry run: {dry_run})")
+    result = report.as_dict()
+    if limit is not None:
+        result['next'] = next_pk
+    return result
+
+
+def reevaluate_batch(
+    program: AuthenticatorMapProgram,
+    authenticator: Authenticator,
+    batch: list,
+    report: ClaimsChangeReport,
+    dry_run: bool,
+    processes: int = 1,
+    executor=None,
+) -> None:
+    '''
+    Evaluates the maps for a batch of AuthenticatorUsers (with their users) from their stored attributes and groups,
+    writes the changes with one bulk_update per table and reconciles the users whose claims changed.
+    '''
+    user_data = [(authenticator_user.user.username, authenticator_user.extra_data, authenticator_user.groups or []) for authenticator_user in batch]
+    if executor:
+        results = executor.map(_evaluate_in_worker, user_data, chunksize=max(1, len(user_data) // (processes * 4)))
+    else:
+        results = (evaluate_claims(program, authenticator.name, *data) for data in user_data)
+
+    changed = []
+    changed_users = []
+    changed_authenticator_users = []
+    user_fields = set()
+    authenticator_user_fields = set()
+    for authenticator_user, new_values in zip(batch, results):
+        user = authenticator_user.user
+        old_values = {}
+        for attribute in new_values.keys():
+            if target := _get_target(user, authenticator_user, attribute):
+                old_values[attribute] = getattr(target, attribute, None)
+
+        report.record(old_values, new_values)
+        if dry_run:
+            continue
+
+        dirty_targets = set()
+        for attribute, value in new_values.items():
+            target = _get_target(user, authenticator_user, attribute)
+            if value is None or target is None:
+                continue
+            if isinstance(value, (dict, list)):
+                # Match what comes back out of a JSONField (i.e. the map ids in last_login_map_results become strings)
+                value = json.loads(json.dumps(value))
+            if old_values[attribute] == value:
+                continue
+            setattr(target, attribute, value)
+            dirty_targets.add(id(target))
+            if target is user:
+                user_fields.add(attribute)
+            else:
+                authenticator_user_fields.add(attribute)
+
+        if dirty_targets:
+            changed.append(authenticator_user)
+        if id(user) in dirty_targets:
+            changed_users.append(user)
+        if id(authenticator_user) in dirty_targets:
+            changed_authenticator_users.append(authenticator_user)
+
+    if not changed:
+        return
+
+    with transaction.atomic():
+        if changed_users:
+            type(changed_users[0]).objects.bulk_update(changed_users, sorted(user_fields))
+        if changed_authenticator_users:
+            AuthenticatorUser.objects.bulk_update(changed_authenticator_users, sorted(authenticator_user_fields))
+
+    # Give the application a chance to apply the new claims the same way it does on login
+    for authenticator_user in changed:
+        if authenticator_user.access_allowed is True:
+            reconcile_user_claims(authenticator_user.user, authenticator_user)
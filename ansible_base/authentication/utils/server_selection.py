@@ -0,0 +1,105 @@
+import logging
+import time
+
+from ansible_base.authentication.utils.circuit_breaker import LATENCY_WEIGHT
+from ansible_base.authentication.utils.versions import get_authentication_cache
+from ansible_base.lib.utils.settings import get_setting
+
+logger = logging.getLogger('ansible_base.authentication.utils.server_selection')
+
+
+class ServerSelector:
+    '''
+    Tracks the latency and errors of each server of an authenticator (i.e. the SERVER_URI list of LDAP) in the authentication
+    cache so that all of the workers share them.
+
+    Servers are tried fastest first. A server which fails to answer is demoted for ANSIBLE_BASE_AUTHENTICATOR_SERVER_COOLDOWN
+    seconds, during that time it is only tried after all of the other servers.
+    '''
+
+    def __init__(self, authenticator_id: int, servers: list):
+        self.authenticator_id = authenticator_id
+        self.servers = list(servers)
+        self.key = f'ansible_base.authentication.servers.{authenticator_id}'
+
+    @property
+    def cooldown(self) -> int:
+        return get_setting('ANSIBLE_BASE_AUTHENTICATOR_SERVER_COOLDOWN', 60)
+
+    def _get(self) -> dict:
+        return get_authentication_cache().get(self.key, None) or {}
+
+    def _set(self, stats: dict) -> None:
+        get_authentication_cache().set(self.key, stats, timeout=None)
+
+    @staticmethod
+    def _new_server_state() -> dict:
+        return {
+            'average_latency': None,
+            'successes': 0,
+            'failures': 0,
+            'consecutive_failures': 0,
+            'demoted_until': None,
+            'last_error': None,
+        }
+
+    def get_state(self) -> list:
+        '''
+        Returns the stats of every server in the order they would be tried
+        '''
+        stats = self._get()
+        now = time.time()
+        state = []
+        for server in self.ordered(stats):
+            server_state = stats.get(server, None) or self._new_server_state()
+            server_state['server'] = server
+            server_state['demoted'] = bool(server_state['demoted_until'] and server_state['demoted_until'] > now)
+            state.append(server_state)
+        return state
+
+    def ordered(self, stats: dict = None) -> list:
+        '''
+        Returns the servers in the order they should be tried: the healthy servers, fastest first, followed by the demoted servers.
+        Servers we have no latency for yet are tried first so that every server gets measured, ties keep the configured order.
+        '''
+        if stats is None:
+            stats = self._get()
+        now = time.time()
+
+        def sort_key(indexed_server):
+            index, server = indexed_server
+            server_state = stats.get(server, None) or {}
+            demoted_until = server_state.get('demoted_until', None) or 0
+            if demoted_until > now:
+                # The server which comes back first is the next best bet
+                return (1, demoted_until, index)
+            return (0, server_state.get('average_latency', None) or 0, index)
+
+        return [server for _, server in sorted(enumerate(self.servers), key=sort_key)]
+
+    def record_success(self, server: str, latency: float) -> None:
+        stats = self._get()
+        server_state = stats.setdefault(server, self._new_server_state())
+        if server_state['demoted_until']:
+            logger.info(f'Server {server} of authenticator with ID "{self.authenticator_id}" is responding again')
+        server_state['successes'] += 1
+        server_state['consecutive_failures'] = 0
+        server_state['demoted_until'] = None
+        if server_state['average_latency'] is None:
+            server_state['average_latency'] = latency
+        else:
+            server_state['average_latency'] = (1 - LATENCY_WEIGHT) * server_state['average_latency'] + LATENCY_WEIGHT * latency
+        self._set(stats)
+
+    def record_failure(self, server: str, error) -> None:
+        stats = self._get()
+        server_state = stats.setdefault(server, self._new_server_state())
+        server_state['failures'] += 1
+        server_state['consecutive_failures'] += 1
+        server_state['demoted_until'] = time.time() + self.cooldown
+        server_state['last_error'] = str(error)
+        logger.warning(f'Server {server} of authenticator with ID "{self.authenticator_id}" failed, trying it last for {self.cooldown} seconds: {error}')
+        self._set(stats)
+
+    def reset(self) -> None:
+        get_authentication_cache().delete(self.key)
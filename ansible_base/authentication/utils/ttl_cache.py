@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    '''
+    A thread safe in memory cache where every entry expires timeout seconds after it was set.
+    Once max_size entries are stored the least recently used entry is dropped to make room.
+    '''
+
+    def __init__(self, timeout: float, max_size: int):
+        self.timeout = timeout
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # key -> (expires, value), the least recently used entry is first
+        self.entries = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            expires, value = self.entries.get(key, (None, None))
+            if expires is None:
+                return default
+            if time.monotonic() >= expires:
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.max_size < 1:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,81 @@
+import logging
+from typing import Optional
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Count, Max, QuerySet
+
+from ansible_base.lib.utils.settings import get_setting
+
+logger = logging.getLogger('ansible_base.authentication.utils.versions')
+
+# Bumped whenever any Authenticator is saved or deleted
+AUTHENTICATORS_VERSION = 'authenticators'
+
+
+def get_authentication_cache():
+    '''
+    The cache used to share versions (and other small bits of state) between processes.
+    This should be a cache which is shared by all of the workers (i.e. redis, memcached, database or file based)
+    '''
+    return caches[getattr(settings, 'ANSIBLE_BASE_AUTHENTICATION_CACHE', 'default')]
+
+
+def get_saml_metadata_cache_key(authenticator_id: int) -> str:
+    # This lives here instead of in the SAML plugin so the signal handlers can clear it without importing the plugin
+    return f'ansible_base.authentication.saml_metadata.{authenticator_id}'
+
+
+def is_shared_cache(cache) -> bool:
+    '''
+    Returns if a bump stored in the cache is seen by all of the workers.
+    A per-process cache (LocMemCache) or one which does not store anything (DummyCache) is not, unless
+    ANSIBLE_BASE_AUTHENTICATION_CACHE_SHARED says so (i.e. there is only one process).
+    '''
+    shared = get_setting('ANSIBLE_BASE_AUTHENTICATION_CACHE_SHARED', None)
+    if shared is not None:
+        return bool(shared)
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def get_database_version(queryset: QuerySet) -> str:
+    '''
+    Builds a version token from the rows of a CommonModel queryset, saving (modified_on) or deleting (count) a row changes it
+    '''
+    state = queryset.aggregate(modified_on=Max('modified_on'), count=Count('pk'))
+    return f"{state['modified_on'].isoformat() if state['modified_on'] else None}.{state['count']}"
+
+
+def get_version_key(name: str) -> str:
+    return f'ansible_base.authentication.version.{name}'
+
+
+def get_version(name: str, queryset: Optional[QuerySet] = None) -> str:
+    '''
+    Returns an opaque token for the named version, a different token means that whatever is versioned by name has changed
+
+    If the authentication cache is not shared between the workers they would never see the bumps of each other, so when
+    given the queryset of what is versioned the token is read from the database instead.
+    '''
+    cache = get_authentication_cache()
+    if queryset is not None and not is_shared_cache(cache):
+        return get_database_version(queryset)
+    key = get_version_key(name)
+    version = cache.get(key)
+    if version is None:
+        # Nothing has bumped this version yet (or the cache evicted it), seed a new one so everyone reloads exactly once.
+        # add is used instead of set so that if two processes race here they both end up with the same token.
+        cache.add(key, uuid4().hex, timeout=None)
+        version = cache.get(key)
+        if version is None:
+            # The cache is not storing anything (i.e. a dummy cache) so we have to assume the version always changes
+            logger.debug(f"Unable to store version {name} in the cache, treating it as changed")
+            version = uuid4().hex
+    return version
+
+
+def bump_version(name: str) -> None:
+    get_authentication_cache().set(get_version_key(name), uuid4().hex, timeout=None)
@@ -0,0 +1,179 @@
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+
+from django.db import connections, transaction
+from django.utils.timezone import now
+
+from ansible_base.lib.utils.settings import get_setting
+
+logger = logging.getLogger('ansible_base.authentication.utils.write_behind')
+
+# How many times we try to write a buffered update before we give up on it
+MAX_ATTEMPTS = 3
+
+
+class WriteBehindBuffer:
+    '''
+    Collects the updates of a login which only move a timestamp (i.e. auth_time in extra_data, modified and last_login)
+    and writes them with one bulk_update per model instead of one UPDATE per login.
+
+    The buffer is only used when ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND is True. It lives in the memory of the process and is flushed
+    once it holds ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND_MAX_ENTRIES objects, ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND_INTERVAL seconds
+    after the first update was added and when the process exits. Anything which changes more than a timestamp is written right away.
+    A batch which fails to write is put back in the buffer and tried again with the next flush, up to MAX_ATTEMPTS times.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (model, pk) -> {'fields': {field: value}, 'extra_data': {key: value}}
+        self.entries = {}
+        self.first_added = None
+        self.timer = None
+
+    @property
+    def enabled(self) -> bool:
+        return get_setting('ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND', False)
+
+    @property
+    def interval(self) -> float:
+        return get_setting('ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND_INTERVAL', 5)
+
+    @property
+    def max_entries(self) -> int:
+        return get_setting('ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND_MAX_ENTRIES', 500)
+
+    def add(self, instance, fields: dict, extra_data: Optional[dict] = None) -> None:
+        '''
+        Buffers writing fields on instance. The keys in extra_data are merged into the extra_data the row has when we flush,
+        so a buffered auth_time never writes over attributes another process stored in the meantime.
+        '''
+        with self.lock:
+            entry = self.entries.setdefault((type(instance), instance.pk), {'fields': {}, 'extra_data': {}, 'attempts': 0})
+            entry['fields'].update(fields)
+            entry['extra_data'].update(extra_data or {})
+            full, overdue = self._schedule()
+
+        if full or overdue:
+            # Don't tie the other buffered updates to the transaction of this login
+            transaction.on_commit(self.flush)
+
+    def _schedule(self) -> (bool, bool):
+        # Called with the lock held after entries were added, starts the timer unless the buffer should be flushed right away
+        if self.first_added is None:
+            self.first_added = time.monotonic()
+        full = len(self.entries) >= self.max_entries
+        overdue = time.monotonic() - self.first_added >= self.interval
+        if not (full or overdue):
+            self._start_timer()
+        return full, overdue
+
+    def _start_timer(self) -> None:
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, self.flush_in_thread)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _requeue(self, model, batch: dict) -> None:
+        '''
+        Puts a batch which failed to write back in the buffer, anything buffered for the same object since then is newer and wins
+        '''
+        with self.lock:
+            for pk, entry in batch.items():
+                entry['attempts'] += 1
+                if entry['attempts'] >= MAX_ATTEMPTS:
+                    logger.error(f"Giving up on the buffered login update of {model.__name__} {pk} after {entry['attempts']} attempts")
+                    continue
+                newer = self.entries.get((model, pk), None)
+                if newer is not None:
+                    entry['fields'].update(newer['fields'])
+                    entry['extra_data'].update(newer['extra_data'])
+                self.entries[(model, pk)] = entry
+            if self.entries:
+                if self.first_added is None:
+                    self.first_added = time.monotonic()
+                self._start_timer()
+
+    def discard(self, instance) -> None:
+        '''
+        Drops what is buffered for instance, used when instance is being saved anyway
+        '''
+        if not self.entries:
+            return
+        with self.lock:
+            self.entries.pop((type(instance), instance.pk), None)
+
+    def flush(self) -> None:
+        with self.lock:
+            entries, self.entries = self.entries, {}
+            self.first_added = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not entries:
+            return
+
+        # bulk_update needs the same fields on every object so group the updates by model and fields
+        batches = defaultdict(dict)
+        for (model, pk), entry in entries.items():
+            fields = tuple(sorted(entry['fields']))
+            if entry['extra_data']:
+                fields += ('extra_data',)
+            batches[(model, fields)][pk] = entry
+
+        for (model, fields), batch in batches.items():
+            try:
+                self._write(model, fields, batch)
+            except Exception:
+                logger.exception(f"Failed to write {len(batch)} buffered login updates of {model.__name__}, they will be tried again")
+                self._requeue(model, batch)
+
+    def _write(self, model, fields: tuple, batch: dict) -> None:
+        with transaction.atomic():
+            current = {}
+            if 'extra_data' in fields:
+                current = {obj.pk: obj.extra_data for obj in model.objects.filter(pk__in=list(batch)).only('pk', 'extra_data')}
+            objs = []
+            for pk, entry in batch.items():
+                obj = model(pk=pk)
+                for field, value in entry['fields'].items():
+                    setattr(obj, field, value)
+                if entry['extra_data']:
+                    if pk not in current:
+                        # Deleted since the login
+                        continue
+                    obj.extra_data = {**(current[pk] or {}), **entry['extra_data']}
+                objs.append(obj)
+            model.objects.bulk_update(objs, list(fields))
+        logger.debug(f"Wrote {len(objs)} buffered login updates of {model.__name__}")
+
+    def flush_in_thread(self) -> None:
+        try:
+            self.flush()
+        finally:
+            # The timer thread has its own database connection, don't leave it open
+            connections.close_all()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+login_write_buffer = WriteBehindBuffer()
+atexit.register(login_write_buffer.flush)
+
+
+def save_login(authenticator_user, update_fields: Optional[list] = None) -> None:
+    '''
+    Saves an AuthenticatorUser at the end of a login. With write behind enabled a login which changed nothing but the
+    timestamps (auth_time in extra_data and modified) is buffered instead.
+    '''
+    timestamp_fields = {'extra_data', 'groups', 'modified'}
+    if login_write_buffer.enabled and update_fields is not None and set(update_fields) <= timestamp_fields and authenticator_user.only_auth_time_changed():
+        login_write_buffer.add(authenticator_user, {'modified': now()}, extra_data={'auth_time': authenticator_user.extra_data.get('auth_time', None)})
+        return
+
+    login_write_buffer.discard(authenticator_user)
+    authenticator_user.save(update_fields=update_fields)
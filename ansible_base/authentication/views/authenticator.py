@@ -1,11 +1,17 @@
 import logging
 
 from rest_framework import permissions, status
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
+from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
 from ansible_base.authentication.models import Authenticator, AuthenticatorUser
 from ansible_base.authentication.serializers import AuthenticatorSerializer
+from ansible_base.authentication.utils import reevaluation
+from ansible_base.authentication.utils.circuit_breaker import CircuitBreaker
+from ansible_base.authentication.utils.server_selection import ServerSelector
+from ansible_base.lib.utils.settings import get_setting
 from ansible_base.lib.utils.views.django_app_api import AnsibleBaseDjangoAppApiView
 
 logger = logging.getLogger('ansible_base.authentication.views.authenticator')
@@ -31,3 +37,51 @@ class AuthenticatorViewSet(ModelViewSet, AnsibleBaseDjangoAppApiView):
         else:
             logger.info(f"Deleting authenticator with ID={instance.id}")
             return super().destroy(request, *args, **kwargs)
+
+    @action(detail=True, methods=['get'])
+    def health(self, request, *args, **kwargs):
+        """
+        Returns the circuit breaker state of an authenticator which talks to a remote service
+        """
+        instance = self.get_object()
+        try:
+            plugin = get_authenticator_plugin(instance.type)
+        except ImportError:
+            return Response(status=status.HTTP_404_NOT_FOUND, data={"details": "Failed to load the plugin behind this authenticator"})
+        if not plugin.circuit_breaker_enabled:
+            return Response(status=status.HTTP_404_NOT_FOUND, data={"details": "Authenticator does not track its health"})
+        return Response(CircuitBreaker(instance.id).get_state())
+
+    @action(detail=True, methods=['get'])
+    def servers(self, request, *args, **kwargs):
+        """
+        Returns the latency and error statistics of each server of an authenticator which picks between several servers
+        """
+        instance = self.get_object()
+        try:
+            plugin = get_authenticator_plugin(instance.type)
+        except ImportError:
+            return Response(status=status.HTTP_404_NOT_FOUND, data={"details": "Failed to load the plugin behind this authenticator"})
+        servers = plugin.get_servers(instance)
+        if not servers:
+            return Response(status=status.HTTP_404_NOT_FOUND, data={"details": "Authenticator does not track its servers"})
+        return Response(ServerSelector(instance.id, servers).get_state())
+
+    @action(detail=True, methods=['post'])
+    def reevaluate_claims(self, request, *args, **kwargs):
+        """
+        Re-runs the authenticator maps for one page of the users of the authenticator, by default this is a dry run which only reports the changes.
+        Pass {"dry_run": false} to update the users.
+
+        A page holds at most ANSIBLE_BASE_AUTHENTICATOR_REEVALUATE_PAGE_SIZE users, post the returned "next" as {"after": next}
+        to continue. Use the reevaluate_claims management command to re-evaluate all of the users in one go.
+        """
+        instance = self.get_object()
+        dry_run = request.data.get('dry_run', True)
+        if not isinstance(dry_run, bool):
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"dry_run": "Must be a boolean"})
+        after = request.data.get('after', None) or 0
+        if not isinstance(after, int) or isinstance(after, bool) or after < 0:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"after": "Must be an authenticator user id"})
+        page_size = get_setting('ANSIBLE_BASE_AUTHENTICATOR_REEVALUATE_PAGE_SIZE', 1000)
+        return Response(reevaluation.reevaluate_claims(instance, dry_run=dry_run, batch_size=page_size, after=after, limit=page_size))
@@ -3,10 +3,10 @@ from urllib.parse import urljoin, urlparse
 
 import jwt
 import requests
-from django.contrib.auth import get_user_model
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 
+from ansible_base.lib.utils.models import upsert_user
 from ansible_base.lib.utils.settings import get_setting
 
 logger = logging.getLogger("ansible_base.jwt_consumer.common.auth")
@@ -45,15 +45,15 @@ class JWTCommonAuth:
             timeout=get_setting("ANSIBLE_BASE_JWT_URL_TIMEOUT", 30),
         )
         validated_body = self.validate_token(token, decryption_key)
-        user_model = get_user_model()
-        user, created = user_model.objects.update_or_create(
-            username=validated_body["sub"],
-            defaults={
+        user, created = upsert_user(
+            validated_body["sub"],
+            details={
                 "first_name": validated_body["first_name"],
                 "last_name": validated_body["last_name"],
                 "email": validated_body["email"],
                 "is_superuser": validated_body["is_superuser"],
             },
+            update=True,
         )
 
         if created:
@@ -103,7 +103,7 @@ if 'ansible_base.authentication' in INSTALLED_APPS:
         'social_core.pipeline.user.get_username',
         'social_core.pipeline.user.create_user',
         'social_core.pipeline.social_auth.associate_user',
-        'social_core.pipeline.social_auth.load_extra_data',
+        'ansible_base.authentication.social_auth.load_extra_data',
         'social_core.pipeline.user.user_details',
         'ansible_base.authentication.social_auth.create_user_claims_pipeline',
     )
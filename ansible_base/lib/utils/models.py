@@ -2,6 +2,7 @@ import logging
 from itertools import chain
 
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
 from django.utils.translation import gettext_lazy as _
 from inflection import underscore
 
@@ -72,3 +73,39 @@ def get_system_user():
             )
         )
     return system_user
+
+
+def upsert_user(username: str, details: dict = None, update: bool = False):
+    """
+    Returns (user, created) for the user with username, creating the user if it does not exist yet.
+
+    When the user already exists it is left alone, unless update is True in which case the fields in details which changed
+    are saved (the same as update_or_create). A returning user costs a single SELECT and no transaction.
+
+    A new user is inserted with save() (so CommonModel, the encrypted fields, the signals and any save() of the user model
+    all apply) inside a savepoint. If a login of the same user running in parallel inserted the user between our lookup and
+    our insert, the insert fails on the unique username, is rolled back to the savepoint and we return their user.
+    """
+    model = get_user_model()
+    details = details or {}
+
+    user = model.objects.filter(username=username).first()
+    if user is None:
+        candidate = model(username=username, **details)
+        # New users come from an authenticator so they can't login with a password
+        candidate.set_unusable_password()
+        try:
+            with transaction.atomic():
+                candidate.save(force_insert=True)
+            return candidate, True
+        except IntegrityError:
+            logger.debug(f"User {username} was created by another process, using their user")
+            user = model.objects.get(username=username)
+
+    if update:
+        changed_fields = [field for field, value in details.items() if getattr(user, field) != value]
+        if changed_fields:
+            for field in changed_fields:
+                setattr(user, field, details[field])
+            user.save(update_fields=changed_fields)
+    return user, False
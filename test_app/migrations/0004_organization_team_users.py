@@ -0,0 +1,24 @@
+# Generated by Django 4.2.8 on 2026-10-18 21:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test_app', '0003_create_system_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='users',
+            field=models.ManyToManyField(blank=True, help_text='The users who are members of this organization', related_name='organizations', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='team',
+            name='users',
+            field=models.ManyToManyField(blank=True, help_text='The users who are members of this team', related_name='teams', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -9,6 +9,7 @@ from ansible_base.resource_registry.fields import AnsibleResourceField
 
 class Organization(AbstractOrganization):
     resource = AnsibleResourceField(primary_key_field="id")
+    users = models.ManyToManyField('test_app.User', related_name='organizations', blank=True, help_text="The users who are members of this organization")
 
 
 class User(AbstractUser, CommonModel):
@@ -21,6 +22,7 @@ class User(AbstractUser, CommonModel):
 class Team(AbstractTeam):
     resource = AnsibleResourceField(primary_key_field="id")
     encryptioner = models.ForeignKey('test_app.EncryptionModel', on_delete=models.SET_NULL, null=True)
+    users = models.ManyToManyField('test_app.User', related_name='teams', blank=True, help_text="The users who are members of this team")
 
 
 class ResourceMigrationTestModel(models.Model):
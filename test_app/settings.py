@@ -123,6 +123,9 @@ SECRET_KEY = "asdf1234"
 
 ANSIBLE_BASE_AUTHENTICATOR_CLASS_PREFIXES = ['ansible_base.authentication.authenticator_plugins']
 
+# The tests run in a single process so the local memory cache is shared by everything which uses it
+ANSIBLE_BASE_AUTHENTICATION_CACHE_SHARED = True
+
 from ansible_base.lib import dynamic_config  # noqa: E402
 
 settings_file = os.path.join(os.path.dirname(dynamic_config.__file__), 'dynamic_settings.py')
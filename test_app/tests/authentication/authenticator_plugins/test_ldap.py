@@ -5,10 +5,18 @@ from unittest.mock import MagicMock
 import ldap
 import pytest
 from django.urls import reverse
+from django_auth_ldap import config
+from django_auth_ldap.config import LDAPGroupType, LDAPSearch
 from rest_framework.serializers import ValidationError
 
-from ansible_base.authentication.authenticator_plugins.ldap import AuthenticatorPlugin, LDAPSettings, validate_ldap_filter
-from ansible_base.authentication.models import Authenticator
+from ansible_base.authentication.authenticator_plugins.ldap import (
+    ActiveDirectoryInChainGroupType,
+    AuthenticatorPlugin,
+    LDAPSettings,
+    get_group_type_user_attributes,
+    validate_ldap_filter,
+)
+from ansible_base.authentication.models import Authenticator, AuthenticatorMap
 from ansible_base.authentication.session import SessionAuthentication
 from ansible_base.lib.utils.encryption import ENCRYPTED_STRING
 
@@ -472,3 +480,386 @@ def test_AuthenticatorPlugin_authenticate_start_tls(authenticate, ldap_authentic
         assert backend.settings.CONNECTION_OPTIONS[ldap.OPT_X_TLS_NEWCTX] == newctx_value
     else:
         assert ldap.OPT_X_TLS_NEWCTX not in backend.settings.CONNECTION_OPTIONS
+
+
+@pytest.mark.django_db
+def test_ldap_pooled_user_reuses_bound_connection(ldap_authenticator):
+    from ansible_base.authentication.authenticator_plugins.ldap import PooledLDAPConnection, PooledLDAPUser
+
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    service_connection = MagicMock()
+    user_connection = MagicMock()
+    with mock.patch.object(backend, 'new_connection', side_effect=[service_connection, user_connection]):
+        pool = backend.get_connection_pool()
+        ldap_user = PooledLDAPUser(backend, pool, username="foo")
+        ldap_user._user_dn = "cn=foo,dc=example,dc=org"
+
+        # Searching gets a connection bound as BIND_DN from the pool and the password is checked on its own connection
+        assert ldap_user.connection.ldap_connection is service_connection
+        service_connection.simple_bind_s.assert_called_once_with(backend.settings.BIND_DN, backend.settings.BIND_PASSWORD)
+        ldap_user._authenticate_user_dn("bar")
+        user_connection.simple_bind_s.assert_called_once_with("cn=foo,dc=example,dc=org", "bar")
+        user_connection.unbind_s.assert_called_once()
+
+        ldap_user.release_connection()
+        assert len(pool) == 1
+
+        # The next login gets the same connection without binding again
+        ldap_user = PooledLDAPUser(backend, pool, username="foo")
+        assert ldap_user.connection.ldap_connection is service_connection
+        assert service_connection.simple_bind_s.call_count == 1
+
+        # A connection which lost its server is not put back in the pool
+        service_connection.search_s.side_effect = ldap.SERVER_DOWN()
+        with pytest.raises(ldap.SERVER_DOWN):
+            ldap_user.connection.search_s("dc=example,dc=org", ldap.SCOPE_SUBTREE)
+        assert isinstance(ldap_user._connection, PooledLDAPConnection) and ldap_user._connection.broken
+        ldap_user.release_connection()
+        assert len(pool) == 0
+        service_connection.unbind_s.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_ldap_connection_pool_disabled(ldap_authenticator, settings):
+    settings.ANSIBLE_BASE_LDAP_CONNECTION_POOL_SIZE = 0
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    assert backend.get_connection_pool() is None
+
+
+@pytest.mark.django_db
+def test_ldap_connection_pool_replaced_when_authenticator_changes(ldap_authenticator):
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    pool = backend.get_connection_pool()
+    assert backend.get_connection_pool() is pool
+
+    ldap_authenticator.save()
+    backend.update_if_needed(Authenticator.objects.get(pk=ldap_authenticator.pk))
+    assert backend.get_connection_pool() is not pool
+    assert pool.closed
+
+
+@pytest.mark.django_db
+def test_ldap_lookup_cache(ldap_authenticator):
+    ldap_authenticator.configuration['LOOKUP_CACHE_TIMEOUT'] = 60
+    ldap_authenticator.save()
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    lookup_cache = backend.get_lookup_cache()
+    assert lookup_cache is not None
+
+    user = MagicMock()
+    ldap_user = MagicMock(_username="foo", _user_dn=None, _user_attrs=None)
+
+    def authenticate(ldap_user, password):
+        ldap_user._user_dn = "cn=foo,dc=example,dc=org"
+        ldap_user._user_attrs = {"mail": ["foo@example.org"]}
+        return user
+
+    with mock.patch("ansible_base.authentication.authenticator_plugins.ldap.LDAPBackend.authenticate_ldap_user", side_effect=authenticate):
+        assert backend._authenticate_ldap_user_with_cache(ldap_user, "bar") is user
+    assert lookup_cache.get(("user", "foo", ())) == ("cn=foo,dc=example,dc=org", {"mail": ["foo@example.org"]})
+
+    ldap_user._groups._group_infos = [("cn=admins,dc=example,dc=org", {})]
+    backend.cache_user_groups(ldap_user)
+
+    # The next login starts with the DN, attributes and groups so the directory is only asked to check the password
+    next_ldap_user = MagicMock(_username="foo", _user_dn=None, _user_attrs=None)
+    with mock.patch("ansible_base.authentication.authenticator_plugins.ldap.LDAPBackend.authenticate_ldap_user", return_value=user) as authenticate_mock:
+        assert backend._authenticate_ldap_user_with_cache(next_ldap_user, "bar") is user
+    authenticate_mock.assert_called_once_with(next_ldap_user, "bar")
+    assert next_ldap_user._user_dn == "cn=foo,dc=example,dc=org"
+    assert next_ldap_user._groups._group_infos == [("cn=admins,dc=example,dc=org", {})]
+
+    # Failed logins are never cached
+    with mock.patch("ansible_base.authentication.authenticator_plugins.ldap.LDAPBackend.authenticate_ldap_user", return_value=None):
+        assert backend._authenticate_ldap_user_with_cache(MagicMock(_username="other", _user_dn="cn=other", _user_attrs=None), "bad") is None
+    assert lookup_cache.get(("user", "other", ())) is None
+
+    # Changing the authenticator throws the cache away
+    ldap_authenticator.save()
+    backend.update_if_needed(Authenticator.objects.get(pk=ldap_authenticator.pk))
+    assert backend.get_lookup_cache() is not lookup_cache
+    assert backend.get_lookup_cache().get(("user", "foo", ())) is None
+
+
+@pytest.mark.django_db
+def test_ldap_lookup_cache_disabled_by_default(ldap_authenticator):
+    assert AuthenticatorPlugin(database_instance=ldap_authenticator).get_lookup_cache() is None
+
+
+def test_ldap_in_chain_group_type_single_search():
+    from ansible_base.authentication.authenticator_plugins.ldap import ActiveDirectoryInChainGroupType, get_group_type_class
+
+    assert get_group_type_class('ActiveDirectoryInChainGroupType') is ActiveDirectoryInChainGroupType
+    group_type = ActiveDirectoryInChainGroupType()
+    ldap_user = MagicMock(dn="CN=Jane (Admin),OU=Users,DC=example,DC=org")
+    ldap_user.connection.search_s.return_value = [
+        ("CN=Admins,OU=Groups,DC=example,DC=org", {"cn": [b"Admins"]}),
+        ("CN=Everyone,OU=Groups,DC=example,DC=org", {"cn": [b"Everyone"]}),
+    ]
+    group_search = LDAPSearch("OU=Groups,DC=example,DC=org", ldap.SCOPE_SUBTREE, "(objectClass=group)")
+
+    groups = group_type.user_groups(ldap_user, group_search)
+
+    # Every level of nesting is resolved by the server in one search
+    ldap_user.connection.search_s.assert_called_once_with(
+        "OU=Groups,DC=example,DC=org",
+        ldap.SCOPE_SUBTREE,
+        "(&(objectClass=group)(member:1.2.840.113556.1.4.1941:=CN=Jane \\28Admin\\29,OU=Users,DC=example,DC=org))",
+        None,
+    )
+    assert [group[0] for group in groups] == ["CN=Admins,OU=Groups,DC=example,DC=org", "CN=Everyone,OU=Groups,DC=example,DC=org"]
+
+
+@pytest.mark.parametrize(
+    "search_result,expected",
+    [
+        ([("CN=Admins,OU=Groups,DC=example,DC=org", {})], True),
+        ([], False),
+        (ldap.NO_SUCH_OBJECT(), False),
+    ],
+)
+def test_ldap_in_chain_group_type_is_member(search_result, expected):
+    from ansible_base.authentication.authenticator_plugins.ldap import ActiveDirectoryInChainGroupType
+
+    ldap_user = MagicMock(dn="CN=Jane,OU=Users,DC=example,DC=org")
+    if isinstance(search_result, Exception):
+        ldap_user.connection.search_s.side_effect = search_result
+    else:
+        ldap_user.connection.search_s.return_value = search_result
+
+    assert ActiveDirectoryInChainGroupType().is_member(ldap_user, "CN=Admins,OU=Groups,DC=example,DC=org") is expected
+    ldap_user.connection.search_s.assert_called_once_with(
+        "CN=Admins,OU=Groups,DC=example,DC=org", ldap.SCOPE_BASE, "(member:1.2.840.113556.1.4.1941:=CN=Jane,OU=Users,DC=example,DC=org)", ['1.1']
+    )
+
+
+@pytest.mark.django_db
+def test_ldap_in_chain_group_type_configuration(admin_api_client, ldap_authenticator):
+    config = ldap_authenticator.configuration
+    config["GROUP_TYPE"] = "ActiveDirectoryInChainGroupType"
+    config["GROUP_TYPE_PARAMS"] = {"name_attr": "cn"}
+    url = reverse("authenticator-detail", kwargs={"pk": ldap_authenticator.pk})
+    response = admin_api_client.patch(url, data={"configuration": config}, format="json")
+    assert response.status_code == 200
+
+    backend = AuthenticatorPlugin(database_instance=Authenticator.objects.get(pk=ldap_authenticator.pk))
+    assert type(backend.settings.GROUP_TYPE).__name__ == "ActiveDirectoryInChainGroupType"
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "extra_attributes,group_type,expected",
+    [
+        ([], "MemberDNGroupType", ["department", "givenName", "mail", "sn"]),
+        (["uid"], "MemberDNGroupType", ["department", "givenName", "mail", "sn", "uid"]),
+        ([], "PosixGroupType", ["department", "gidNumber", "givenName", "mail", "sn", "uid"]),
+        (["*"], "MemberDNGroupType", None),
+    ],
+)
+def test_ldap_user_attributes(ldap_authenticator, extra_attributes, group_type, expected):
+    ldap_authenticator.configuration['EXTRA_USER_ATTRIBUTES'] = extra_attributes
+    ldap_authenticator.configuration['GROUP_TYPE'] = group_type
+    if group_type == "PosixGroupType":
+        ldap_authenticator.configuration['GROUP_TYPE_PARAMS'] = {"name_attr": "cn"}
+    ldap_authenticator.save()
+    AuthenticatorMap.objects.create(
+        name="department", authenticator=ldap_authenticator, map_type="is_superuser", triggers={"attributes": {"department": {"equals": "IT"}}}
+    )
+
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    assert backend.get_user_attributes() == expected
+
+
+class NISGroupType(LDAPGroupType):
+    pass
+
+
+class CustomGroupType(LDAPGroupType):
+    pass
+
+
+class CustomPosixGroupType(config.PosixGroupType):
+    pass
+
+
+@pytest.mark.parametrize(
+    "group_type_class,expected",
+    [
+        (None, set()),
+        (config.GroupOfNamesType, set()),
+        (config.NestedActiveDirectoryGroupType, set()),
+        (ActiveDirectoryInChainGroupType, set()),
+        (config.PosixGroupType, {"uid", "gidNumber"}),
+        (CustomPosixGroupType, {"uid", "gidNumber"}),
+        (NISGroupType, {"uid"}),
+        # We can't tell what a group type we don't know reads so it gets all of the attributes
+        (CustomGroupType, None),
+    ],
+)
+def test_ldap_group_type_user_attributes(group_type_class, expected):
+    assert get_group_type_user_attributes(group_type_class) == expected
+
+
+@pytest.mark.django_db
+def test_ldap_user_attributes_unknown_group_type(ldap_authenticator):
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    with mock.patch("ansible_base.authentication.authenticator_plugins.ldap.get_group_type_class", return_value=NISGroupType):
+        assert "uid" in backend.get_user_attributes()
+    with mock.patch("ansible_base.authentication.authenticator_plugins.ldap.get_group_type_class", return_value=CustomGroupType):
+        assert backend.get_user_attributes() is None
+
+
+@pytest.mark.django_db
+def test_ldap_user_search_requests_user_attributes(ldap_authenticator):
+    ldap_authenticator.configuration['USER_SEARCH'] = ["ou=users,dc=example,dc=org", "SCOPE_SUBTREE", "(cn=%(user)s)"]
+    ldap_authenticator.save()
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+
+    with mock.patch("ansible_base.authentication.authenticator_plugins.ldap.LDAPBackend.authenticate", return_value=None):
+        # Logging in twice makes sure the search is built from the configuration every time
+        for _ in range(2):
+            backend.authenticate(None, username="foo", password="bar")
+            assert backend.settings.USER_SEARCH.attrlist == backend.get_user_attributes()
+    assert backend.settings.USER_ATTRLIST == backend.get_user_attributes()
+
+
+def test_ldap_settings_are_frozen(ldap_settings):
+    assert isinstance(ldap_settings.USER_SEARCH, LDAPSearch)
+    assert isinstance(ldap_settings.GROUP_SEARCH, LDAPSearch)
+    with pytest.raises(AttributeError):
+        ldap_settings.USER_ATTRLIST = ["mail"]
+
+
+@pytest.mark.django_db
+def test_ldap_settings_only_built_when_needed(ldap_authenticator):
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    settings = backend.settings
+
+    with mock.patch("ansible_base.authentication.authenticator_plugins.ldap.LDAPBackend.authenticate", return_value=None):
+        backend.authenticate(None, username="foo", password="bar")
+        assert backend.settings is settings
+
+        # A new map can need new attributes so the settings are rebuilt for it
+        AuthenticatorMap.objects.create(
+            name="department", authenticator=ldap_authenticator, map_type="is_superuser", triggers={"attributes": {"department": {"equals": "IT"}}}
+        )
+        backend.authenticate(None, username="foo", password="bar")
+    assert backend.settings is not settings
+    assert "department" in backend.settings.USER_SEARCH.attrlist
+
+
+@pytest.mark.django_db
+@mock.patch("ansible_base.authentication.authenticator_plugins.ldap.config.LDAPSearch", side_effect=Exception("Something went wrong"))
+def test_ldap_settings_search_error(LDAPSearch, ldap_authenticator, shut_up_logging):
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    assert str(backend.settings.error) == "Something went wrong"
+    with mock.patch("ansible_base.authentication.authenticator_plugins.ldap.LDAPBackend.authenticate") as authenticate:
+        assert backend.authenticate(None, username="foo", password="bar") is None
+    authenticate.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_ldap_connect_fails_over_to_next_server(ldap_authenticator):
+    from ansible_base.authentication.utils.server_selection import ServerSelector
+
+    servers = ["ldap://dc1.example.com", "ldap://dc2.example.com"]
+    ldap_authenticator.configuration['SERVER_URI'] = servers
+    ldap_authenticator.save()
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+
+    down_connection = MagicMock()
+    down_connection.simple_bind_s.side_effect = ldap.SERVER_DOWN()
+    up_connection = MagicMock()
+    with mock.patch.object(backend, 'new_connection', side_effect=[down_connection, up_connection]) as new_connection:
+        assert backend.connect("cn=ldapadmin,dc=example,dc=org", "securepassword") is up_connection
+    assert [call.kwargs['uri'] for call in new_connection.call_args_list] == servers
+    down_connection.unbind_s.assert_called_once()
+
+    # The server which was down is tried last until its cooldown is over
+    assert ServerSelector(ldap_authenticator.id, servers).ordered() == list(reversed(servers))
+
+    # A rejected password does not count against the server
+    up_connection.simple_bind_s.side_effect = ldap.INVALID_CREDENTIALS()
+    with mock.patch.object(backend, 'new_connection', return_value=up_connection):
+        with pytest.raises(ldap.INVALID_CREDENTIALS):
+            backend.connect("cn=foo,dc=example,dc=org", "bad")
+    state = {server_state['server']: server_state for server_state in ServerSelector(ldap_authenticator.id, servers).get_state()}
+    assert state[servers[1]]['successes'] == 2
+    assert state[servers[1]]['consecutive_failures'] == 0
+
+
+@pytest.mark.django_db
+def test_ldap_connect_all_servers_down(ldap_authenticator):
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    down_connection = MagicMock()
+    down_connection.simple_bind_s.side_effect = ldap.SERVER_DOWN()
+    with mock.patch.object(backend, 'new_connection', return_value=down_connection):
+        with pytest.raises(ldap.SERVER_DOWN):
+            backend.connect("cn=ldapadmin,dc=example,dc=org", "securepassword")
+
+
+@pytest.mark.django_db
+def test_ldap_servers(admin_api_client, ldap_authenticator):
+    from ansible_base.authentication.utils.server_selection import ServerSelector
+
+    response = admin_api_client.get(reverse('authenticator-detail', kwargs={'pk': ldap_authenticator.id}))
+    servers_url = reverse('authenticator-servers', kwargs={'pk': ldap_authenticator.id})
+    assert response.data['related']['servers'] == servers_url
+
+    ServerSelector(ldap_authenticator.id, ldap_authenticator.configuration['SERVER_URI']).record_success("ldap://ldap06.example.com:389", 0.25)
+    response = admin_api_client.get(servers_url)
+    assert response.status_code == 200
+    assert response.data[0]['server'] == "ldap://ldap06.example.com:389"
+    assert response.data[0]['average_latency'] == 0.25
+    assert response.data[0]['demoted'] is False
+
+
+@pytest.mark.django_db
+def test_ldap_iter_directory_users(ldap_authenticator):
+    from ldap.controls import SimplePagedResultsControl
+
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    assert backend.get_username_attribute() == "cn"
+
+    def page_control(cookie):
+        return SimplePagedResultsControl(True, size=2, cookie=cookie)
+
+    connection = MagicMock()
+    connection.result3.side_effect = [
+        (
+            ldap.RES_SEARCH_RESULT,
+            [
+                ("cn=foo,ou=users,dc=example,dc=org", {"cn": [b"foo"], "mail": [b"foo@example.org"], "givenName": [b"Foo"]}),
+                ("cn=nocn,ou=users,dc=example,dc=org", {"mail": [b"nocn@example.org"]}),
+            ],
+            1,
+            [page_control(b"next page")],
+        ),
+        (ldap.RES_SEARCH_RESULT, [("cn=bar,ou=users,dc=example,dc=org", {"cn": [b"bar"]})], 2, [page_control(b"")]),
+    ]
+    with mock.patch.object(backend, 'connect', return_value=connection):
+        with mock.patch("ansible_base.authentication.authenticator_plugins.ldap._LDAPUser._get_groups") as get_groups:
+            get_groups.return_value.get_group_dns.return_value = {"cn=admins,ou=groups,dc=example,dc=org"}
+            pages = list(backend.iter_directory_users(page_size=2))
+
+    assert [[user.uid for user in page] for page in pages] == [["foo"], ["bar"]]
+    foo = pages[0][0]
+    assert foo.details == {"username": "foo", "email": "foo@example.org", "first_name": "Foo"}
+    assert foo.groups == ["cn=admins,ou=groups,dc=example,dc=org"]
+
+    # The whole directory is walked with the user filter, one page at a time, on one connection
+    first_search, second_search = connection.search_ext.call_args_list
+    assert first_search.args[:3] == ("ou=users,dc=example,dc=org", ldap.SCOPE_SUBTREE, "(cn=*)")
+    assert "cn" in first_search.args[3]
+    assert second_search.kwargs['serverctrls'][0].cookie == b"next page"
+    connection.unbind_s.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_ldap_iter_directory_users_needs_user_search(ldap_authenticator):
+    ldap_authenticator.configuration['USER_SEARCH'] = None
+    ldap_authenticator.save()
+    backend = AuthenticatorPlugin(database_instance=ldap_authenticator)
+    assert backend.get_username_attribute() is None
+    with pytest.raises(ValueError):
+        next(backend.iter_directory_users())
@@ -1,5 +1,7 @@
+import json
 from unittest import mock
 
+import jwt
 import pytest
 from django.urls import reverse
 
@@ -95,3 +97,139 @@ def test_oidc_endpoint_url_validation(
         assert response.json() == expected_error
     else:
         assert response.json()['configuration']['OIDC_ENDPOINT'] == endpoint_url
+
+
+@pytest.fixture
+def oidc_backend(oidc_authenticator):
+    from ansible_base.authentication.authenticator_plugins.oidc import AuthenticatorPlugin
+    from ansible_base.authentication.social_auth import AuthenticatorStorage, AuthenticatorStrategy
+    from ansible_base.authentication.utils.versions import get_authentication_cache
+
+    yield AuthenticatorPlugin(AuthenticatorStrategy(AuthenticatorStorage()), database_instance=oidc_authenticator)
+    for name in ('discovery', 'jwks'):
+        get_authentication_cache().delete(f'ansible_base.authentication.oidc.{oidc_authenticator.id}.{name}')
+
+
+def _response(body, cache_control=None):
+    response = mock.MagicMock()
+    response.json.return_value = body
+    response.text = json.dumps(body)
+    response.headers = {'Cache-Control': cache_control} if cache_control else {}
+    return response
+
+
+@pytest.mark.parametrize(
+    "cache_control, expected",
+    [
+        (None, None),
+        ('max-age=300', 300),
+        ('public, max-age="120"', 120),
+        ('max-age=abc', None),
+        ('no-cache', 0),
+        ('no-store, max-age=300', 0),
+    ],
+)
+def test_oidc_get_max_age(cache_control, expected):
+    from ansible_base.authentication.authenticator_plugins.oidc import get_max_age
+
+    assert get_max_age(_response({}, cache_control)) == expected
+
+
+@pytest.mark.django_db
+def test_oidc_config_is_cached_per_authenticator(oidc_backend):
+    with mock.patch.object(oidc_backend, 'request', return_value=_response({'issuer': 'https://idp.example.com'})) as request:
+        assert oidc_backend.id_token_issuer() == 'https://idp.example.com'
+        assert oidc_backend.oidc_config() == {'issuer': 'https://idp.example.com'}
+    request.assert_called_once_with('https://localhost/api/gateway/callback/oidc_test//.well-known/openid-configuration')
+
+    # Modifying the authenticator drops what we have cached
+    oidc_backend.database_instance.configuration['OIDC_ENDPOINT'] = 'https://idp.example.com'
+    oidc_backend.database_instance.save()
+    with mock.patch.object(oidc_backend, 'request', return_value=_response({'issuer': 'https://other.example.com'})) as request:
+        assert oidc_backend.id_token_issuer() == 'https://other.example.com'
+    request.assert_called_once_with('https://idp.example.com/.well-known/openid-configuration')
+
+
+@pytest.mark.django_db
+def test_oidc_config_honours_cache_control(settings, oidc_backend):
+    settings.ANSIBLE_BASE_OIDC_CACHE_TIMEOUT = 3600
+    settings.ANSIBLE_BASE_OIDC_CACHE_MIN_TIMEOUT = 60
+    with mock.patch('ansible_base.authentication.authenticator_plugins.oidc.time.time', return_value=1000):
+        with mock.patch.object(oidc_backend, 'request', return_value=_response({'issuer': 'one'}, 'max-age=300')):
+            oidc_backend.oidc_config()
+
+    with mock.patch.object(oidc_backend, 'request', return_value=_response({'issuer': 'two'})) as request:
+        with mock.patch('ansible_base.authentication.authenticator_plugins.oidc.time.time', return_value=1299):
+            assert oidc_backend.oidc_config() == {'issuer': 'one'}
+        request.assert_not_called()
+        with mock.patch('ansible_base.authentication.authenticator_plugins.oidc.time.time', return_value=1300):
+            assert oidc_backend.oidc_config() == {'issuer': 'two'}
+        request.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_oidc_config_serves_stale_when_provider_is_down(settings, oidc_backend):
+    from social_core.exceptions import AuthFailed
+
+    settings.ANSIBLE_BASE_OIDC_CACHE_MIN_TIMEOUT = 60
+    with mock.patch('ansible_base.authentication.authenticator_plugins.oidc.time.time', return_value=1000):
+        with mock.patch.object(oidc_backend, 'request', return_value=_response({'issuer': 'one'}, 'no-store')):
+            oidc_backend.oidc_config()
+
+    with mock.patch.object(oidc_backend, 'request', side_effect=AuthFailed(oidc_backend, 'Connection refused')) as request:
+        with mock.patch('ansible_base.authentication.authenticator_plugins.oidc.time.time', return_value=1060):
+            assert oidc_backend.oidc_config() == {'issuer': 'one'}
+            # We wait before trying the provider again
+            assert oidc_backend.oidc_config() == {'issuer': 'one'}
+    request.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_oidc_config_without_cache_raises_when_provider_is_down(oidc_backend):
+    from social_core.exceptions import AuthFailed
+
+    with mock.patch.object(oidc_backend, 'request', side_effect=AuthFailed(oidc_backend, 'Connection refused')):
+        with pytest.raises(AuthFailed):
+            oidc_backend.oidc_config()
+
+
+@pytest.mark.django_db
+def test_oidc_config_only_one_refresh(oidc_backend):
+    from ansible_base.authentication.utils.versions import get_authentication_cache
+
+    with mock.patch('ansible_base.authentication.authenticator_plugins.oidc.time.time', return_value=1000):
+        with mock.patch.object(oidc_backend, 'request', return_value=_response({'issuer': 'one'}, 'no-store')):
+            oidc_backend.oidc_config()
+
+    # Another worker is refreshing the document, we keep using the one we have
+    cache_key = f'ansible_base.authentication.oidc.{oidc_backend.database_instance.id}.discovery'
+    get_authentication_cache().add(f'{cache_key}.refresh', True)
+    try:
+        with mock.patch.object(oidc_backend, 'request') as request:
+            assert oidc_backend.oidc_config() == {'issuer': 'one'}
+        request.assert_not_called()
+    finally:
+        get_authentication_cache().delete(f'{cache_key}.refresh')
+
+
+@pytest.mark.django_db
+def test_oidc_unknown_kid_refreshes_jwks(settings, oidc_backend):
+    settings.ANSIBLE_BASE_OIDC_CACHE_MIN_TIMEOUT = 60
+    old_keys = {'keys': [{'kid': 'old', 'kty': 'oct', 'alg': 'HS256', 'k': 'b2xk'}]}
+    new_keys = {'keys': [{'kid': 'old', 'kty': 'oct', 'alg': 'HS256', 'k': 'b2xk'}, {'kid': 'new', 'kty': 'oct', 'alg': 'HS256', 'k': 'bmV3'}]}
+    oidc_backend.database_instance.configuration['JWKS_URI'] = 'https://idp.example.com/jwks'
+    token = jwt.encode({'sub': 'user'}, 'new', algorithm='HS256', headers={'kid': 'new'})
+
+    with mock.patch('ansible_base.authentication.authenticator_plugins.oidc.time.time', return_value=1000):
+        with mock.patch.object(oidc_backend, 'request', return_value=_response(old_keys)):
+            assert oidc_backend.get_jwks_keys() == old_keys['keys']
+
+        # The keys were just fetched, an unknown kid does not make us fetch them again
+        with mock.patch.object(oidc_backend, 'request', return_value=_response(new_keys)) as request:
+            assert oidc_backend.find_valid_key(token) is None
+        request.assert_not_called()
+
+    with mock.patch('ansible_base.authentication.authenticator_plugins.oidc.time.time', return_value=1060):
+        with mock.patch.object(oidc_backend, 'request', return_value=_response(new_keys)) as request:
+            assert oidc_backend.find_valid_key(token)['kid'] == 'new'
+        request.assert_called_once_with('https://idp.example.com/jwks')
@@ -2,6 +2,7 @@ from unittest import mock
 
 import pytest
 from django.urls import reverse
+from social_core.backends.saml import SAMLAuth
 
 from ansible_base.authentication.session import SessionAuthentication
 from ansible_base.lib.utils.encryption import ENCRYPTED_STRING
@@ -193,3 +194,109 @@ def test_saml_metadata_on_bad_saml_authenticator(admin_api_client, saml_authenti
     headers = response.headers
     assert str(headers['content-type']) == 'text/plain'
     assert response.content.decode("utf-8") == 'Invalid dict settings: sp_acs_not_found'
+
+
+@pytest.mark.django_db
+def test_saml_metadata_is_cached(admin_api_client, saml_authenticator):
+    url = reverse('authenticator-metadata', kwargs={'pk': saml_authenticator.id})
+    with mock.patch('social_core.backends.saml.SAMLAuth.generate_metadata_xml', autospec=True, side_effect=SAMLAuth.generate_metadata_xml) as generate:
+        response = admin_api_client.get(url)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        assert etag.startswith('"') and response.headers['Last-Modified']
+
+        response = admin_api_client.get(url)
+        assert response.status_code == 200
+        assert response.headers['ETag'] == etag
+        assert generate.call_count == 1
+
+        # Conditional requests of the pollers don't get the metadata again
+        response = admin_api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert response.content == b''
+        response = admin_api_client.get(url, HTTP_IF_MODIFIED_SINCE=response.headers['Last-Modified'])
+        assert response.status_code == 304
+        assert generate.call_count == 1
+
+        # A change to the authenticator gives new metadata
+        saml_authenticator.configuration['SP_ENTITY_ID'] = 'https://changed.example.com'
+        saml_authenticator.save()
+        response = admin_api_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert b'https://changed.example.com' in response.content
+        assert generate.call_count == 2
+
+
+@pytest.mark.django_db
+def test_saml_metadata_prepared_on_save(saml_authenticator, django_capture_on_commit_callbacks):
+    from ansible_base.authentication.authenticator_plugins.saml import get_metadata
+
+    with django_capture_on_commit_callbacks(execute=True):
+        saml_authenticator.save()
+
+    with mock.patch('social_core.backends.saml.SAMLAuth.generate_metadata_xml') as generate:
+        metadata = get_metadata(saml_authenticator)
+    generate.assert_not_called()
+    assert metadata['errors'] is None
+    assert b'EntityDescriptor' in metadata['metadata']
+
+
+@pytest.mark.django_db
+def test_saml_metadata_cleared_on_change(saml_authenticator, django_capture_on_commit_callbacks):
+    from ansible_base.authentication.authenticator_plugins.saml import get_metadata
+    from ansible_base.authentication.utils.versions import get_authentication_cache, get_saml_metadata_cache_key
+
+    cache = get_authentication_cache()
+    cache_key = get_saml_metadata_cache_key(saml_authenticator.id)
+    get_metadata(saml_authenticator)
+    assert cache.get(cache_key)['etag']
+
+    # A save drops the cached metadata right away, before it is prepared again once the save was committed
+    with django_capture_on_commit_callbacks(execute=False):
+        saml_authenticator.save()
+    assert cache.get(cache_key) is None
+
+    get_metadata(saml_authenticator)
+    with django_capture_on_commit_callbacks(execute=True):
+        saml_authenticator.delete()
+    assert cache.get(cache_key) is None
+
+
+@pytest.mark.django_db
+def test_saml_metadata_missing_authenticator(admin_api_client):
+    response = admin_api_client.get(reverse('authenticator-metadata', kwargs={'pk': 999999}))
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_saml_settings_are_reused(saml_authenticator, saml_configuration):
+    from django.test.client import RequestFactory
+    from social_core.backends.saml import SAMLIdentityProvider
+
+    from ansible_base.authentication.authenticator_plugins.saml import AuthenticatorPlugin, saml_settings_cache
+    from ansible_base.authentication.social_auth import AuthenticatorStorage, AuthenticatorStrategy
+
+    saml_settings_cache.clear()
+    idp = SAMLIdentityProvider(
+        'IdP', entity_id=saml_configuration['IDP_ENTITY_ID'], url=saml_configuration['IDP_URL'], x509cert=saml_configuration['IDP_X509_CERT']
+    )
+    request = RequestFactory().post('/api/social/complete/', data={})
+    request.session = {}
+
+    def backend(redirect_uri=saml_configuration['CALLBACK_URL']):
+        strategy = AuthenticatorStrategy(AuthenticatorStorage(), request=request)
+        return AuthenticatorPlugin(strategy, database_instance=saml_authenticator, redirect_uri=redirect_uri)
+
+    saml_settings = backend().get_saml_settings(idp)
+    # Every login (each gets its own backend) shares the parsed settings
+    assert backend().get_saml_settings(idp) is saml_settings
+    assert backend()._create_saml_auth(idp).get_settings() is saml_settings
+    assert backend('https://other.example.com/complete/').get_saml_settings(idp) is not saml_settings
+
+    # A change to the authenticator parses the settings again
+    saml_authenticator.configuration['SP_ENTITY_ID'] = 'https://changed.example.com'
+    saml_authenticator.save()
+    new_settings = backend().get_saml_settings(idp)
+    assert new_settings is not saml_settings
+    assert new_settings.get_sp_data()['entityId'] == 'https://changed.example.com'
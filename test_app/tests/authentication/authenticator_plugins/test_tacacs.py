@@ -1,4 +1,5 @@
 from functools import partial
+from socket import AF_INET, AF_INET6, SOCK_STREAM
 from unittest import mock
 from unittest.mock import MagicMock
 
@@ -250,3 +251,230 @@ def test_tacacs_create_authenticator_error_handling(admin_api_client, tacacs_con
                 assert any(value in item for item in response.data[key]), f"Expected error '{value}' in {response.data[key]}"
             else:
                 assert value in response.data[key]
+
+
+@pytest.mark.django_db
+def test_tacacs_authenticate_connection_error_reports_unavailable(tacacs_authenticator):
+    from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
+    from ansible_base.authentication.utils.circuit_breaker import pop_reported_error
+
+    with mock.patch('tacacs_plus.client.TACACSClient.authenticate', side_effect=ConnectionRefusedError("Connection refused")):
+        authenticator_object = get_authenticator_plugin(tacacs_authenticator.type)
+        authenticator_object.update_if_needed(tacacs_authenticator)
+        assert authenticator_object.authenticate(request=RequestFactory(), username='jane', password='doe') is None
+    assert isinstance(pop_reported_error(), ConnectionRefusedError)
+
+
+@pytest.mark.django_db
+def test_tacacs_health(admin_api_client, tacacs_authenticator):
+    from ansible_base.authentication.utils.circuit_breaker import CircuitBreaker
+
+    url = reverse('authenticator-detail', kwargs={'pk': tacacs_authenticator.id})
+    response = admin_api_client.get(url)
+    health_url = reverse('authenticator-health', kwargs={'pk': tacacs_authenticator.id})
+    assert response.data['related']['health'] == health_url
+
+    CircuitBreaker(tacacs_authenticator.id).record_failure(1, "Connection refused")
+    response = admin_api_client.get(health_url)
+    assert response.status_code == 200
+    assert response.data['state'] == 'closed'
+    assert response.data['consecutive_failures'] == 1
+    assert response.data['last_error'] == "Connection refused"
+
+
+@pytest.mark.django_db
+def test_health_on_authenticator_without_circuit_breaker(admin_api_client, local_authenticator):
+    response = admin_api_client.get(reverse('authenticator-health', kwargs={'pk': local_authenticator.id}))
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("tacacs.example.com", ("tacacs.example.com", 49)),
+        ("tacacs.example.com:4949", ("tacacs.example.com", 4949)),
+        ("10.0.0.1", ("10.0.0.1", 49)),
+        ("fd00::1", ("fd00::1", 49)),
+        ("[fd00::1]", ("fd00::1", 49)),
+        ("[fd00::1]:4949", ("fd00::1", 4949)),
+        ("tacacs.example.com:port", ValueError),
+        ("tacacs.example.com:70000", ValueError),
+        (":4949", ValueError),
+    ],
+)
+def test_tacacs_parse_tacacs_host(value, expected):
+    from ansible_base.authentication.authenticator_plugins.tacacs import parse_tacacs_host
+
+    if expected is ValueError:
+        with pytest.raises(ValueError):
+            parse_tacacs_host(value, 49)
+    else:
+        assert parse_tacacs_host(value, 49) == expected
+
+
+@pytest.mark.django_db
+def test_tacacs_failover_hosts_validation(admin_api_client, tacacs_configuration):
+    tacacs_configuration['FAILOVER_HOSTS'] = ['backup.example.com:4949', 'backup.example.com:port']
+    data = {
+        "name": "TACACS authenticator (should not get created)",
+        "enabled": True,
+        "configuration": tacacs_configuration,
+        "type": "ansible_base.authentication.authenticator_plugins.tacacs",
+    }
+    response = admin_api_client.post(reverse("authenticator-list"), data=data, format="json")
+    assert response.status_code == 400
+    assert 'backup.example.com:port does not have a valid port' in str(response.data['FAILOVER_HOSTS'])
+
+
+@pytest.mark.django_db
+def test_tacacs_failover_to_next_host(tacacs_authenticator):
+    from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
+    from ansible_base.authentication.utils.server_selection import ServerSelector
+
+    tacacs_authenticator.configuration['FAILOVER_HOSTS'] = ['backup.example.com', 'other.example.com:4949']
+    tacacs_authenticator.save()
+
+    hosts = []
+
+    def authenticate(client, *args, **kwargs):
+        hosts.append((client.host, client.port))
+        if client.host == 'localhost':
+            raise ConnectionRefusedError("Connection refused")
+        return AuthenticateReponse(True)
+
+    with mock.patch('tacacs_plus.client.TACACSClient.authenticate', autospec=True, side_effect=authenticate):
+        authenticator_object = get_authenticator_plugin(tacacs_authenticator.type)
+        authenticator_object.update_if_needed(tacacs_authenticator)
+        assert authenticator_object.authenticate(request=RequestFactory(), username='jane', password='doe').username == 'jane'
+        assert hosts == [('localhost', 49), ('backup.example.com', 49)]
+
+        # The server which refused the connection is now tried last and the server which was not measured yet goes first
+        hosts.clear()
+        assert authenticator_object.authenticate(request=RequestFactory(), username='jane', password='doe').username == 'jane'
+        assert hosts == [('other.example.com', 4949)]
+
+    state = {server['server']: server for server in ServerSelector(tacacs_authenticator.id, authenticator_object.get_servers(tacacs_authenticator)).get_state()}
+    assert state['localhost:49']['demoted'] is True
+    assert state['localhost:49']['last_error'] == 'Connection refused'
+    assert state['backup.example.com:49']['successes'] == 1
+    assert state['other.example.com:4949']['successes'] == 1
+
+
+@pytest.mark.django_db
+def test_tacacs_all_hosts_unavailable(expected_log, tacacs_authenticator):
+    from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
+    from ansible_base.authentication.utils.circuit_breaker import pop_reported_error
+
+    tacacs_authenticator.configuration['FAILOVER_HOSTS'] = ['backup.example.com']
+    tacacs_authenticator.save()
+    expected_log = partial(expected_log, "ansible_base.authentication.authenticator_plugins.tacacs.logger")
+
+    with mock.patch('tacacs_plus.client.TACACSClient.authenticate', side_effect=[ConnectionRefusedError("refused"), TimeoutError("timed out")]) as authenticate:
+        authenticator_object = get_authenticator_plugin(tacacs_authenticator.type)
+        authenticator_object.update_if_needed(tacacs_authenticator)
+        with expected_log("exception", "TACACS+ Authentication Error"):
+            assert authenticator_object.authenticate(request=RequestFactory(), username='jane', password='doe') is None
+    assert authenticate.call_count == 2
+    assert isinstance(pop_reported_error(), TimeoutError)
+
+
+@pytest.mark.django_db
+def test_tacacs_related_servers(admin_api_client, tacacs_authenticator):
+    tacacs_authenticator.configuration['FAILOVER_HOSTS'] = ['backup.example.com:4949']
+    tacacs_authenticator.save()
+
+    url = reverse('authenticator-detail', kwargs={'pk': tacacs_authenticator.id})
+    servers_url = reverse('authenticator-servers', kwargs={'pk': tacacs_authenticator.id})
+    assert admin_api_client.get(url).data['related']['servers'] == servers_url
+
+    response = admin_api_client.get(servers_url)
+    assert response.status_code == 200
+    assert [server['server'] for server in response.data] == ['localhost:49', 'backup.example.com:4949']
+
+
+_IPV4_ADDRESS = (AF_INET, SOCK_STREAM, 6, '', ('127.0.0.1', 49))
+
+
+@pytest.mark.parametrize(
+    "timeout,connect_timeout,expected_timeout,expected_connect_timeout",
+    [
+        (5, None, 5, 5),
+        (5, 2, 5, 2),
+        (0, None, None, None),
+        (5, 0, 5, None),
+    ],
+)
+def test_tacacs_client_timeouts(timeout, connect_timeout, expected_timeout, expected_connect_timeout):
+    from ansible_base.authentication.authenticator_plugins.tacacs import TimeoutTACACSClient
+
+    client = TimeoutTACACSClient('localhost', 49, 'secret', timeout=timeout, connect_timeout=connect_timeout)
+    with mock.patch('socket.getaddrinfo', return_value=[_IPV4_ADDRESS]), mock.patch('socket.socket') as socket:
+        client.sock
+    socket.return_value.settimeout.assert_has_calls([mock.call(expected_connect_timeout), mock.call(expected_timeout)])
+    socket.return_value.connect.assert_called_once_with(('127.0.0.1', 49))
+
+
+def test_tacacs_client_connect_failure_closes_socket():
+    from ansible_base.authentication.authenticator_plugins.tacacs import TimeoutTACACSClient
+
+    client = TimeoutTACACSClient('localhost', 49, 'secret', timeout=5, connect_timeout=1)
+    with mock.patch('socket.getaddrinfo', return_value=[_IPV4_ADDRESS]), mock.patch('socket.socket') as socket:
+        socket.return_value.connect.side_effect = TimeoutError("timed out")
+        with pytest.raises(TimeoutError):
+            client.sock
+    socket.return_value.close.assert_called_once()
+    assert client._sock is None
+
+
+def test_tacacs_client_ipv6():
+    from ansible_base.authentication.authenticator_plugins.tacacs import TimeoutTACACSClient, parse_tacacs_host
+
+    host, port = parse_tacacs_host('[2001:db8::1]:4949', 49)
+    client = TimeoutTACACSClient(host, port, 'secret', timeout=5)
+    with mock.patch('socket.socket') as socket:
+        client.sock
+    socket.assert_called_once_with(AF_INET6, SOCK_STREAM, mock.ANY)
+    socket.return_value.connect.assert_called_once_with(('2001:db8::1', 4949, 0, 0))
+
+
+def test_tacacs_client_tries_every_address():
+    from ansible_base.authentication.authenticator_plugins.tacacs import TimeoutTACACSClient
+
+    client = TimeoutTACACSClient('tacacs.example.com', 49, 'secret', timeout=5)
+    ipv6_address = (AF_INET6, SOCK_STREAM, 6, '', ('2001:db8::1', 49, 0, 0))
+    with mock.patch('socket.getaddrinfo', return_value=[ipv6_address, _IPV4_ADDRESS]), mock.patch('socket.socket') as socket:
+        # i.e. the host has no IPv6 route, the IPv4 address still answers
+        socket.return_value.connect.side_effect = [OSError("Network is unreachable"), None]
+        assert client.sock is socket.return_value
+    assert socket.call_args_list == [mock.call(AF_INET6, SOCK_STREAM, 6), mock.call(AF_INET, SOCK_STREAM, 6)]
+    socket.return_value.close.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_tacacs_returning_user_queries(tacacs_authenticator, django_assert_num_queries):
+    from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
+    from ansible_base.authentication.models import AuthenticatorUser
+
+    with mock.patch('tacacs_plus.client.TACACSClient.authenticate', return_value=AuthenticateReponse(True)):
+        authenticator_object = get_authenticator_plugin(tacacs_authenticator.type)
+        authenticator_object.update_if_needed(tacacs_authenticator)
+        user = authenticator_object.authenticate(request=RequestFactory(), username='jane', password='doe')
+        assert AuthenticatorUser.objects.filter(uid='jane', user=user, provider=tacacs_authenticator).count() == 1
+
+        with django_assert_num_queries(1):
+            assert authenticator_object.authenticate(request=RequestFactory(), username='jane', password='doe') == user
+
+
+@pytest.mark.django_db
+def test_tacacs_verify_credentials_does_not_create_user(tacacs_authenticator, django_user_model):
+    from ansible_base.authentication.authenticator_plugins.utils import get_authenticator_plugin
+
+    with mock.patch('tacacs_plus.client.TACACSClient.authenticate', return_value=AuthenticateReponse(True)):
+        authenticator_object = get_authenticator_plugin(tacacs_authenticator.type)
+        authenticator_object.update_if_needed(tacacs_authenticator)
+        verified = authenticator_object.verify_credentials(request=RequestFactory(), username='jane', password='doe')
+    assert verified
+    assert not django_user_model.objects.filter(username='jane').exists()
+
+    user = authenticator_object.complete_login(RequestFactory(), verified, username='jane', password='doe')
+    assert user.username == 'jane'
@@ -0,0 +1,41 @@
+import json
+from io import StringIO
+from unittest import mock
+
+import pytest
+from django.core.management import CommandError, call_command
+
+from ansible_base.authentication.models import AuthenticatorUser
+from ansible_base.authentication.utils.provisioning import ProvisionedUser
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "args,error",
+    [
+        (['999'], "Authenticator 999 does not exist"),
+        (['{id}', '--page-size', '0'], "must be at least 1"),
+        (['{id}'], "can not list its users"),
+    ],
+)
+def test_provision_users_command_errors(local_authenticator, args, error):
+    args = [arg.format(id=local_authenticator.id) for arg in args]
+    with pytest.raises(CommandError, match=error):
+        call_command('provision_users', *args)
+
+
+@pytest.mark.django_db
+def test_provision_users_command(local_authenticator):
+    from ansible_base.authentication.authenticator_plugins.local import AuthenticatorPlugin
+
+    def iter_directory_users(self, page_size):
+        assert page_size == 10
+        yield [ProvisionedUser(uid="jdoe", details={"username": "jdoe"}, extra_data={}, groups=[])]
+
+    out = StringIO()
+    with mock.patch.object(AuthenticatorPlugin, 'iter_directory_users', iter_directory_users, create=True):
+        call_command('provision_users', str(local_authenticator.id), '--page-size', '10', stdout=out)
+    report = json.loads(out.getvalue())
+    assert report['users'] == 1
+    assert report['created'] == 1
+    assert AuthenticatorUser.objects.filter(provider=local_authenticator, uid="jdoe").exists()
@@ -0,0 +1,27 @@
+from io import StringIO
+from unittest import mock
+
+import pytest
+from django.core.management import CommandError, call_command
+
+from ansible_base.authentication.models import AuthenticatorUser, ReconciliationJob
+from ansible_base.authentication.utils.claims import queue_reconciliation
+
+
+@pytest.mark.django_db
+def test_reconcile_claims_command_once(local_authenticator, user):
+    authenticator_user = AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator)
+    queue_reconciliation(user, authenticator_user)
+
+    out = StringIO()
+    with mock.patch('ansible_base.authentication.utils.claims.ReconcileUser.reconcile_user_claims') as reconcile:
+        call_command('reconcile_claims', '--once', stdout=out)
+
+    reconcile.assert_called_once_with(user, authenticator_user)
+    assert ReconciliationJob.objects.count() == 0
+    assert "Reconciled 1 users" in out.getvalue()
+
+
+def test_reconcile_claims_command_bad_batch_size():
+    with pytest.raises(CommandError, match="must be at least 1"):
+        call_command('reconcile_claims', '--batch-size', '0')
@@ -0,0 +1,39 @@
+import json
+from io import StringIO
+
+import pytest
+from django.core.management import CommandError, call_command
+
+from ansible_base.authentication.models import AuthenticatorMap, AuthenticatorUser
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("dry_run", [True, False])
+def test_reevaluate_claims_command(local_authenticator, user, dry_run):
+    AuthenticatorMap.objects.create(name="everyone", authenticator=local_authenticator, map_type="is_superuser", triggers={"always": {}})
+    AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator)
+
+    out = StringIO()
+    args = ['reevaluate_claims', str(local_authenticator.id)]
+    if dry_run:
+        args.append('--dry-run')
+    call_command(*args, stdout=out)
+
+    report = json.loads(out.getvalue())
+    assert report['flags']['is_superuser'] == {'gained': 1, 'lost': 0}
+    user.refresh_from_db()
+    assert user.is_superuser is not dry_run
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "args,error",
+    [
+        (['999'], "Authenticator 999 does not exist"),
+        (['{id}', '--batch-size', '0'], "must be at least 1"),
+    ],
+)
+def test_reevaluate_claims_command_errors(local_authenticator, args, error):
+    args = [arg.format(id=local_authenticator.id) for arg in args]
+    with pytest.raises(CommandError, match=error):
+        call_command('reevaluate_claims', *args)
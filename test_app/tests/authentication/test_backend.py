@@ -1,39 +1,401 @@
+import time
 from unittest import mock
 
 import pytest
+from django.utils.timezone import now
 
 import ansible_base.authentication.backend as backend
-from ansible_base.authentication.models import Authenticator
+from ansible_base.authentication.authenticator_plugins.base import AbstractAuthenticatorPlugin
+from ansible_base.authentication.models import Authenticator, AuthenticatorUser
+from ansible_base.authentication.registry import authenticator_registry
+from ansible_base.authentication.utils.versions import AUTHENTICATORS_VERSION, bump_version
 
 
 @pytest.mark.django_db
 def test_authenticator_backends_import_error(ldap_authenticator):
     # Load one item
-    assert len(backend.get_authentication_backends("fake date")) == 1
+    assert len(backend.get_authentication_backends()) == 1
 
     # Change the get_authenticator_plugin to fail, this will cause the backend to not be able to load
-    with mock.patch('ansible_base.authentication.backend.get_authenticator_plugin', side_effect=ImportError("Test Exception")):
-        # Force the cache to get evicted by updating an authenticator.
-        assert len(backend.get_authentication_backends("fake date2")) == 0
+    with mock.patch('ansible_base.authentication.registry.get_authenticator_plugin', side_effect=ImportError("Test Exception")):
+        # Force the registry to reload by bumping the version and dropping the existing plugins
+        authenticator_registry.reset()
+        assert len(backend.get_authentication_backends()) == 0
 
 
 @pytest.mark.django_db
 def test_authenticator_backends_cache(ldap_authenticator):
-    last_modified = Authenticator.objects.values("modified_on").order_by("-modified_on").first()["modified_on"]
-
     # Load one item
-    assert len(backend.get_authentication_backends(last_modified)) == 1
+    assert len(backend.get_authentication_backends()) == 1
 
     # verify that the cache is evicted when an authenticator is updated.
     ldap_authenticator.name = "new_name"
     ldap_authenticator.save()
 
-    last_modified = Authenticator.objects.values("modified_on").order_by("-modified_on").first()["modified_on"]
-    authenticator = backend.get_authentication_backends(last_modified)[ldap_authenticator.pk]
+    authenticator = backend.get_authentication_backends()[ldap_authenticator.pk]
     assert authenticator.database_instance.name == "new_name"
 
-    # verify that the cache is not updated if the last_modified date is the same
-    with mock.patch('ansible_base.authentication.backend.get_authenticator_plugin', side_effect=OSError("Test Exception")):
+    # verify that the cache is not updated if nothing has changed
+    with mock.patch('ansible_base.authentication.registry.get_authenticator_plugin', side_effect=OSError("Test Exception")):
         # If the function reruns, get_authenticator_plugin will throw an exception here
-        authenticator = backend.get_authentication_backends(last_modified)[ldap_authenticator.pk]
+        authenticator = backend.get_authentication_backends()[ldap_authenticator.pk]
         assert authenticator.database_instance.name == "new_name"
+
+
+@pytest.mark.django_db
+def test_authenticator_backends_no_queries_when_unchanged(local_authenticator, django_assert_num_queries):
+    assert list(backend.get_authentication_backends().keys()) == [local_authenticator.id]
+
+    with django_assert_num_queries(0):
+        assert list(backend.get_authentication_backends().keys()) == [local_authenticator.id]
+
+
+@pytest.mark.django_db
+def test_authenticator_backends_only_rebuild_changed(local_authenticator):
+    other_authenticator = Authenticator.objects.create(
+        name="Other Local Authenticator",
+        enabled=True,
+        type="ansible_base.authentication.authenticator_plugins.local",
+        configuration={},
+    )
+    backends = backend.get_authentication_backends()
+    local_plugin = backends[local_authenticator.id]
+    other_plugin = backends[other_authenticator.id]
+
+    other_authenticator.name = "Renamed Local Authenticator"
+    other_authenticator.save()
+
+    with mock.patch.object(local_plugin, 'update_settings') as local_update, mock.patch.object(other_plugin, 'update_settings') as other_update:
+        backends = backend.get_authentication_backends()
+    local_update.assert_not_called()
+    other_update.assert_called_once()
+
+    # The plugin instances themselves are kept
+    assert backends[local_authenticator.id] is local_plugin
+    assert backends[other_authenticator.id] is other_plugin
+    assert other_plugin.database_instance.name == "Renamed Local Authenticator"
+
+
+@pytest.mark.django_db
+def test_authenticator_backends_disable_and_delete(local_authenticator):
+    other_authenticator = Authenticator.objects.create(
+        name="Other Local Authenticator",
+        enabled=True,
+        type="ansible_base.authentication.authenticator_plugins.local",
+        configuration={},
+    )
+    assert len(backend.get_authentication_backends()) == 2
+
+    other_authenticator.enabled = False
+    other_authenticator.save()
+    assert list(backend.get_authentication_backends().keys()) == [local_authenticator.id]
+
+    other_authenticator.delete()
+    local_authenticator.delete()
+    assert len(backend.get_authentication_backends()) == 0
+
+
+@pytest.mark.django_db
+def test_authenticator_backends_reload_on_version_bump(local_authenticator):
+    assert len(backend.get_authentication_backends()) == 1
+
+    # Simulate another process changing an authenticator, the save signal there bumps the shared version
+    Authenticator.objects.filter(id=local_authenticator.id).update(enabled=False)
+    assert len(backend.get_authentication_backends()) == 1
+    bump_version(AUTHENTICATORS_VERSION)
+    assert len(backend.get_authentication_backends()) == 0
+
+
+@pytest.mark.django_db
+def test_authenticator_backends_reload_without_shared_cache(local_authenticator, settings, django_assert_num_queries):
+    settings.ANSIBLE_BASE_AUTHENTICATION_CACHE_SHARED = None
+    assert len(backend.get_authentication_backends()) == 1
+    # Every call checks the authenticators in the database, but doesn't reload them if they are unchanged
+    with django_assert_num_queries(1):
+        assert len(backend.get_authentication_backends()) == 1
+
+    # Simulate another process saving an authenticator, its bump lands in its own local memory cache which we can't see
+    Authenticator.objects.filter(id=local_authenticator.id).update(enabled=False, modified_on=now())
+    assert len(backend.get_authentication_backends()) == 0
+
+
+@pytest.mark.parametrize(
+    "rule,username,expected",
+    [
+        ({"username_suffix": "@example.com"}, "jdoe@example.com", True),
+        ({"username_suffix": "@example.com"}, "jdoe@EXAMPLE.com", True),
+        ({"username_suffix": "@example.com"}, "jdoe@example.org", False),
+        ({"domain": "corp"}, "CORP\\jdoe", True),
+        ({"domain": "corp.example.com"}, "jdoe@corp.example.com", True),
+        ({"domain": "corp.example.com"}, "jdoe@example.com", False),
+        ({"username_regex": "^svc-"}, "svc-backup", True),
+        ({"username_regex": "^svc-"}, "jdoe", False),
+        ({"username_regex": "(unclosed"}, "jdoe", False),
+        ({}, "jdoe", False),
+    ],
+)
+def test_rule_matches_username(rule, username, expected):
+    assert backend.rule_matches_username(rule, username) is expected
+
+
+def _fake_backends(*slugs):
+    backends = {}
+    for index, slug in enumerate(slugs):
+        plugin = mock.MagicMock()
+        plugin.database_instance.slug = slug
+        plugin.circuit_breaker_enabled = False
+        backends[index + 1] = plugin
+    return backends
+
+
+@pytest.mark.parametrize(
+    "username,learned_slug,expected_order",
+    [
+        (None, '', [1, 2, 3]),
+        ("jdoe", '', [1, 2, 3]),
+        ("jdoe@example.com", '', [3, 1, 2]),
+        ("jdoe", 'second', [2, 1, 3]),
+        ("jdoe@example.com", 'second', [3, 2, 1]),
+        ("jdoe@example.com", 'third', [3, 1, 2]),
+        ("jdoe", 'deleted', [1, 2, 3]),
+    ],
+)
+def test_get_routed_backends(settings, username, learned_slug, expected_order):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_ROUTING_RULES = [{"authenticator": "third", "username_suffix": "@example.com"}]
+    backends = _fake_backends('first', 'second', 'third')
+    routed = backend.get_routed_backends(backends, username, learned_slug)
+    assert [authenticator_id for authenticator_id, _ in routed] == expected_order
+
+
+@pytest.mark.django_db
+def test_authenticate_learns_route(local_authenticator, user):
+    first_authenticator = Authenticator.objects.create(
+        name="First Local Authenticator",
+        enabled=True,
+        order=0,
+        type="ansible_base.authentication.authenticator_plugins.local",
+        configuration={},
+    )
+    backends = backend.get_authentication_backends()
+    assert list(backends.keys()) == [first_authenticator.id, local_authenticator.id]
+
+    # Only let the second authenticator accept the user
+    with mock.patch.object(backends[first_authenticator.id], 'authenticate', return_value=None) as first_authenticate:
+        assert backend.AnsibleBaseAuth().authenticate(None, username=user.username, password="password") == user
+    first_authenticate.assert_called_once()
+    assert backend.get_learned_route(user.username) == local_authenticator.slug
+
+    # Now that we know where the user comes from the first authenticator should not be tried
+    with mock.patch.object(backends[first_authenticator.id], 'authenticate', return_value=None) as first_authenticate:
+        assert backend.AnsibleBaseAuth().authenticate(None, username=user.username, password="password") == user
+    first_authenticate.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_get_learned_route_from_authenticator_user(local_authenticator, user):
+    from ansible_base.authentication.models import AuthenticatorUser
+    from ansible_base.authentication.utils.versions import get_authentication_cache
+
+    get_authentication_cache().delete(backend.get_route_cache_key(user.username))
+    AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator)
+    assert backend.get_learned_route(user.username) == local_authenticator.slug
+
+
+class FakePasswordPlugin(AbstractAuthenticatorPlugin):
+    """
+    A password plugin whose verify_credentials answers result after delay seconds
+    """
+
+    circuit_breaker_enabled = False
+
+    def __init__(self, slug, delay=0, result=None):
+        super().__init__(mock.MagicMock(slug=slug, category='password'))
+        self.delay = delay
+        self.result = result
+        self.completed = []
+        self.discarded = []
+        self.get_circuit_breaker = mock.MagicMock()
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        verified = self.verify_credentials(request, username, password, **kwargs)
+        return self.complete_login(request, verified, username, password, **kwargs) if verified else None
+
+    def verify_credentials(self, request, username=None, password=None, **kwargs):
+        time.sleep(self.delay)
+        return self.result
+
+    def complete_login(self, request, verified, username=None, password=None, **kwargs):
+        self.completed.append(verified)
+        return verified
+
+    def discard_login(self, verified):
+        self.discarded.append(verified)
+
+
+def _wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.mark.parametrize(
+    "attempts,expected_winner",
+    [
+        # The lowest order success wins even if a later authenticator answered first
+        ([(0.2, "first"), (0, "second")], 1),
+        ([(0.1, None), (0, "second")], 2),
+        ([(0, None), (0, None)], None),
+        # An authenticator which does not respond in time is skipped
+        ([(2, "first"), (0, "second")], 2),
+    ],
+)
+def test_authenticate_concurrently(settings, attempts, expected_winner):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_TIMEOUT = 0.5
+    backends = {index: FakePasswordPlugin(f'slug{index}', delay, result) for index, (delay, result) in enumerate(attempts, start=1)}
+
+    with mock.patch('ansible_base.authentication.backend.connections'):
+        authenticator_id, authenticator_object, user = backend.AnsibleBaseAuth().authenticate_concurrently(backends, None, username="jdoe", password="pw")
+
+    assert authenticator_id == expected_winner
+    if expected_winner:
+        assert authenticator_object is backends[expected_winner]
+        assert user == attempts[expected_winner - 1][1]
+    else:
+        assert user is None
+    # Only the winner gets to create or update the user
+    for index, plugin in backends.items():
+        assert plugin.completed == ([user] if index == expected_winner else [])
+
+
+def test_authenticate_concurrently_discards_losing_logins():
+    backends = {1: FakePasswordPlugin('first', 0, "first"), 2: FakePasswordPlugin('second', 0.2, "second")}
+
+    with mock.patch('ansible_base.authentication.backend.connections'):
+        authenticator_id, _, user = backend.AnsibleBaseAuth().authenticate_concurrently(backends, None, username="jdoe", password="pw")
+    assert (authenticator_id, user) == (1, "first")
+
+    # The second authenticator also accepted the credentials but lost, it is told to clean up instead of logging the user in
+    assert _wait_for(lambda: backends[2].discarded == ["second"])
+    assert backends[2].completed == []
+
+
+def test_authenticate_concurrently_runs_unverifiable_plugins_in_order():
+    backends = _fake_backends('verifiable', 'unverifiable')
+    backends[1] = FakePasswordPlugin('verifiable', 0, None)
+    backends[2].database_instance.category = 'password'
+    backends[2].authenticate.return_value = "user"
+
+    with mock.patch('ansible_base.authentication.backend.connections'):
+        authenticator_id, _, user = backend.AnsibleBaseAuth().authenticate_concurrently(backends, None, username="jdoe", password="pw")
+    backends[2].authenticate.assert_called_once()
+    assert (authenticator_id, user) == (2, "user")
+
+
+def test_authenticate_concurrently_only_password_authenticators(settings):
+    backends = _fake_backends('sso')
+    backends[1].database_instance.category = 'sso'
+    backends[2] = FakePasswordPlugin('password', 0, "user")
+
+    with mock.patch('ansible_base.authentication.backend.connections'):
+        authenticator_id, _, user = backend.AnsibleBaseAuth().authenticate_concurrently(backends, None, username="jdoe", password="pw")
+    backends[1].authenticate.assert_not_called()
+    assert authenticator_id == 2
+    assert user == "user"
+
+
+@pytest.mark.django_db
+def test_authenticate_uses_concurrent_mode(settings, local_authenticator, user):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_LOGIN = True
+    with mock.patch.object(backend.AnsibleBaseAuth, 'authenticate_concurrently', return_value=(None, None, None)) as concurrently:
+        assert backend.AnsibleBaseAuth().authenticate(None, username=user.username, password="password") is None
+    concurrently.assert_called_once()
+
+
+@pytest.mark.django_db
+def test_authenticate_skips_open_circuit_breaker(settings, tacacs_authenticator, local_authenticator, user):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_THRESHOLD = 2
+    settings.ANSIBLE_BASE_AUTHENTICATOR_LEARN_ROUTES = False
+    breaker = backend.get_authentication_backends()[tacacs_authenticator.id].get_circuit_breaker()
+
+    with mock.patch('tacacs_plus.client.TACACSClient.authenticate', side_effect=ConnectionRefusedError("Connection refused")) as tacacs_authenticate:
+        for _ in range(2):
+            assert backend.AnsibleBaseAuth().authenticate(None, username=user.username, password="password") == user
+        assert tacacs_authenticate.call_count == 2
+        assert breaker.get_state()['state'] == 'open'
+
+        # While the breaker is open the TACACS+ server is not contacted at all
+        assert backend.AnsibleBaseAuth().authenticate(None, username=user.username, password="password") == user
+        assert tacacs_authenticate.call_count == 2
+
+
+@pytest.mark.django_db
+def test_authenticate_invalid_credentials_do_not_open_circuit_breaker(settings, tacacs_authenticator):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_THRESHOLD = 1
+    breaker = backend.get_authentication_backends()[tacacs_authenticator.id].get_circuit_breaker()
+
+    with mock.patch('tacacs_plus.client.TACACSClient.authenticate', return_value=mock.MagicMock(valid=False)):
+        assert backend.AnsibleBaseAuth().authenticate(None, username="jdoe", password="wrong") is None
+    state = breaker.get_state()
+    assert state['state'] == 'closed'
+    assert state['average_latency'] is not None
+
+
+def test_authenticate_concurrently_timeout_counts_against_circuit_breaker(settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_TIMEOUT = 0.1
+    backends = {1: FakePasswordPlugin('slow', 0.5, None)}
+    backends[1].circuit_breaker_enabled = True
+
+    with mock.patch('ansible_base.authentication.backend.connections'):
+        backend.AnsibleBaseAuth().authenticate_concurrently(backends, None, username="jdoe", password="pw")
+    backends[1].get_circuit_breaker.return_value.record_failure.assert_called()
+
+
+@pytest.mark.django_db
+def test_authenticate_adds_user_with_known_route(local_authenticator, user):
+    # A provisioned user has an AuthenticatorUser (which the route is learned from) but was never added to the authenticator
+    AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator)
+    assert backend.get_learned_route(user.username) == local_authenticator.slug
+    assert not local_authenticator.users.exists()
+
+    assert backend.AnsibleBaseAuth().authenticate(None, username=user.username, password="password") == user
+    assert list(local_authenticator.users.all()) == [user]
+
+    # Adding them again is harmless
+    assert backend.AnsibleBaseAuth().authenticate(None, username=user.username, password="password") == user
+    assert list(local_authenticator.users.all()) == [user]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("kwargs", [{"backend": "sso", "username": "jdoe", "password": "pw"}, {"username": "jdoe"}, {"token": "abc"}])
+def test_authenticate_concurrent_mode_only_for_passwords(settings, kwargs):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CONCURRENT_LOGIN = True
+    with mock.patch.object(backend.AnsibleBaseAuth, 'authenticate_concurrently') as concurrently:
+        with mock.patch.object(backend.AnsibleBaseAuth, 'authenticate_in_order', return_value=(None, None, None)) as in_order:
+            assert backend.AnsibleBaseAuth().authenticate(None, **kwargs) is None
+    concurrently.assert_not_called()
+    in_order.assert_called_once()
+
+
+def test_authenticate_concurrently_falls_back_when_pool_is_busy():
+    backends = {1: FakePasswordPlugin('first', 0, None), 2: FakePasswordPlugin('second', 0, "user")}
+
+    # One thread is still stuck in an authenticator from an earlier login
+    executor = backend.LoginExecutor(2)
+    assert executor.reserve(1)
+    with mock.patch('ansible_base.authentication.backend.get_login_executor', return_value=executor):
+        with mock.patch.object(executor, 'submit') as submit:
+            authenticator_id, _, user = backend.AnsibleBaseAuth().authenticate_concurrently(backends, None, username="jdoe", password="pw")
+    submit.assert_not_called()
+    assert authenticator_id == 2
+    assert user == "user"
+    assert executor.busy == 1
+
+
+def test_login_executor_releases_threads(settings):
+    executor = backend.LoginExecutor(2)
+    assert executor.reserve(2)
+    assert not executor.reserve(1)
+    executor.submit(lambda: None).result()
+    executor.submit(lambda: None).result()
+    assert executor.busy == 0
@@ -75,3 +75,91 @@ def test_social_auth_validate_callback_mixin(mocked_generate_slug, mocked_revers
     # should always call reverse if no callback url
     if has_instance and 'configuration' in test_data and not test_data.get('configuration', {}).get('CALLBACK_URL'):
         assert mocked_reverse.called
+
+
+@mock.patch("ansible_base.authentication.social_auth.logger")
+@override_settings(ANSIBLE_BASE_SOCIAL_AUTH_STRATEGY_SETTINGS_FUNCTION='test_app.tests.authentication.test_social_auth.set_settings')
+def test_authenticator_strategy_settings_are_cached(logger, settings):
+    settings.ANSIBLE_BASE_SOCIAL_AUTH_STRATEGY_SETTINGS_CACHE_TIMEOUT = 60
+    with mock.patch('test_app.tests.authentication.test_social_auth.set_settings', wraps=set_settings) as settings_function:
+        strategy = AuthenticatorStrategy(storage=AuthenticatorStorage())
+        strategy.settings['ANOTHER_SETTING'] = 'added'
+        strategy = AuthenticatorStrategy(storage=AuthenticatorStorage())
+    assert strategy.settings == {"A_SETTING": "set"}
+    settings_function.assert_called_once()
+
+
+@mock.patch("ansible_base.authentication.social_auth.logger")
+@override_settings(ANSIBLE_BASE_SOCIAL_AUTH_STRATEGY_SETTINGS_FUNCTION='test_app.tests.authentication.test_social_auth.set_settings')
+def test_authenticator_strategy_settings_cache_timeout(logger, settings):
+    settings.ANSIBLE_BASE_SOCIAL_AUTH_STRATEGY_SETTINGS_CACHE_TIMEOUT = 0
+    with mock.patch('test_app.tests.authentication.test_social_auth.set_settings', wraps=set_settings) as settings_function:
+        AuthenticatorStrategy(storage=AuthenticatorStorage())
+        AuthenticatorStrategy(storage=AuthenticatorStorage())
+    assert settings_function.call_count == 2
+
+
+@pytest.mark.django_db
+def test_get_backend_caches_authenticator_by_slug(oidc_authenticator, django_assert_num_queries):
+    strategy = AuthenticatorStrategy(storage=AuthenticatorStorage())
+    with django_assert_num_queries(1):
+        backend = strategy.get_backend(oidc_authenticator.slug)
+        assert strategy.get_backend(oidc_authenticator.slug).database_instance == backend.database_instance
+    assert backend.database_instance.name == "Test OIDC Authenticator"
+
+    # Saving the authenticator drops it from the cache
+    oidc_authenticator.name = "Renamed OIDC Authenticator"
+    oidc_authenticator.save()
+    with django_assert_num_queries(1):
+        assert strategy.get_backend(oidc_authenticator.slug).database_instance.name == "Renamed OIDC Authenticator"
+
+
+@pytest.mark.django_db
+def test_social_auth_cache_returns_copies(oidc_authenticator, social_auth_cache):
+    authenticator = social_auth_cache.get_authenticator(oidc_authenticator.slug)
+    secret = authenticator.configuration['SECRET']
+    assert not secret.startswith('$encrypted$')
+    assert authenticator is not social_auth_cache.get_authenticator(oidc_authenticator.slug)
+
+    # Changing a returned authenticator (like save() encrypting its configuration) leaves the cached one alone
+    authenticator.configuration['SECRET'] = '$encrypted$'
+    authenticator.name = 'Changed'
+    cached = social_auth_cache.get_authenticator(oidc_authenticator.slug)
+    assert cached.configuration['SECRET'] == secret
+    assert cached.name == oidc_authenticator.name
+
+
+@pytest.mark.django_db
+def test_get_backend_deleted_authenticator(oidc_authenticator):
+    from ansible_base.authentication.models import Authenticator
+
+    strategy = AuthenticatorStrategy(storage=AuthenticatorStorage())
+    slug = oidc_authenticator.slug
+    strategy.get_backend(slug)
+    Authenticator.objects.filter(pk=oidc_authenticator.pk).delete()
+    with pytest.raises(Authenticator.DoesNotExist):
+        strategy.get_backend(slug)
+
+
+@pytest.mark.django_db
+def test_social_pipeline_writes_authenticator_user_once(oidc_authenticator, user):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    from ansible_base.authentication.models import AuthenticatorUser
+    from ansible_base.authentication.social_auth import create_user_claims_pipeline, load_extra_data
+
+    social = AuthenticatorUser.objects.create(uid=user.username, user=user, provider=oidc_authenticator, extra_data={"email": "old@example.com"})
+    social = AuthenticatorUser.objects.get(pk=social.pk)
+    backend = AuthenticatorStrategy(storage=AuthenticatorStorage()).get_backend(oidc_authenticator.slug)
+    table = AuthenticatorUser._meta.db_table
+
+    with CaptureQueriesContext(connection) as queries:
+        with mock.patch.object(backend, 'extra_data', return_value={"email": "new@example.com"}):
+            load_extra_data(backend, {}, {}, user.username, user, social=social)
+        create_user_claims_pipeline(backend=backend, user=user, social=social)
+    assert len([query for query in queries.captured_queries if query['sql'].startswith('UPDATE') and f'"{table}"' in query['sql']]) == 1
+
+    social.refresh_from_db()
+    assert social.extra_data["email"] == "new@example.com"
+    assert "auth_time" in social.extra_data
@@ -0,0 +1,153 @@
+import re
+from unittest import mock
+
+import pytest
+
+from ansible_base.authentication.models import AuthenticatorMap
+from ansible_base.authentication.utils import claims
+from ansible_base.authentication.utils.authenticator_maps import (
+    build_program,
+    compile_authenticator_map,
+    compile_authenticator_maps,
+    compiled_map_cache,
+)
+
+
+@pytest.mark.parametrize(
+    "triggers, expected_triggers, invalid",
+    [
+        ({"always": {}}, {"always": {}}, False),
+        ({"badkey": {}}, {}, True),
+        ({"groups": {"has_or": ["a", "b"], "bad_condition": ["c"]}}, {"groups": {"has_or": frozenset(["a", "b"])}}, False),
+        (
+            {"attributes": {"email": {"in": ["a", "b"]}, "join_condition": "invalid"}},
+            {"attributes": {"join_condition": "or", "email": {"in": frozenset(["a", "b"])}}},
+            False,
+        ),
+        # An attribute which only has invalid conditions can never match so it is dropped
+        ({"attributes": {"email": {"bad_condition": "a"}, "name": {}}}, {"attributes": {"join_condition": "or", "name": {}}}, False),
+        ({"attributes": {"email": {"matches": "(unclosed"}}}, {}, True),
+        ({"attributes": "not a dict"}, {}, True),
+    ],
+)
+def test_compile_authenticator_map(triggers, expected_triggers, invalid):
+    compiled_map = compile_authenticator_map(AuthenticatorMap(id=1, name="map", map_type="is_superuser", triggers=triggers))
+    assert compiled_map.invalid is invalid
+    assert compiled_map.triggers == expected_triggers
+
+
+def test_compile_authenticator_map_regex():
+    compiled_map = compile_authenticator_map(AuthenticatorMap(id=1, name="map", triggers={"attributes": {"email": {"matches": "^JDOE@"}}}))
+    pattern = compiled_map.triggers["attributes"]["email"]["matches"]
+    assert isinstance(pattern, re.Pattern)
+    assert claims.process_user_attributes(compiled_map.triggers["attributes"], {"email": "jdoe@example.com"}, 1) is True
+
+
+@pytest.mark.django_db
+def test_compiled_map_cache_only_compiles_on_change(local_authenticator_map, django_assert_num_queries):
+    authenticator = local_authenticator_map.authenticator
+    assert claims.create_claims(authenticator, "username", {}, [])["is_superuser"] is True
+
+    # Nothing changed so the maps are not loaded again
+    with django_assert_num_queries(0):
+        assert claims.create_claims(authenticator, "username", {}, [])["is_superuser"] is True
+
+    local_authenticator_map.triggers = {"never": {}}
+    local_authenticator_map.save()
+    assert claims.create_claims(authenticator, "username", {}, [])["is_superuser"] is False
+
+    local_authenticator_map.delete()
+    assert claims.create_claims(authenticator, "username", {}, [])["is_superuser"] is None
+
+
+@pytest.mark.django_db
+def test_compiled_map_cache_is_per_authenticator(local_authenticator_map, tacacs_authenticator):
+    program = compiled_map_cache.get(local_authenticator_map.authenticator.id)
+    AuthenticatorMap.objects.create(name="TACACS map", authenticator=tacacs_authenticator, map_type="allow", triggers={"always": {}})
+
+    with mock.patch('ansible_base.authentication.utils.authenticator_maps.compile_authenticator_maps') as compile_maps:
+        assert compiled_map_cache.get(local_authenticator_map.authenticator.id) is program
+    compile_maps.assert_not_called()
+
+
+def test_build_program_group_maps():
+    program = build_program(
+        (
+            compile_authenticator_map(AuthenticatorMap(id=1, name="always", triggers={"always": {}})),
+            compile_authenticator_map(AuthenticatorMap(id=2, name="empty groups", triggers={"groups": {}})),
+            compile_authenticator_map(AuthenticatorMap(id=3, name="empty has_and", triggers={"groups": {"has_and": []}})),
+            compile_authenticator_map(AuthenticatorMap(id=4, name="invalid", triggers={"groups": {"has_or": ["a"]}, "badkey": {}})),
+        )
+    )
+    assert [compiled_map.id for compiled_map in program.group_maps] == [3]
+
+
+@pytest.mark.django_db
+def test_create_claims_groups(local_authenticator):
+    AuthenticatorMap.objects.create(name="admins", authenticator=local_authenticator, map_type="is_superuser", triggers={"groups": {"has_or": ["admins"]}})
+    AuthenticatorMap.objects.create(
+        name="auditors", authenticator=local_authenticator, map_type="is_system_auditor", triggers={"groups": {"has_and": ["auditors", "staff"]}}
+    )
+    AuthenticatorMap.objects.create(
+        name="no contractors", authenticator=local_authenticator, map_type="allow", triggers={"groups": {"has_not": ["contractors"]}}
+    )
+
+    res = claims.create_claims(local_authenticator, "username", {}, ["admins", "auditors"])
+    assert res["is_superuser"] is True
+    assert res["is_system_auditor"] is False
+    assert res["access_allowed"] is True
+
+
+@pytest.mark.parametrize("ignore_group_case", [True, False])
+def test_evaluate_claims_groups_case(ignore_group_case):
+    compiled_maps = (
+        compile_authenticator_map(
+            AuthenticatorMap(id=1, name="admins", map_type="is_superuser", triggers={"groups": {"has_or": ["CN=Admins,OU=Groups,DC=example,DC=com"]}}),
+            ignore_group_case,
+        ),
+        compile_authenticator_map(
+            AuthenticatorMap(id=2, name="auditors", map_type="is_system_auditor", triggers={"groups": {"has_and": ["Auditors", "STAFF"]}}),
+            ignore_group_case,
+        ),
+    )
+    program = build_program(compiled_maps, ignore_group_case)
+    user_groups = ["cn=admins,ou=groups,dc=example,dc=com", "AUDITORS", "Staff"]
+
+    res = claims.evaluate_claims(program, "authenticator", "username", {}, user_groups)
+    # Only authenticators with case insensitive groups (LDAP) match groups which differ in case, for everyone else the case matters
+    assert res["is_superuser"] is ignore_group_case
+    assert res["is_system_auditor"] is ignore_group_case
+
+    res = claims.evaluate_claims(program, "authenticator", "username", {}, ["CN=Admins,OU=Groups,DC=example,DC=com", "Auditors", "STAFF"])
+    assert res["is_superuser"] is True
+    assert res["is_system_auditor"] is True
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("case_insensitive_groups", [True, False])
+def test_compile_authenticator_maps_group_case(local_authenticator, case_insensitive_groups):
+    AuthenticatorMap.objects.create(name="admins", authenticator=local_authenticator, map_type="is_superuser", triggers={"groups": {"has_or": ["Admins"]}})
+
+    plugin_class = mock.Mock(case_insensitive_groups=case_insensitive_groups)
+    with mock.patch('ansible_base.authentication.utils.authenticator_maps.get_authenticator_class', return_value=plugin_class):
+        program = compile_authenticator_maps(local_authenticator.id)
+    assert program.ignore_group_case is case_insensitive_groups
+    assert program.maps[0].triggers["groups"]["has_or"] == frozenset(["admins" if case_insensitive_groups else "Admins"])
+
+
+@pytest.mark.django_db
+def test_compile_authenticator_maps_local_groups_keep_case(local_authenticator):
+    assert compile_authenticator_maps(local_authenticator.id).ignore_group_case is False
+
+
+def test_build_program_attributes():
+    program = build_program(
+        (
+            compile_authenticator_map(
+                AuthenticatorMap(id=1, name="email", triggers={"attributes": {"join_condition": "and", "mail": {"ends_with": "@example.com"}, "title": {}}})
+            ),
+            compile_authenticator_map(AuthenticatorMap(id=2, name="groups", triggers={"groups": {"has_or": ["a"]}, "attributes": {"department": {}}})),
+            compile_authenticator_map(AuthenticatorMap(id=3, name="invalid", triggers={"attributes": {"ignored": {"matches": "("}}})),
+        )
+    )
+    assert program.attributes == frozenset(["mail", "title", "department"])
@@ -0,0 +1,92 @@
+from unittest import mock
+
+import pytest
+
+from ansible_base.authentication.utils.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, pop_reported_error, report_unavailable
+
+
+def test_circuit_breaker_opens_after_threshold(settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_THRESHOLD = 3
+    breaker = CircuitBreaker(1)
+
+    for _ in range(2):
+        breaker.record_failure(1, "Can't contact LDAP server")
+        assert breaker.get_state()['state'] == CLOSED
+        assert breaker.allow_request()
+
+    breaker.record_failure(1, "Can't contact LDAP server")
+    state = breaker.get_state()
+    assert state['state'] == OPEN
+    assert state['consecutive_failures'] == 3
+    assert state['last_error'] == "Can't contact LDAP server"
+    assert not breaker.allow_request()
+
+
+def test_circuit_breaker_success_resets_failures(settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_THRESHOLD = 2
+    breaker = CircuitBreaker(1)
+
+    breaker.record_failure(1, "timeout")
+    breaker.record_success(1)
+    breaker.record_failure(1, "timeout")
+    assert breaker.get_state()['state'] == CLOSED
+
+
+def test_circuit_breaker_threshold_zero_never_opens(settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_THRESHOLD = 0
+    breaker = CircuitBreaker(1)
+    for _ in range(10):
+        breaker.record_failure(1, "timeout")
+    assert breaker.allow_request()
+
+
+def test_circuit_breaker_half_open_allows_one_probe(settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_THRESHOLD = 1
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_COOLDOWN = 60
+    breaker = CircuitBreaker(1)
+    breaker.record_failure(1, "timeout")
+    opened_at = breaker.get_state()['opened_at']
+
+    with mock.patch('ansible_base.authentication.utils.circuit_breaker.time.time', return_value=opened_at + 61):
+        assert breaker.get_state()['state'] == HALF_OPEN
+        # Only the first login gets to probe, everyone else keeps skipping the authenticator
+        assert breaker.allow_request()
+        assert not breaker.allow_request()
+
+        # A failed probe opens the breaker for another cooldown
+        breaker.record_failure(1, "timeout")
+        assert breaker.get_state()['state'] == OPEN
+        assert not breaker.allow_request()
+
+    with mock.patch('ansible_base.authentication.utils.circuit_breaker.time.time', return_value=opened_at + 122):
+        assert breaker.allow_request()
+        breaker.record_success(1)
+
+    assert breaker.get_state()['state'] == CLOSED
+    assert breaker.allow_request()
+
+
+def test_circuit_breaker_tracks_latency():
+    breaker = CircuitBreaker(1)
+    breaker.record_success(1)
+    assert breaker.get_state()['average_latency'] == 1
+    breaker.record_success(2)
+    assert breaker.get_state()['average_latency'] == pytest.approx(1.2)
+
+
+def test_circuit_breakers_are_per_authenticator(settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_CIRCUIT_BREAKER_THRESHOLD = 1
+    CircuitBreaker(1).record_failure(1, "timeout")
+    assert not CircuitBreaker(1).allow_request()
+    assert CircuitBreaker(2).allow_request()
+
+    CircuitBreaker(1).reset()
+    assert CircuitBreaker(1).allow_request()
+
+
+def test_report_unavailable():
+    assert pop_reported_error() is None
+    error = OSError("Connection refused")
+    report_unavailable(error)
+    assert pop_reported_error() is error
+    assert pop_reported_error() is None
@@ -600,3 +600,133 @@ def test_has_access_with_join(current_access, new_access, condition, expected):
 def test_process_user_attributes(trigger_condition, attributes, expected):
     res = claims.process_user_attributes(trigger_condition, attributes, authenticator_id=1337)
     assert res is expected
+
+
+def _writes(captured_queries, table):
+    return [query['sql'] for query in captured_queries if query['sql'].startswith(('UPDATE', 'INSERT')) and f'"{table}"' in query['sql']]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("pass_authenticator_user", [True, False])
+def test_update_user_claims_single_write(local_authenticator_map, user, pass_authenticator_user):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    from ansible_base.authentication.models import AuthenticatorUser
+
+    authenticator = local_authenticator_map.authenticator
+    authenticator_user = AuthenticatorUser.objects.create(uid=user.username, user=user, provider=authenticator, extra_data={"email": "user@example.com"})
+    user_table = user._meta.db_table
+    authenticator_user_table = AuthenticatorUser._meta.db_table
+
+    # The map makes the user a superuser so both the user and authenticator user change
+    with CaptureQueriesContext(connection) as queries:
+        assert claims.update_user_claims(user, authenticator, ["group1"], authenticator_user if pass_authenticator_user else None) == user
+    assert len(_writes(queries.captured_queries, user_table)) == 1
+    assert len(_writes(queries.captured_queries, authenticator_user_table)) == 1
+    looked_up = [query for query in queries.captured_queries if query['sql'].startswith('SELECT') and f'"{authenticator_user_table}"' in query['sql']]
+    assert bool(looked_up) is not pass_authenticator_user
+
+    user.refresh_from_db()
+    authenticator_user.refresh_from_db()
+    assert user.is_superuser is True
+    assert authenticator_user.groups == ["group1"]
+    assert authenticator_user.extra_data["email"] == "user@example.com"
+    assert "auth_time" in authenticator_user.extra_data
+
+    # Nothing changes on the second login so the user is not written at all
+    with CaptureQueriesContext(connection) as queries:
+        claims.update_user_claims(user, authenticator, ["group1"], authenticator_user)
+    assert len(_writes(queries.captured_queries, user_table)) == 0
+    assert len(_writes(queries.captured_queries, authenticator_user_table)) == 1
+
+
+@pytest.mark.django_db
+def test_update_user_claims_uses_extra_data(local_authenticator, user):
+    from ansible_base.authentication.models import AuthenticatorMap, AuthenticatorUser
+
+    AuthenticatorMap.objects.create(
+        name="example admins",
+        authenticator=local_authenticator,
+        map_type="is_superuser",
+        triggers={"attributes": {"email": {"ends_with": "@example.com"}}},
+    )
+    AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator, extra_data={"email": "user@example.com"})
+
+    claims.update_user_claims(user, local_authenticator, [])
+    user.refresh_from_db()
+    assert user.is_superuser is True
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("deferred", [True, False])
+def test_update_user_claims_deferred_reconciliation(settings, local_authenticator, user, deferred):
+    from ansible_base.authentication.models import ReconciliationJob
+
+    settings.ANSIBLE_BASE_AUTHENTICATOR_RECONCILE_DEFERRED = deferred
+    with mock.patch('ansible_base.authentication.utils.claims.ReconcileUser.reconcile_user_claims') as reconcile:
+        # Logging in twice before the queue is processed only queues the user once
+        claims.update_user_claims(user, local_authenticator, [])
+        claims.update_user_claims(user, local_authenticator, [])
+
+    assert reconcile.called is not deferred
+    assert ReconciliationJob.objects.filter(user=user).count() == (1 if deferred else 0)
+
+
+def test_get_reconcile_class_is_cached(settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_RECONCILE_MODULE = 'ansible_base.authentication.utils.claims'
+    assert claims.get_reconcile_class() is claims.ReconcileUser
+    with mock.patch('builtins.__import__', wraps=__import__) as import_mock:
+        assert claims.get_reconcile_class() is claims.ReconcileUser
+    assert not any(call.args[0] == 'ansible_base.authentication.utils.claims' for call in import_mock.call_args_list)
+
+
+@pytest.mark.django_db
+def test_get_or_create_authenticator_user_new_user(local_authenticator):
+    authenticator_user, created = claims.get_or_create_authenticator_user('new_user', {'username': 'new_user'}, local_authenticator, {'dn': 'foo'})
+    assert created is True
+    assert authenticator_user.user.username == 'new_user'
+    assert authenticator_user.extra_data['dn'] == 'foo'
+    assert 'auth_time' in authenticator_user.extra_data
+
+    authenticator_user, created = claims.get_or_create_authenticator_user('new_user', {'username': 'new_user'}, local_authenticator, {'dn': 'bar'})
+    assert created is False
+    assert authenticator_user.extra_data['dn'] == 'bar'
+
+
+@pytest.mark.django_db
+def test_upsert_authenticator_user_lost_race(local_authenticator, random_user):
+    from ansible_base.authentication.models import AuthenticatorUser
+
+    # Another login linked the user between our lookup and our insert
+    AuthenticatorUser.objects.create(uid=random_user.username, user=random_user, provider=local_authenticator, extra_data={'dn': 'first'})
+
+    authenticator_user, created = claims.upsert_authenticator_user(local_authenticator, random_user.username, random_user, {'dn': 'second'})
+    assert created is False
+    assert authenticator_user.extra_data == {'dn': 'second'}
+
+    authenticator_user, created = claims.upsert_authenticator_user(local_authenticator, random_user.username, random_user)
+    assert created is False
+    assert authenticator_user.extra_data == {'dn': 'second'}
+    assert AuthenticatorUser.objects.filter(uid=random_user.username, provider=local_authenticator).count() == 1
+
+
+@pytest.mark.django_db
+def test_update_user_claims_survives_reconcile_database_error(local_authenticator_map, user, django_user_model):
+    from ansible_base.authentication.models import AuthenticatorUser
+
+    authenticator = local_authenticator_map.authenticator
+    authenticator_user = AuthenticatorUser.objects.create(uid=user.username, user=user, provider=authenticator)
+
+    def reconcile(user, authenticator_user):
+        # Violates the unique username, the error leaves the transaction unusable unless reconciliation has its own savepoint
+        django_user_model.objects.create(username=user.username)
+
+    with mock.patch('ansible_base.authentication.utils.claims.ReconcileUser.reconcile_user_claims', side_effect=reconcile):
+        assert claims.update_user_claims(user, authenticator, ["group1"], authenticator_user) == user
+
+    user.refresh_from_db()
+    authenticator_user.refresh_from_db()
+    assert user.is_superuser is True
+    assert authenticator_user.groups == ["group1"]
+    assert "auth_time" in authenticator_user.extra_data
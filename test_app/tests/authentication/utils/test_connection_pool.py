@@ -0,0 +1,137 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from ansible_base.authentication.utils.connection_pool import ConnectionPool, ConnectionPools, ConnectionPoolTimeout
+
+
+class FakeConnections:
+    def __init__(self):
+        self.created = 0
+        self.closed = []
+
+    def connect(self):
+        self.created += 1
+        return f'connection {self.created}'
+
+    def close(self, connection):
+        self.closed.append(connection)
+
+
+def test_connection_pool_reuses_most_recent():
+    connections = FakeConnections()
+    pool = ConnectionPool(connections.connect, connections.close, max_size=2)
+
+    first = pool.acquire()
+    second = pool.acquire()
+    assert connections.created == 2
+    pool.release(first)
+    pool.release(second)
+    assert len(pool) == 2
+
+    assert pool.acquire() == second
+    assert pool.acquire() == first
+    assert connections.created == 2
+
+
+def test_connection_pool_max_size():
+    connections = FakeConnections()
+    pool = ConnectionPool(connections.connect, connections.close, max_size=1, acquire_timeout=0.01)
+
+    first = pool.acquire()
+    # No more than max_size connections are open at once
+    with pytest.raises(ConnectionPoolTimeout):
+        pool.acquire()
+    assert connections.created == 1
+
+    pool.release(first)
+    assert pool.acquire() == first
+    pool.discard(first)
+    assert connections.closed == [first]
+    assert pool.acquire() == 'connection 2'
+
+
+def test_connection_pool_waits_for_release():
+    connections = FakeConnections()
+    pool = ConnectionPool(connections.connect, connections.close, max_size=1, acquire_timeout=5)
+    first = pool.acquire()
+
+    timer = threading.Timer(0.1, pool.release, args=[first])
+    timer.start()
+    assert pool.acquire() == first
+    timer.join()
+
+
+def test_connection_pool_failed_connect_frees_slot():
+    connections = FakeConnections()
+    connect = mock.MagicMock(side_effect=[OSError("Connection refused"), 'connection'])
+    pool = ConnectionPool(connect, connections.close, max_size=1, acquire_timeout=0.01)
+    with pytest.raises(OSError):
+        pool.acquire()
+    assert pool.acquire() == 'connection'
+
+
+def test_connection_pool_idle_eviction():
+    connections = FakeConnections()
+    pool = ConnectionPool(connections.connect, connections.close, max_idle=10)
+
+    with mock.patch('ansible_base.authentication.utils.connection_pool.time.monotonic', return_value=100):
+        pool.release(pool.acquire())
+    with mock.patch('ansible_base.authentication.utils.connection_pool.time.monotonic', return_value=111):
+        assert pool.acquire() == 'connection 2'
+    assert connections.closed == ['connection 1']
+
+
+def test_connection_pool_health_check():
+    connections = FakeConnections()
+    check = mock.MagicMock(side_effect=[Exception("server went away"), True])
+    pool = ConnectionPool(connections.connect, connections.close, check=check, check_after=5)
+
+    with mock.patch('ansible_base.authentication.utils.connection_pool.time.monotonic', return_value=100):
+        first = pool.acquire()
+        pool.release(first)
+        # Recently used connections are not checked
+        assert pool.acquire() == first
+        check.assert_not_called()
+        pool.release(first)
+
+    with mock.patch('ansible_base.authentication.utils.connection_pool.time.monotonic', return_value=106):
+        # The check fails so the connection is closed and a new one is made
+        assert pool.acquire() == 'connection 2'
+    assert connections.closed == [first]
+
+
+def test_connection_pool_close():
+    connections = FakeConnections()
+    pool = ConnectionPool(connections.connect, connections.close)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.close()
+    assert connections.closed == [first]
+
+    # Connections coming back after the pool was closed are closed too
+    pool.release(second)
+    assert connections.closed == [first, second]
+    assert len(pool) == 0
+
+
+def test_connection_pools_versions():
+    pools = ConnectionPools()
+    connections = FakeConnections()
+
+    def create():
+        return ConnectionPool(connections.connect, connections.close)
+
+    pool = pools.get(1, 'v1', create)
+    assert pools.get(1, 'v1', create) is pool
+    assert pools.get(2, 'v1', create) is not pool
+
+    new_pool = pools.get(1, 'v2', create)
+    assert new_pool is not pool
+    assert pool.closed
+
+    pools.remove(1)
+    assert new_pool.closed
+    pools.reset()
+    assert pools.pools == {}
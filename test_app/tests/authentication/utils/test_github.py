@@ -0,0 +1,90 @@
+from unittest import mock
+
+import pytest
+from requests import HTTPError
+from social_core.exceptions import AuthFailed
+
+from ansible_base.authentication.authenticator_plugins.github_org import AuthenticatorPlugin
+from ansible_base.authentication.social_auth import AuthenticatorStorage, AuthenticatorStrategy
+from ansible_base.authentication.utils.versions import get_authentication_cache
+
+MEMBER_URL = 'https://api.github.com/orgs/foo-org/members/bob'
+
+
+@pytest.fixture
+def github_backend(github_organization_authenticator):
+    get_authentication_cache().clear()
+    yield AuthenticatorPlugin(AuthenticatorStrategy(AuthenticatorStorage()), database_instance=github_organization_authenticator)
+    get_authentication_cache().clear()
+
+
+def _response(status_code, etag=None):
+    response = mock.MagicMock()
+    response.status_code = status_code
+    response.headers = {'ETag': etag} if etag else {}
+    if status_code >= 400:
+        response.raise_for_status.side_effect = HTTPError(response=response)
+    return response
+
+
+def _request(*responses):
+    def request(url, headers=None):
+        response = responses[request.calls]
+        request.calls += 1
+        response.raise_for_status()
+        return response
+
+    request.calls = 0
+    return mock.MagicMock(side_effect=request)
+
+
+@pytest.mark.django_db
+def test_member_is_cached_and_revalidated(settings, github_backend):
+    settings.ANSIBLE_BASE_GITHUB_MEMBERSHIP_CACHE_TIMEOUT = 300
+    request = _request(_response(204, '"abc"'), _response(304, '"abc"'))
+    with mock.patch.object(github_backend, 'request', request):
+        with mock.patch('ansible_base.authentication.utils.github.time.time', return_value=1000):
+            assert github_backend.is_member('token', MEMBER_URL) is True
+            assert github_backend.is_member('token', MEMBER_URL) is True
+        assert request.call_count == 1
+        assert 'If-None-Match' not in request.call_args.kwargs['headers']
+
+        # Once the answer expired we ask GitHub if it changed
+        with mock.patch('ansible_base.authentication.utils.github.time.time', return_value=1300):
+            assert github_backend.is_member('token', MEMBER_URL) is True
+        assert request.call_count == 2
+        assert request.call_args.kwargs['headers'] == {'Authorization': 'token token', 'If-None-Match': '"abc"'}
+
+
+@pytest.mark.django_db
+def test_non_member_is_cached(settings, github_backend):
+    settings.ANSIBLE_BASE_GITHUB_NON_MEMBER_CACHE_TIMEOUT = 60
+    request = _request(_response(404), _response(204))
+    with mock.patch.object(github_backend, 'request', request):
+        with mock.patch('ansible_base.authentication.utils.github.time.time', return_value=1000):
+            assert github_backend.is_member('token', MEMBER_URL) is False
+            assert github_backend.is_member('token', MEMBER_URL) is False
+        assert request.call_count == 1
+
+        with mock.patch('ansible_base.authentication.utils.github.time.time', return_value=1060):
+            assert github_backend.is_member('token', MEMBER_URL) is True
+        assert request.call_count == 2
+
+
+@pytest.mark.django_db
+def test_errors_are_not_cached(github_backend):
+    request = _request(_response(502), _response(204))
+    with mock.patch.object(github_backend, 'request', request):
+        with pytest.raises(AuthFailed):
+            github_backend.is_member('token', MEMBER_URL)
+        assert github_backend.is_member('token', MEMBER_URL) is True
+
+
+@pytest.mark.django_db
+def test_user_data_refuses_non_members(github_backend):
+    with mock.patch('social_core.backends.github.GithubOAuth2.user_data', return_value={'login': 'bob', 'email': 'bob@example.com'}):
+        with mock.patch.object(github_backend, 'request', _request(_response(204), _response(404))):
+            assert github_backend.user_data('token')['login'] == 'bob'
+            get_authentication_cache().clear()
+            with pytest.raises(AuthFailed, match="User doesn't belong to the organization"):
+                github_backend.user_data('token')
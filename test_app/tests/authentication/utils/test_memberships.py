@@ -0,0 +1,99 @@
+import pytest
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ansible_base.authentication.models import AuthenticatorUser
+from ansible_base.authentication.utils.memberships import get_membership, reconcile_user_memberships
+from test_app.models import Organization, Team, User
+
+
+@pytest.fixture
+def authenticator_user(local_authenticator, user):
+    return AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator)
+
+
+def test_get_membership_forward_and_reverse():
+    membership = get_membership(Team, 'users')
+    assert membership.through is Team.users.through
+    assert membership.object_field == 'team_id'
+    assert membership.user_field == 'user_id'
+
+    membership = get_membership(Group, 'user_set')
+    assert membership.through is User.groups.through
+    assert membership.object_field == 'group_id'
+    assert membership.user_field == 'user_id'
+
+
+def test_get_membership_not_users(expected_log):
+    with expected_log('ansible_base.authentication.utils.memberships.logger', 'error', 'is not a many to many relation to the users'):
+        assert get_membership(Team, 'organization') is None
+    assert get_membership(Team, 'does_not_exist') is None
+
+
+@pytest.mark.django_db
+def test_reconcile_user_memberships_adds_and_creates(user, authenticator_user, organization):
+    authenticator_user.claims = {
+        'organization_membership': {organization.name: True, 'New Org': True},
+        'team_membership': {organization.name: {'New Team': True, 'Not A Member': False}},
+    }
+    reconcile_user_memberships(user, authenticator_user)
+
+    assert set(user.organizations.values_list('name', flat=True)) == {organization.name, 'New Org'}
+    assert list(user.teams.values_list('organization__name', 'name')) == [(organization.name, 'New Team')]
+    # Teams the user isn't a member of are not created
+    assert not Team.objects.filter(name='Not A Member').exists()
+
+
+@pytest.mark.django_db
+def test_reconcile_user_memberships_create_objects_disabled(user, authenticator_user, local_authenticator):
+    local_authenticator.create_objects = False
+    local_authenticator.save()
+    authenticator_user.claims = {'organization_membership': {'New Org': True}, 'team_membership': {'New Org': {'New Team': True}}}
+    reconcile_user_memberships(user, authenticator_user)
+
+    assert not Organization.objects.filter(name='New Org').exists()
+    assert not Team.objects.filter(name='New Team').exists()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("remove_users", [True, False])
+def test_reconcile_user_memberships_remove_users(user, authenticator_user, local_authenticator, organization, team, remove_users):
+    local_authenticator.remove_users = remove_users
+    local_authenticator.save()
+    other_organization = Organization.objects.create(name='Unmapped')
+    organization.users.add(user)
+    other_organization.users.add(user)
+    team.users.add(user)
+
+    authenticator_user.claims = {
+        'organization_membership': {organization.name: False},
+        'team_membership': {team.organization.name: {team.name: False}},
+    }
+    reconcile_user_memberships(user, authenticator_user)
+
+    assert organization.users.filter(pk=user.pk).exists() is not remove_users
+    assert team.users.filter(pk=user.pk).exists() is not remove_users
+    # Organizations which are not in the claims are never touched
+    assert other_organization.users.filter(pk=user.pk).exists()
+
+
+@pytest.mark.django_db
+def test_reconcile_user_memberships_query_count(user, authenticator_user, organization):
+    teams = Team.objects.bulk_create(
+        [Team(name=f'team {i}', organization=organization, created_on=organization.created_on, modified_on=organization.modified_on) for i in range(300)]
+    )
+    # Start as a member of half of them, the claims add the other half and remove the first half
+    Team.users.through.objects.bulk_create([Team.users.through(team_id=team.pk, user_id=user.pk) for team in teams[:150]])
+    authenticator_user.claims = {
+        'organization_membership': {organization.name: True},
+        'team_membership': {organization.name: {team.name: index >= 150 for index, team in enumerate(teams)}},
+    }
+
+    with CaptureQueriesContext(connection) as queries:
+        reconcile_user_memberships(user, authenticator_user)
+
+    # organizations, teams, a select and an insert for each of organization and team membership and the team delete
+    # (which collects the rows for the delete signals first), none of which depends on the number of teams
+    assert len(queries.captured_queries) == 9
+    assert set(user.teams.values_list('name', flat=True)) == {team.name for team in teams[150:]}
@@ -0,0 +1,86 @@
+import pytest
+
+from ansible_base.authentication.models import AuthenticatorMap, AuthenticatorUser
+from ansible_base.authentication.utils.provisioning import ProvisionedUser, provision_users
+
+
+@pytest.fixture
+def provisioning_maps(local_authenticator):
+    AuthenticatorMap.objects.create(
+        name="admins", authenticator=local_authenticator, map_type="is_superuser", order=1, triggers={"groups": {"has_or": ["admins"]}}
+    )
+    return local_authenticator
+
+
+def _page(*users):
+    return [
+        ProvisionedUser(
+            uid=username, details={"username": username, "email": f"{username}@example.com"}, extra_data={"mail": [f"{username}@example.com"]}, groups=groups
+        )
+        for username, groups in users
+    ]
+
+
+@pytest.mark.django_db
+def test_provision_users(provisioning_maps, django_user_model):
+    pages = [_page(("admin1", ["admins"]), ("user1", [])), _page(("user2", ["other"]))]
+    report = provision_users(provisioning_maps, iter(pages))
+    assert report['users'] == 3
+    assert report['created'] == 3
+    assert report['flags']['is_superuser'] == {'gained': 1, 'lost': 0}
+
+    admin = AuthenticatorUser.objects.get(provider=provisioning_maps, uid="admin1")
+    assert admin.user.is_superuser is True
+    assert admin.user.email == "admin1@example.com"
+    assert admin.groups == ["admins"]
+    assert admin.access_allowed is True
+    assert AuthenticatorUser.objects.get(provider=provisioning_maps, uid="user2").user.is_superuser is False
+    assert sorted(provisioning_maps.users.values_list('username', flat=True)) == ["admin1", "user1", "user2"]
+
+
+@pytest.mark.django_db
+def test_provision_users_updates_existing_users(provisioning_maps, django_user_model):
+    user = django_user_model.objects.create(username="admin1")
+    AuthenticatorUser.objects.create(
+        uid="admin1", user=user, provider=provisioning_maps, extra_data={"auth_time": "2024-01-01T00:00:00Z"}, groups=[], access_allowed=True
+    )
+
+    report = provision_users(provisioning_maps, [_page(("admin1", ["admins"]))])
+    assert report['created'] == 0
+    assert report['flags']['is_superuser'] == {'gained': 1, 'lost': 0}
+
+    authenticator_user = AuthenticatorUser.objects.get(provider=provisioning_maps, uid="admin1")
+    assert authenticator_user.user_id == user.id
+    assert authenticator_user.groups == ["admins"]
+    # Provisioning is not a login so the last login time is kept
+    assert authenticator_user.extra_data == {"mail": ["admin1@example.com"], "auth_time": "2024-01-01T00:00:00Z"}
+    user.refresh_from_db()
+    assert user.is_superuser is True
+    # The AuthenticatorUser existed but the user was never added to the authenticator
+    assert list(provisioning_maps.users.all()) == [user]
+
+
+@pytest.mark.django_db
+def test_provision_users_dry_run(provisioning_maps, django_user_model):
+    report = provision_users(provisioning_maps, [_page(("admin1", ["admins"]))], dry_run=True)
+    assert report['created'] == 1
+    assert report['flags']['is_superuser'] == {'gained': 1, 'lost': 0}
+    assert not AuthenticatorUser.objects.filter(provider=provisioning_maps).exists()
+    assert not django_user_model.objects.filter(username="admin1").exists()
+    assert not provisioning_maps.users.exists()
+
+
+@pytest.mark.django_db
+def test_provision_users_queries_do_not_grow_with_page(provisioning_maps):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    provision_users(provisioning_maps, [_page(*[(f"user{index}", []) for index in range(50)])])
+
+    # Updating the groups of existing users costs the same number of queries however many there are in the page
+    query_counts = []
+    for size in [5, 50]:
+        with CaptureQueriesContext(connection) as queries:
+            provision_users(provisioning_maps, [_page(*[(f"user{index}", [f"group{size}"]) for index in range(size)])])
+        query_counts.append(len(queries))
+    assert query_counts[0] == query_counts[1]
@@ -0,0 +1,89 @@
+from unittest import mock
+
+import pytest
+
+from ansible_base.authentication.models import AuthenticatorUser, ReconciliationJob
+from ansible_base.authentication.utils.claims import queue_reconciliation
+from ansible_base.authentication.utils.reconciliation import process_reconciliation_queue
+
+
+@pytest.fixture
+def queued_users(local_authenticator, randname):
+    from django.contrib.auth import get_user_model
+
+    authenticator_users = []
+    for _ in range(3):
+        user = get_user_model().objects.create(username=randname("user"))
+        authenticator_user = AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator)
+        queue_reconciliation(user, authenticator_user)
+        authenticator_users.append(authenticator_user)
+    return authenticator_users
+
+
+@pytest.mark.django_db
+def test_queue_reconciliation_coalesces(local_authenticator, github_authenticator, user):
+    first = AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator)
+    second = AuthenticatorUser.objects.create(uid=user.username, user=user, provider=github_authenticator)
+
+    queue_reconciliation(user, first)
+    queued = ReconciliationJob.objects.get(user=user).queued
+    queue_reconciliation(user, second)
+
+    job = ReconciliationJob.objects.get(user=user)
+    assert job.authenticator_user == second
+    # The job keeps its place in the queue
+    assert job.queued == queued
+
+
+@pytest.mark.django_db
+def test_process_reconciliation_queue_in_batches(queued_users):
+    with mock.patch('ansible_base.authentication.utils.claims.ReconcileUser.reconcile_user_claims') as reconcile:
+        assert process_reconciliation_queue(batch_size=2) == 2
+        assert ReconciliationJob.objects.count() == 1
+        assert process_reconciliation_queue(batch_size=2) == 1
+        assert process_reconciliation_queue(batch_size=2) == 0
+
+    assert [call.args for call in reconcile.call_args_list] == [(au.user, au) for au in queued_users]
+    assert ReconciliationJob.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_process_reconciliation_queue_failure_keeps_job(queued_users, expected_log):
+    failed = queued_users[0]
+    last_queued = ReconciliationJob.objects.get(user=queued_users[2].user).queued
+    with mock.patch('ansible_base.authentication.utils.claims.ReconcileUser.reconcile_user_claims', side_effect=[Exception("boom"), None, None]) as reconcile:
+        with expected_log('ansible_base.authentication.utils.reconciliation.logger', 'error', 'boom'):
+            assert process_reconciliation_queue() == 2
+
+    assert reconcile.call_count == 3
+    # The failed user is still queued, behind anyone who was queued before the batch ran
+    job = ReconciliationJob.objects.get()
+    assert job.user == failed.user
+    assert job.queued > last_queued
+
+    with mock.patch('ansible_base.authentication.utils.claims.ReconcileUser.reconcile_user_claims') as reconcile:
+        assert process_reconciliation_queue() == 1
+    reconcile.assert_called_once_with(failed.user, failed)
+    assert ReconciliationJob.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_process_reconciliation_queue_deletes_job_with_reconcile(queued_users):
+    def reconcile(user, authenticator_user):
+        # The job is only removed in the transaction which reconciles the user
+        assert ReconciliationJob.objects.filter(user=user).exists()
+
+    with mock.patch('ansible_base.authentication.utils.claims.ReconcileUser.reconcile_user_claims', side_effect=reconcile):
+        assert process_reconciliation_queue() == 3
+
+    assert ReconciliationJob.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_process_reconciliation_queue_interrupted(queued_users):
+    # i.e. the worker is killed while reconciling the second user, the users it did not finish stay queued
+    with mock.patch('ansible_base.authentication.utils.claims.ReconcileUser.reconcile_user_claims', side_effect=[None, KeyboardInterrupt()]):
+        with pytest.raises(KeyboardInterrupt):
+            process_reconciliation_queue()
+
+    assert set(ReconciliationJob.objects.values_list('user', flat=True)) == {queued_users[1].user.pk, queued_users[2].user.pk}
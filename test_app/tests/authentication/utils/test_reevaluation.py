@@ -0,0 +1,132 @@
+import pytest
+
+from ansible_base.authentication.models import AuthenticatorMap, AuthenticatorUser
+from ansible_base.authentication.utils.reevaluation import reevaluate_claims
+
+
+@pytest.fixture
+def reevaluation_maps(local_authenticator):
+    AuthenticatorMap.objects.create(
+        name="admins", authenticator=local_authenticator, map_type="is_superuser", order=1, triggers={"groups": {"has_or": ["admins"]}}
+    )
+    AuthenticatorMap.objects.create(
+        name="example org",
+        authenticator=local_authenticator,
+        map_type="organization",
+        organization="example",
+        order=2,
+        triggers={"attributes": {"email": {"ends_with": "@example.com"}}},
+    )
+    return local_authenticator
+
+
+@pytest.fixture
+def authenticator_users(reevaluation_maps, django_user_model):
+    authenticator_users = []
+    for username, email, groups in [("admin1", "admin1@example.com", ["admins"]), ("user1", "user1@example.org", []), ("nogroups", "ng@example.com", None)]:
+        user = django_user_model.objects.create(username=username)
+        authenticator_users.append(
+            AuthenticatorUser.objects.create(
+                uid=username,
+                user=user,
+                provider=reevaluation_maps,
+                extra_data={"email": email},
+                groups=groups,
+                access_allowed=True,
+                claims={"organization_membership": {}, "team_membership": {}},
+            )
+        )
+    return authenticator_users
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("processes", [1, 2])
+def test_reevaluate_claims_dry_run(reevaluation_maps, authenticator_users, processes):
+    report = reevaluate_claims(reevaluation_maps, dry_run=True, batch_size=1, processes=processes)
+    assert report == {
+        'users': 3,
+        'changed': 1,
+        # We don't know the groups of nogroups so it can't be evaluated
+        'skipped': 1,
+        'flags': {'access_allowed': {'gained': 0, 'lost': 0}, 'is_superuser': {'gained': 1, 'lost': 0}},
+        'organizations': {'example': {'gained': 1, 'lost': 0}},
+        'teams': {},
+    }
+
+    # Nothing was written
+    admin = AuthenticatorUser.objects.get(uid="admin1")
+    assert admin.user.is_superuser is False
+    assert admin.claims == {"organization_membership": {}, "team_membership": {}}
+
+
+@pytest.mark.django_db
+def test_reevaluate_claims(reevaluation_maps, authenticator_users, django_assert_max_num_queries):
+    report = reevaluate_claims(reevaluation_maps, dry_run=False, batch_size=1000)
+    assert report['changed'] == 1
+
+    admin = AuthenticatorUser.objects.get(uid="admin1")
+    assert admin.user.is_superuser is True
+    assert admin.claims == {"organization_membership": {"example": True}, "team_membership": {}}
+    user = AuthenticatorUser.objects.get(uid="user1")
+    assert user.user.is_superuser is False
+    assert user.claims == {"organization_membership": {"example": False}, "team_membership": {}}
+    map_ids = [str(auth_map.id) for auth_map in AuthenticatorMap.objects.order_by('order')]
+    assert user.last_login_map_results == [{map_ids[0]: False}, {map_ids[1]: False}]
+
+    # Running it again changes nothing and doesn't write anything
+    with django_assert_max_num_queries(2):
+        report = reevaluate_claims(reevaluation_maps, dry_run=False)
+    assert report['changed'] == 0
+
+
+@pytest.mark.django_db
+def test_reevaluate_claims_revokes(reevaluation_maps, authenticator_users):
+    reevaluate_claims(reevaluation_maps, dry_run=False)
+    AuthenticatorMap.objects.filter(name="admins").delete()
+    AuthenticatorMap.objects.filter(name="example org").update(triggers={"never": {}})
+    AuthenticatorMap.objects.get(name="example org").save()
+
+    report = reevaluate_claims(reevaluation_maps, dry_run=True)
+    assert report['organizations'] == {'example': {'gained': 0, 'lost': 1}}
+    # Without a map for is_superuser the flag is left alone
+    assert 'is_superuser' not in report['flags']
+    # nogroups is now evaluated since there are no group maps left
+    assert report['skipped'] == 0
+
+
+@pytest.mark.django_db
+def test_reevaluate_claims_limit(reevaluation_maps, authenticator_users):
+    pks = sorted(authenticator_user.pk for authenticator_user in authenticator_users)
+
+    report = reevaluate_claims(reevaluation_maps, dry_run=True, limit=2)
+    assert report['users'] == 2
+    assert report['next'] == pks[1]
+
+    report = reevaluate_claims(reevaluation_maps, dry_run=True, after=report['next'], limit=2)
+    assert report['users'] == len(pks) - 2
+    assert report['next'] is None
+
+    # Without a limit the report has no next
+    assert 'next' not in reevaluate_claims(reevaluation_maps, dry_run=True)
+
+
+@pytest.mark.django_db
+def test_reevaluate_claims_only_sees_stored_attributes(reevaluation_maps, authenticator_users):
+    # The attribute was not requested (i.e. by LDAP) when the users last logged in so it is not in their extra_data
+    AuthenticatorMap.objects.create(
+        name="it org",
+        authenticator=reevaluation_maps,
+        map_type="organization",
+        organization="it",
+        order=3,
+        triggers={"attributes": {"department": {"equals": "IT"}}},
+    )
+    report = reevaluate_claims(reevaluation_maps, dry_run=True)
+    assert report['organizations'].get('it', {'gained': 0, 'lost': 0}) == {'gained': 0, 'lost': 0}
+
+    # Once a login (or provision_users) stored the attribute the map matches
+    admin = AuthenticatorUser.objects.get(uid="admin1")
+    admin.extra_data = {**admin.extra_data, "department": "IT"}
+    admin.save()
+    report = reevaluate_claims(reevaluation_maps, dry_run=True)
+    assert report['organizations']['it'] == {'gained': 1, 'lost': 0}
@@ -0,0 +1,62 @@
+from unittest import mock
+
+from ansible_base.authentication.utils.server_selection import ServerSelector
+
+SERVERS = ["ldap://dc1.example.com", "ldap://dc2.example.com", "ldap://dc3.example.com"]
+
+
+def test_server_selector_prefers_fastest_server():
+    selector = ServerSelector(1, SERVERS)
+    # Nothing is known yet so the configured order is kept
+    assert selector.ordered() == SERVERS
+
+    selector.record_success(SERVERS[0], 0.4)
+    selector.record_success(SERVERS[1], 0.05)
+    selector.record_success(SERVERS[2], 0.2)
+    assert selector.ordered() == [SERVERS[1], SERVERS[2], SERVERS[0]]
+
+
+def test_server_selector_measures_new_servers_first():
+    selector = ServerSelector(1, SERVERS)
+    selector.record_success(SERVERS[0], 0.4)
+    assert selector.ordered() == [SERVERS[1], SERVERS[2], SERVERS[0]]
+
+
+def test_server_selector_demotes_failing_server(settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_SERVER_COOLDOWN = 30
+    selector = ServerSelector(1, SERVERS)
+    for server in SERVERS:
+        selector.record_success(server, 0.1)
+
+    with mock.patch('ansible_base.authentication.utils.server_selection.time.time', return_value=1000):
+        selector.record_failure(SERVERS[0], "Can't contact LDAP server")
+        assert selector.ordered() == [SERVERS[1], SERVERS[2], SERVERS[0]]
+        state = {server_state['server']: server_state for server_state in selector.get_state()}
+        assert state[SERVERS[0]]['demoted'] is True
+        assert state[SERVERS[0]]['last_error'] == "Can't contact LDAP server"
+        assert state[SERVERS[0]]['consecutive_failures'] == 1
+        assert state[SERVERS[1]]['demoted'] is False
+
+    # Once the cooldown is over the server is back in line
+    with mock.patch('ansible_base.authentication.utils.server_selection.time.time', return_value=1031):
+        assert selector.ordered() == SERVERS
+
+    selector.record_success(SERVERS[0], 0.1)
+    state = {server_state['server']: server_state for server_state in selector.get_state()}[SERVERS[0]]
+    assert state['consecutive_failures'] == 0
+    assert state['failures'] == 1
+    assert state['successes'] == 2
+
+
+def test_server_selector_latency_is_a_rolling_average():
+    selector = ServerSelector(1, SERVERS[:1])
+    selector.record_success(SERVERS[0], 1.0)
+    selector.record_success(SERVERS[0], 0.0)
+    assert selector.get_state()[0]['average_latency'] == 0.8
+
+
+def test_server_selector_reset():
+    selector = ServerSelector(1, SERVERS)
+    selector.record_success(SERVERS[2], 0.1)
+    selector.reset()
+    assert selector.get_state()[0]['successes'] == 0
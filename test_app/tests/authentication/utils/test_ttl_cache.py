@@ -0,0 +1,36 @@
+from unittest import mock
+
+from ansible_base.authentication.utils.ttl_cache import TTLCache
+
+
+def test_ttl_cache_expires():
+    cache = TTLCache(timeout=10, max_size=10)
+    with mock.patch('ansible_base.authentication.utils.ttl_cache.time.monotonic', return_value=100):
+        cache.set('user', 'cn=user,dc=example,dc=org')
+    with mock.patch('ansible_base.authentication.utils.ttl_cache.time.monotonic', return_value=109):
+        assert cache.get('user') == 'cn=user,dc=example,dc=org'
+    with mock.patch('ansible_base.authentication.utils.ttl_cache.time.monotonic', return_value=110):
+        assert cache.get('user', 'missing') == 'missing'
+    assert len(cache) == 0
+
+
+def test_ttl_cache_drops_least_recently_used():
+    cache = TTLCache(timeout=10, max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # Reading a makes b the least recently used entry
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_ttl_cache_delete_and_clear():
+    cache = TTLCache(timeout=10, max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.delete('a')
+    assert cache.get('a') is None
+    cache.clear()
+    assert len(cache) == 0
@@ -0,0 +1,56 @@
+import pytest
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.timezone import now
+
+from ansible_base.authentication.models import Authenticator, AuthenticatorMap
+from ansible_base.authentication.utils.authenticator_maps import compiled_map_cache
+from ansible_base.authentication.utils.versions import AUTHENTICATORS_VERSION, bump_version, get_version, is_shared_cache
+
+
+@pytest.mark.parametrize(
+    "cache,shared,expected",
+    [
+        (LocMemCache('test', {}), None, False),
+        (DummyCache('test', {}), None, False),
+        (LocMemCache('test', {}), True, True),
+        (object(), None, True),
+        (object(), False, False),
+    ],
+)
+def test_is_shared_cache(settings, cache, shared, expected):
+    settings.ANSIBLE_BASE_AUTHENTICATION_CACHE_SHARED = shared
+    assert is_shared_cache(cache) is expected
+
+
+@pytest.mark.django_db
+def test_get_version_from_database(settings, local_authenticator):
+    settings.ANSIBLE_BASE_AUTHENTICATION_CACHE_SHARED = False
+    queryset = Authenticator.objects.all()
+    version = get_version(AUTHENTICATORS_VERSION, queryset)
+    # A bump in our own cache is not what the other workers go by
+    bump_version(AUTHENTICATORS_VERSION)
+    assert get_version(AUTHENTICATORS_VERSION, queryset) == version
+
+    Authenticator.objects.filter(pk=local_authenticator.pk).update(modified_on=now())
+    modified_version = get_version(AUTHENTICATORS_VERSION, queryset)
+    assert modified_version != version
+
+    Authenticator.objects.filter(pk=local_authenticator.pk).delete()
+    assert get_version(AUTHENTICATORS_VERSION, queryset) not in (version, modified_version)
+
+
+@pytest.mark.django_db
+def test_compiled_map_cache_without_shared_cache(settings, local_authenticator):
+    settings.ANSIBLE_BASE_AUTHENTICATION_CACHE_SHARED = False
+    assert compiled_map_cache.get(local_authenticator.id).maps == ()
+
+    # Another worker adding a map can't bump our cache, the database tells us
+    AuthenticatorMap.objects.bulk_create(
+        [
+            AuthenticatorMap(
+                name="everyone", authenticator=local_authenticator, map_type="is_superuser", triggers={"always": {}}, created_on=now(), modified_on=now()
+            )
+        ]
+    )
+    assert [compiled_map.name for compiled_map in compiled_map_cache.get(local_authenticator.id).maps] == ["everyone"]
@@ -0,0 +1,187 @@
+import copy
+from unittest import mock
+
+import pytest
+from django.contrib.auth import user_logged_in
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ansible_base.authentication.models import AuthenticatorUser
+from ansible_base.authentication.utils import claims
+from ansible_base.authentication.utils.write_behind import WriteBehindBuffer, login_write_buffer
+
+
+@pytest.fixture
+def write_behind(settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND = True
+    settings.ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND_INTERVAL = 60
+    yield login_write_buffer
+    login_write_buffer.flush()
+
+
+def _authenticator_user_writes(captured_queries):
+    table = AuthenticatorUser._meta.db_table
+    return [query['sql'] for query in captured_queries if query['sql'].startswith(('UPDATE', 'INSERT')) and f'"{table}"' in query['sql']]
+
+
+@pytest.mark.django_db
+def test_update_user_claims_buffers_auth_time(write_behind, local_authenticator, user):
+    AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator, extra_data={"email": "user@example.com"}, groups=["group1"])
+    # The first login stores the claims
+    claims.update_user_claims(user, local_authenticator, ["group1"])
+    authenticator_user = AuthenticatorUser.objects.get(uid=user.username, provider=local_authenticator)
+
+    with CaptureQueriesContext(connection) as queries:
+        assert claims.update_user_claims(user, local_authenticator, ["group1"], authenticator_user) == user
+    assert _authenticator_user_writes(queries.captured_queries) == []
+    assert len(write_behind) == 1
+    auth_time = authenticator_user.extra_data['auth_time']
+
+    # Another process stores new attributes before we flush, the flush only adds the auth_time
+    AuthenticatorUser.objects.filter(pk=authenticator_user.pk).update(extra_data={"email": "new@example.com"})
+
+    write_behind.flush()
+    assert len(write_behind) == 0
+    authenticator_user.refresh_from_db()
+    assert authenticator_user.extra_data == {"email": "new@example.com", "auth_time": auth_time}
+
+
+@pytest.mark.django_db
+def test_update_user_claims_writes_changes_right_away(write_behind, local_authenticator, user):
+    AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator, extra_data={"email": "user@example.com"}, groups=["group1"])
+    authenticator_user = AuthenticatorUser.objects.get(uid=user.username, provider=local_authenticator)
+    write_behind.add(authenticator_user, {}, extra_data={'auth_time': 'stale'})
+
+    with CaptureQueriesContext(connection) as queries:
+        claims.update_user_claims(user, local_authenticator, ["group2"], authenticator_user)
+    assert len(_authenticator_user_writes(queries.captured_queries)) == 1
+    # The buffered update would only move auth_time back
+    assert len(write_behind) == 0
+
+    authenticator_user.refresh_from_db()
+    assert authenticator_user.groups == ["group2"]
+    assert authenticator_user.extra_data['auth_time'] != 'stale'
+
+
+@pytest.mark.django_db
+def test_update_user_claims_without_write_behind(local_authenticator, user):
+    AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator, extra_data={"email": "user@example.com"}, groups=["group1"])
+    authenticator_user = AuthenticatorUser.objects.get(uid=user.username, provider=local_authenticator)
+
+    with CaptureQueriesContext(connection) as queries:
+        claims.update_user_claims(user, local_authenticator, ["group1"], authenticator_user)
+    assert len(_authenticator_user_writes(queries.captured_queries)) == 1
+    assert len(login_write_buffer) == 0
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("enabled", [True, False])
+def test_authenticator_user_load_copies_login_data(settings, local_authenticator, user, enabled):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND = enabled
+    AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator, extra_data={"email": "user@example.com"}, groups=["group1"])
+
+    with mock.patch('ansible_base.authentication.models.social_auth.copy.deepcopy', wraps=copy.deepcopy) as deepcopy:
+        authenticator_user = AuthenticatorUser.objects.get(uid=user.username, provider=local_authenticator)
+    # The copy is only needed to tell if a login can be buffered
+    assert deepcopy.called is enabled
+    assert hasattr(authenticator_user, '_loaded_login_data') is enabled
+    assert authenticator_user.only_auth_time_changed() is enabled
+
+
+@pytest.mark.django_db
+def test_set_extra_data_buffers_auth_time(write_behind, local_authenticator, user):
+    AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator, extra_data={"email": "user@example.com", "auth_time": 1})
+    authenticator_user = AuthenticatorUser.objects.get(uid=user.username, provider=local_authenticator)
+
+    with mock.patch.object(AuthenticatorUser, 'save') as save:
+        authenticator_user.set_extra_data({"auth_time": 2})
+        save.assert_not_called()
+        assert len(write_behind) == 1
+
+        authenticator_user.set_extra_data({"email": "new@example.com", "auth_time": 3})
+        save.assert_called_once_with(update_fields=['extra_data', 'modified'])
+        assert len(write_behind) == 0
+
+
+@pytest.mark.django_db
+def test_last_login_is_buffered(write_behind, user):
+    last_login = user.last_login
+    user_logged_in.send(sender=user.__class__, request=None, user=user)
+    assert len(write_behind) == 1
+    user.refresh_from_db()
+    assert user.last_login == last_login
+
+    write_behind.flush()
+    user.refresh_from_db()
+    assert user.last_login is not None and user.last_login != last_login
+
+
+@pytest.mark.django_db
+def test_last_login_without_write_behind(user):
+    user_logged_in.send(sender=user.__class__, request=None, user=user)
+    assert len(login_write_buffer) == 0
+    user.refresh_from_db()
+    assert user.last_login is not None
+
+
+@pytest.mark.django_db
+def test_buffer_flushes_when_full(settings, django_user_model, django_capture_on_commit_callbacks):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND_INTERVAL = 60
+    settings.ANSIBLE_BASE_AUTHENTICATOR_WRITE_BEHIND_MAX_ENTRIES = 3
+    users = [django_user_model.objects.create(username=f'write_behind_{i}') for i in range(3)]
+    buffer = WriteBehindBuffer()
+
+    with CaptureQueriesContext(connection) as queries:
+        for user in users[:2]:
+            buffer.add(user, {'is_active': False})
+        assert len(buffer) == 2
+        assert queries.captured_queries == []
+        assert buffer.timer is not None
+
+        with django_capture_on_commit_callbacks(execute=True):
+            buffer.add(users[2], {'is_active': False})
+    assert len(buffer) == 0
+    assert buffer.timer is None
+    # All three users are written in one statement
+    assert len([query for query in queries.captured_queries if query['sql'].startswith('UPDATE')]) == 1
+    assert django_user_model.objects.filter(pk__in=[user.pk for user in users], is_active=False).count() == 3
+
+
+@pytest.mark.django_db
+def test_buffer_flush_skips_deleted_rows(local_authenticator, user):
+    authenticator_user = AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator)
+    buffer = WriteBehindBuffer()
+    buffer.add(authenticator_user, {}, extra_data={'auth_time': 'now'})
+    authenticator_user.delete()
+    buffer.flush()
+    assert not AuthenticatorUser.objects.filter(uid=user.username).exists()
+
+
+@pytest.mark.django_db
+def test_buffer_requeues_failed_writes(django_user_model):
+    from ansible_base.authentication.utils import write_behind
+
+    user = django_user_model.objects.create(username='write_behind_retry')
+    buffer = WriteBehindBuffer()
+    buffer.add(user, {'is_active': False})
+
+    with mock.patch.object(buffer, '_write', side_effect=Exception("database is down")):
+        buffer.flush()
+    assert len(buffer) == 1
+    assert buffer.timer is not None
+    user.refresh_from_db()
+    assert user.is_active is True
+
+    # A newer update which was buffered in the meantime wins over the failed one
+    buffer.add(user, {'first_name': 'Retried'})
+    buffer.flush()
+    assert len(buffer) == 0
+    user.refresh_from_db()
+    assert user.is_active is False
+    assert user.first_name == 'Retried'
+
+    buffer.add(user, {'is_active': True})
+    with mock.patch.object(buffer, '_write', side_effect=Exception("database is down")):
+        for _ in range(write_behind.MAX_ATTEMPTS):
+            buffer.flush()
+    assert len(buffer) == 0
@@ -0,0 +1,64 @@
+import pytest
+from django.urls import reverse
+
+from ansible_base.authentication.models import AuthenticatorMap, AuthenticatorUser
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "data,status_code,is_superuser",
+    [
+        ({}, 200, False),
+        ({"dry_run": True}, 200, False),
+        ({"dry_run": False}, 200, True),
+        ({"dry_run": "no"}, 400, False),
+        ({"after": "no"}, 400, False),
+        ({"after": -1}, 400, False),
+    ],
+)
+def test_authenticator_reevaluate_claims(admin_api_client, local_authenticator, random_user, data, status_code, is_superuser):
+    AuthenticatorMap.objects.create(name="everyone", authenticator=local_authenticator, map_type="is_superuser", triggers={"always": {}})
+    AuthenticatorUser.objects.create(uid=random_user.username, user=random_user, provider=local_authenticator)
+    # Logging in the admin client also created a (non superuser) authenticator user
+    expected_gained = AuthenticatorUser.objects.filter(provider=local_authenticator, user__is_superuser=False).count()
+
+    url = reverse('authenticator-reevaluate-claims', kwargs={'pk': local_authenticator.id})
+    response = admin_api_client.post(url, data=data, format='json')
+    assert response.status_code == status_code
+    if status_code == 200:
+        assert response.data['flags']['is_superuser'] == {'gained': expected_gained, 'lost': 0}
+        assert response.data['next'] is None
+    random_user.refresh_from_db()
+    assert random_user.is_superuser is is_superuser
+
+
+@pytest.mark.django_db
+def test_authenticator_reevaluate_claims_pages(admin_api_client, local_authenticator, randname, django_user_model, settings):
+    settings.ANSIBLE_BASE_AUTHENTICATOR_REEVALUATE_PAGE_SIZE = 2
+    AuthenticatorMap.objects.create(name="everyone", authenticator=local_authenticator, map_type="is_superuser", triggers={"always": {}})
+    for _ in range(3):
+        user = django_user_model.objects.create(username=randname("user"))
+        AuthenticatorUser.objects.create(uid=user.username, user=user, provider=local_authenticator)
+    authenticator_users = list(AuthenticatorUser.objects.filter(provider=local_authenticator).order_by('pk'))
+
+    url = reverse('authenticator-reevaluate-claims', kwargs={'pk': local_authenticator.id})
+    seen = 0
+    data = {"dry_run": False}
+    while True:
+        response = admin_api_client.post(url, data=data, format='json')
+        assert response.status_code == 200
+        assert response.data['users'] <= 2
+        seen += response.data['users']
+        if response.data['next'] is None:
+            break
+        assert response.data['users'] == 2
+        data['after'] = response.data['next']
+
+    assert seen == len(authenticator_users)
+    assert not django_user_model.objects.filter(authenticator_user__provider=local_authenticator, is_superuser=False).exists()
+
+
+@pytest.mark.django_db
+def test_authenticator_servers_without_servers(admin_api_client, local_authenticator):
+    response = admin_api_client.get(reverse('authenticator-servers', kwargs={'pk': local_authenticator.id}))
+    assert response.status_code == 404
@@ -259,6 +259,12 @@ def test_authenticator_map_validate(admin_api_client, local_authenticator, shut_
             "Expected dict but got int",
             id="triggers groups is not dict",
         ),
+        pytest.param(
+            {'attributes': {"email": {"matches": "(unclosed"}}},
+            "triggers.attributes.email.matches",
+            "Invalid regular expression",
+            id="triggers attributes matches is not a valid regex",
+        ),
     ],
 )
 def test_authenticator_map_validate_trigger_data(admin_api_client, local_authenticator, shut_up_logging, triggers, error_field, error_message):
@@ -500,3 +500,43 @@ def organization(db, randname):
 @pytest.fixture
 def team(organization):
     return models.Team.objects.create(name='foo-team', organization=organization)
+
+
+@pytest.fixture(autouse=True)
+def authenticator_registry():
+    # The registry lives for the life of the process, make sure plugins from a previous test don't leak into the next one
+    from ansible_base.authentication.registry import authenticator_registry
+
+    authenticator_registry.reset()
+    yield authenticator_registry
+    authenticator_registry.reset()
+
+
+@pytest.fixture(autouse=True)
+def social_auth_cache():
+    # Authenticators are cached by slug and slugs get reused between tests
+    from ansible_base.authentication.social_auth import social_auth_cache
+
+    social_auth_cache.reset()
+    yield social_auth_cache
+    social_auth_cache.reset()
+
+
+@pytest.fixture(autouse=True)
+def authentication_cache():
+    # Learned routes and circuit breakers are keyed by ids which get reused between tests
+    from ansible_base.authentication.utils.versions import get_authentication_cache
+
+    cache = get_authentication_cache()
+    cache.clear()
+    yield cache
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def ldap_connection_pools():
+    # Pools are kept for the life of the process, don't hand connections (or mocks) from one test to the next
+    from ansible_base.authentication.utils.connection_pool import connection_pools
+
+    yield connection_pools
+    connection_pools.reset()
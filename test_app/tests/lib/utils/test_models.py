@@ -1,5 +1,5 @@
 from functools import partial
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import pytest
 from django.test.utils import override_settings
@@ -32,3 +32,79 @@ def test_system_user_set_but_no_user(expected_log):
         expected_log = partial(expected_log, "ansible_base.lib.utils.models.logger")
         with expected_log('error', f'is set to {system_username} but no user with that username exists'):
             assert models.get_system_user() is None
+
+
+@pytest.mark.django_db
+def test_upsert_user_creates_user(system_user):
+    from django.db.models.signals import post_save
+
+    from ansible_base.resource_registry.models import Resource
+    from test_app.models import User
+
+    receiver = MagicMock()
+    post_save.connect(receiver, sender=User)
+    try:
+        user, created = models.upsert_user('bob', {'email': 'bob@example.com'})
+    finally:
+        post_save.disconnect(receiver, sender=User)
+
+    assert created is True
+    assert user.pk and user.email == 'bob@example.com'
+    assert not user.has_usable_password()
+    assert user.created_by == system_user and user.created_on is not None
+    receiver.assert_called_once()
+    assert receiver.call_args.kwargs['created'] is True
+    # The resource registry sees the new user like it would after save()
+    assert Resource.get_resource_for_object(user)
+
+
+@pytest.mark.django_db
+def test_upsert_user_existing_user(random_user, django_assert_num_queries):
+    password = random_user.password
+    # A returning user is only looked up
+    with django_assert_num_queries(1):
+        user, created = models.upsert_user(random_user.username, {'email': 'changed@example.com'})
+    assert created is False
+    assert user == random_user
+    assert user.email == random_user.email
+    assert user.password == password
+
+
+@pytest.mark.django_db
+def test_upsert_user_update_existing_user(random_user):
+    user, created = models.upsert_user(random_user.username, {'email': 'changed@example.com', 'is_superuser': True}, update=True)
+    assert created is False
+    assert user.pk == random_user.pk
+    assert user.email == 'changed@example.com'
+    assert user.is_superuser is True
+    assert user.modified_on > random_user.modified_on
+
+
+@pytest.mark.django_db
+def test_upsert_user_lost_race(random_user):
+    from test_app.models import User
+
+    # Another login inserts the user between our lookup and our insert
+    with patch.object(User.objects, 'filter', return_value=User.objects.none()):
+        user, created = models.upsert_user(random_user.username, {'email': 'changed@example.com'})
+    assert created is False
+    assert user.pk == random_user.pk
+    assert user.email == random_user.email
+
+
+@pytest.mark.django_db
+def test_upsert_user_uses_save(system_user):
+    from django.db.models.signals import pre_save
+
+    from test_app.models import User
+
+    receiver = MagicMock()
+    pre_save.connect(receiver, sender=User)
+    try:
+        with patch.object(User, 'save', autospec=True, side_effect=User.save) as save:
+            user, created = models.upsert_user('alice')
+    finally:
+        pre_save.disconnect(receiver, sender=User)
+    assert created is True
+    save.assert_called_once_with(user, force_insert=True)
+    receiver.assert_called_once()